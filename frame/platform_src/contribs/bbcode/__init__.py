@@ -1,3 +1,4 @@
 from .core import *
 from . import tags
 from . import video
+from . import cache
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+"""BBCode 渲染结果的缓存
+
+HTML 只取决于 source, 渲染参数 (resp_width, br 等) 以及节点的实现, 因此以
+三者的 hash 作为缓存的键:
+
+* 进程内的 LRU, 有数量上限和总字节数上限, 超过单条上限的 HTML 只放在
+  Redis 中; 两个字节数上限可以在 app 配置中用 BBCODE_RENDER_CACHE_LRU_BYTES
+  和 BBCODE_RENDER_CACHE_LRU_ENTRY_BYTES 设置
+* 可选的 Redis, 通过 frame.platform.engines.redis 访问, 需要在 app 配置中
+  设置 BBCODE_RENDER_CACHE_REDIS = True
+
+节点或 hook 的代码改动后 registry_version 会改变, 旧的缓存自然失效.
+依赖于请求的节点 (比如根据浏览器决定公式图片格式的 MathMode) 通过
+cache_vary 区分缓存, 无法区分的节点设置 cacheable = False (也可以是按
+节点判断的 property), 含有这类节点的文档不会被缓存.
+
+"""
+
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app as app
+
+from .core import BaseNode, registered_classes, registry_version
+
+__all__ = ['RenderCache', 'render_cache']
+
+# unicode 每个字符占用的字节数
+CHAR_SIZE = 4 if sys.maxunicode > 0xffff else 2
+
+
+class RenderCache(object):
+
+    def __init__(self, maxsize=1024, maxbytes=32 * 1024 * 1024,
+                 max_entry_bytes=256 * 1024, expire=7 * 86400,
+                 key_prefix='bbcode-html:'):
+        self.maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._max_entry_bytes = max_entry_bytes
+        self.lru_bytes = 0
+        self.expire = expire
+        self.key_prefix = key_prefix
+        self.lock = threading.Lock()
+        self.lru = OrderedDict()
+        self._nodes_version = None
+
+    @property
+    def maxbytes(self):
+        if app:
+            return app.config.get('BBCODE_RENDER_CACHE_LRU_BYTES',
+                                  self._maxbytes)
+        return self._maxbytes
+
+    @property
+    def max_entry_bytes(self):
+        if app:
+            return app.config.get('BBCODE_RENDER_CACHE_LRU_ENTRY_BYTES',
+                                  self._max_entry_bytes)
+        return self._max_entry_bytes
+
+    @property
+    def redis(self):
+        if app and app.config.get('BBCODE_RENDER_CACHE_REDIS'):
+            from frame.platform.engines import redis
+            return redis
+
+    def _inspect_nodes(self):
+        """找出需要区分缓存以及不能缓存的节点类型, 随注册表的版本更新"""
+        version = registry_version()
+        if self._nodes_version != version:
+            default_vary = BaseNode.cache_vary.__func__
+            vary_nodes = {}
+            uncacheable = set()
+            for node_class in registered_classes():
+                func = node_class.cache_vary.__func__
+                if func is not default_vary:
+                    vary_nodes.setdefault(func, node_class)
+                # cacheable 可以是 property, 由节点自己决定能否缓存
+                if node_class.cacheable is not True:
+                    uncacheable.add(node_class)
+            self._vary_nodes = sorted(vary_nodes.values(),
+                                      key=lambda c: c.__name__)
+            self._uncacheable = tuple(uncacheable)
+            self._nodes_version = version
+        return version
+
+    def key(self, bbcode, **kwargs):
+        """根据 source, 渲染参数, 注册表版本和请求相关的输入计算缓存的键"""
+        version = self._inspect_nodes()
+        vary = [node_class.cache_vary() for node_class in self._vary_nodes]
+        digest = hashlib.sha1(bbcode.source.encode('U8'))
+        digest.update(repr(sorted(kwargs.iteritems())))
+        digest.update(repr(bbcode.max_depth))
+        digest.update(repr(vary))
+        return self.key_prefix + version[:8] + ':' + digest.hexdigest()
+
+    def cacheable(self, bbcode):
+        # 超出解析限制的结果取决于当时的负载, 不缓存
+        if bbcode.nodes is not None and bbcode.degraded:
+            return False
+        self._inspect_nodes()
+        if not self._uncacheable:
+            return True
+        stack = [bbcode.nodes]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, self._uncacheable) and not node.cacheable:
+                return False
+            stack.extend(node.children)
+        return True
+
+    def get(self, key):
+        with self.lock:
+            html = self.lru.pop(key, None)
+            if html is not None:
+                self.lru[key] = html
+                return html
+        redis = self.redis
+        if redis is not None:
+            html = redis.get(key)
+            if html is not None:
+                html = html.decode('U8')
+                self._set_lru(key, html)
+                return html
+        return None
+
+    def _set_lru(self, key, html):
+        size = len(html) * CHAR_SIZE
+        maxbytes = self.maxbytes
+        with self.lock:
+            old = self.lru.pop(key, None)
+            if old is not None:
+                self.lru_bytes -= len(old) * CHAR_SIZE
+            if self.maxsize <= 0 or size > self.max_entry_bytes or \
+               size > maxbytes:
+                return
+            self.lru[key] = html
+            self.lru_bytes += size
+            while len(self.lru) > self.maxsize or self.lru_bytes > maxbytes:
+                _, old = self.lru.popitem(last=False)
+                self.lru_bytes -= len(old) * CHAR_SIZE
+
+    def get_many(self, keys):
+        """同 get, 不在 LRU 中的键通过一次 mget 从 Redis 读取"""
+        htmls = []
+        with self.lock:
+            for key in keys:
+                html = self.lru.pop(key, None)
+                if html is not None:
+                    self.lru[key] = html
+                htmls.append(html)
+        redis = self.redis
+        missing = [i for i, html in enumerate(htmls) if html is None]
+        if redis is not None and missing:
+            for i, html in zip(missing, redis.mget([keys[i] for i in missing])):
+                if html is not None:
+                    htmls[i] = html.decode('U8')
+                    self._set_lru(keys[i], htmls[i])
+        return htmls
+
+    def set(self, key, html):
+        self._set_lru(key, html)
+        redis = self.redis
+        if redis is not None:
+            redis.setex(key, html.encode('U8'), self.expire)
+
+    def set_many(self, items):
+        """同 set, 通过一次 pipeline 写入 Redis"""
+        for key, html in items:
+            self._set_lru(key, html)
+        redis = self.redis
+        if redis is not None and items:
+            pipe = redis.pipeline(transaction=False)
+            for key, html in items:
+                pipe.setex(key, html.encode('U8'), self.expire)
+            pipe.execute()
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+            self.lru_bytes = 0
+
+    def html(self, bbcode, **kwargs):
+        """给出 bbcode 的 HTML, 优先从缓存中读取
+
+        命中缓存时不会解析 source, after_parse 的 hook 也不会被触发.
+
+        """
+        key = self.key(bbcode, **kwargs)
+        html = self.get(key)
+        if html is None:
+            bbcode.prepare_many([bbcode])
+            html = bbcode.nodes.html(**kwargs)
+            if self.cacheable(bbcode):
+                self.set(key, html)
+        return html
+
+    def html_many(self, bbcodes, **kwargs):
+        """批量给出 HTML, 未命中缓存的文档一起解析, 渲染和写入缓存"""
+        if not bbcodes:
+            return []
+        keys = [self.key(bbcode, **kwargs) for bbcode in bbcodes]
+        htmls = self.get_many(keys)
+        missing = [i for i, html in enumerate(htmls) if html is None]
+        if missing:
+            bbcodes[0].prepare_many([bbcodes[i] for i in missing])
+            items = []
+            for i in missing:
+                htmls[i] = bbcodes[i].nodes.html(**kwargs)
+                if self.cacheable(bbcodes[i]):
+                    items.append((keys[i], htmls[i]))
+            self.set_many(items)
+        return htmls
+
+
+render_cache = RenderCache()
@@ -2,10 +2,20 @@
 from __future__ import unicode_literals
 """A minimal but pluggable BBCode parser"""
 
-import weakref
+import os
+import re
+import copy
+import sys
+import time
+import zlib
+import bisect
+import itertools
+import hashlib
 import anyjson as json
+import json as _json # anyjson 的 dumps 不支持 separators
+from itertools import chain
 from collections import OrderedDict
-from werkzeug import utils
+from werkzeug import utils, url_quote
 from cssselect.parser import Element, CombinedSelector
 import cssselect
 
@@ -16,7 +26,13 @@ __all__ = ['BBCode']
 _NODES = OrderedDict()
 _REGEX_NODES = OrderedDict()
 _HOOKS = {}
+_BATCH_HOOKS = set()
+_TAG_TRIE = None
+_ALLOWED_NODES = {}
+_REGISTRY_VERSION = None
 MAXIMUM_DEPTH = 256
+AST_VERSION = 2
+_SPACES = re.compile(r'\s*', re.U)
 
 class BBCodeSyntaxError(Exception):
     pass
@@ -24,25 +40,39 @@ class BBCodeSyntaxError(Exception):
 class NodeError(Exception):
     pass
 
+class BBCodeBudgetExceeded(Exception):
+    pass
+
 class BaseNode(object):
-    """表示一个节点的 object"""
+    """表示一个节点的 object
+
+    一篇长文会有数以万计的节点, 因此节点都使用 __slots__, 子类需要的属性
+    也要在自己的 __slots__ 中声明. 父节点和在兄弟中的位置在构造时记录,
+    构造之后不要再修改 children.
+
+    """
+
+    __slots__ = ('value', 'children', '_parent', '_index')
 
     name = None
     tag_includes = None
     tag_excludes = None
     display = 'inline'
+    # 渲染结果依赖于 cache_vary 无法表达的输入时, 设为 False 以免被缓存
+    cacheable = True
+    # text() 不包含内容的节点 (比如图片) 设为 False, 供 BBCode.iter_text 使用
+    has_text = True
 
     def __init__(self, value, children=None):
         self.value = value
         if children is None:
             children = []
         self.children = children
-        for child in children:
-            child.__bind_parent(self)
-        self.__parent = None
-
-    def __bind_parent(self, parent):
-        self.__parent = weakref.proxy(parent)
+        for index, child in enumerate(children):
+            child._parent = self
+            child._index = index
+        self._parent = None
+        self._index = None
 
     def _filter(self, selector):
         result = []
@@ -66,13 +96,10 @@ class BaseNode(object):
         return result
 
     def offset_sibling(self, offset):
-        parent = self.__parent
-        if not parent:
-            return
-        try:
-            idx = parent.children.index(self) + offset
-        except IndexError:
+        parent = self._parent
+        if parent is None:
             return
+        idx = self._index + offset
         if idx > -1 and idx < len(parent.children):
             return parent.children[idx]
         else:
@@ -84,6 +111,15 @@ class BaseNode(object):
     def next_sibling(self):
         return self.offset_sibling(1)
 
+    @classmethod
+    def cache_vary(cls):
+        """给出影响该类节点渲染结果的请求相关输入 (比如浏览器),
+
+        返回值会被加入渲染缓存的键, 以区分不同的输入. 默认为 None.
+
+        """
+        return None
+
     @classmethod
     def NODES(cls, BASE_NODES):
         """给出可以内嵌的节点类型
@@ -104,30 +140,82 @@ class BaseNode(object):
                 n.pop(tagname, None)
         return n
 
+    def children_iter_html(self, **kwargs):
+        """逐段给出所有子节点的HTML文本"""
+        for child in self.children:
+            for fragment in child.iter_html(**kwargs):
+                yield fragment
+
     def children_html(self, **kwargs):
         """给出所有子节点的HTML文本"""
-        return ''.join(map(lambda n: n.html(**kwargs), self.children))
+        return ''.join(self.children_iter_html(**kwargs))
 
     def children_unicode(self):
-        """给出所有子节点的BBCode文本"""
-        return ''.join(map(unicode, self.children))
+        """给出所有子节点的BBCode文本
+
+        使用显式的栈, 嵌套到 MAXIMUM_DEPTH 层也不会超出 Python 的递归深度.
+        覆盖了 __unicode__ 的节点仍然调用自己的 __unicode__.
+
+        """
+        parts = []
+        stack = self.children[::-1]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, basestring):
+                # 闭标签
+                parts.append(node)
+            elif type(node).__unicode__.__func__ is BaseNode.__unicode__.__func__:
+                opening, closing = node.markups()
+                parts.append(opening)
+                stack.append(closing)
+                stack.extend(node.children[::-1])
+            else:
+                parts.append(unicode(node))
+        return ''.join(parts)
 
     def children_text(self):
-        """给出所有子节点去掉HTML标记后的纯文本"""
-        return ''.join(map(lambda n: n.text(), self.children))
+        """给出所有子节点去掉HTML标记后的纯文本, 与 children_unicode 一样
+        使用显式的栈"""
+        parts = []
+        stack = self.children[::-1]
+        while stack:
+            node = stack.pop()
+            if type(node).text.__func__ is BaseNode.text.__func__ and \
+               node.name is not None:
+                stack.extend(node.children[::-1])
+            else:
+                parts.append(node.text())
+        return ''.join(parts)
 
     def text(self):
         if self.name is None:
             raise NotImplementedError
         return self.children_text()
 
+    @classmethod
+    def empty_text(cls, value):
+        """没有内容时 text() 的结果, 供 BBCode.iter_text 使用"""
+        return ''
+
+    def iter_html(self, **kwargs):
+        """逐段给出 HTML, 以便流式输出或者最后一次性拼接
+
+        子类实现 iter_html 和 html 之一即可, 只实现了 html 的节点在这里
+        一次给出全部 HTML.
+
+        """
+        if type(self).html.__func__ is BaseNode.html.__func__:
+            raise NotImplementedError
+        yield self.html(**kwargs)
+
     def html(self, **kwargs):
-        raise NotImplementedError
+        return ''.join(self.iter_html(**kwargs))
 
     def __html__(self):
         return self.html()
 
-    def __unicode__(self):
+    def markups(self):
+        """给出 (开标签, 闭标签)"""
         if self.name is None:
             raise NotImplementedError
         ret = '[' + self.name
@@ -135,10 +223,11 @@ class BaseNode(object):
             escaped = json.dumps(self.value) # 用 json 来转义
             ret += '=' + escaped
         ret += ']'
-        if self.children:
-            ret += self.children_unicode()
-        ret += '[/' + self.name + ']'
-        return ret
+        return ret, '[/' + self.name + ']'
+
+    def __unicode__(self):
+        opening, closing = self.markups()
+        return opening + self.children_unicode() + closing
 
     def __str__(self):
         return unicode(self).encode('U8')
@@ -158,6 +247,20 @@ class PlainNode(BaseNode):
 
     name = '__plain__'
 
+    __slots__ = ('start', )
+
+    def __init__(self, value, children=None, start=None):
+        if children:
+            super(PlainNode, self).__init__(value, children)
+        else:
+            # 纯文本节点的数量最多, 省去 BaseNode.__init__ 的调用
+            self.value = value
+            self.children = []
+            self._parent = None
+            self._index = None
+        # 在 source 中的起始位置, 不是取自 source 的为 None
+        self.start = start
+
     @property
     def has_linebreak(self):
         return '\n' in self.value
@@ -165,13 +268,13 @@ class PlainNode(BaseNode):
     def text(self):
         return self.value
 
-    def html(self, br=True, **kwargs):
+    def iter_html(self, br=True, **kwargs):
         ret = utils.escape(self.value)
         prev_sibling = self.prev_sibling()
         if br and ret[-1:] == '\n' and (
            prev_sibling is None or prev_sibling.display == 'inline'):
             ret = ret[:-1] + '<br />\n'
-        return ret
+        yield ret
 
     def __unicode__(self):
         return self.value
@@ -181,6 +284,8 @@ class RegexNode(BaseNode):
     name = '__regex__'
     regex = None
 
+    __slots__ = ()
+
     def text(self):
         return self.value.group(0)
 
@@ -191,29 +296,143 @@ class TopNode(BaseNode):
 
     name = '__top__'
 
-    def html(self, **kwargs):
-        return self.children_html(**kwargs)
+    __slots__ = ()
+
+    def iter_html(self, **kwargs):
+        return self.children_iter_html(**kwargs)
 
     def __unicode__(self):
         return self.children_unicode()
 
-def next_not_escaped_markup(source, markup):
-    length = len(source)
-    end = 0
-    while end < length:
+def skip_spaces(source, pos):
+    """返回 source 中 pos 之后第一个非空白字符的位置"""
+    if source[pos:pos + 1].isspace():
+        return _SPACES.match(source, pos).end()
+    return pos
+
+def next_not_escaped_markup(source, markup, start=0):
+    """返回 source 中 start 之后第一个没有被转义的 markup 的位置"""
+    end = start
+    while True:
         end = source.find(markup, end)
-        if not end or source[end - 1] != '\\':
-            return source[:end], end
+        if end < 0:
+            # not found
+            raise BBCodeSyntaxError(start)
+        if end == start or source[end - 1] != '\\':
+            return end
         end += 1
-    else:
-        # not found
-        raise BBCodeSyntaxError()
+
+def tag_trie():
+    """给出所有已注册 tagname 的前缀树
+
+    前缀树在注册结束后第一次使用时才构建, 每个节点是以字符为键的 dict,
+    键 None 对应的值是以该节点结尾的 tagname.
+
+    """
+    global _TAG_TRIE
+    if _TAG_TRIE is None:
+        trie = {}
+        for tagname in _NODES:
+            node = trie
+            for char in tagname:
+                node = node.setdefault(char, {})
+            node[None] = tagname
+        _TAG_TRIE = trie
+    return _TAG_TRIE
+
+def allowed_nodes(node_class, BASE_NODES):
+    """给出 node_class 在 BASE_NODES 中可以内嵌的节点类型
+
+    结果按 (BASE_NODES, node_class) 缓存在注册表中, 同一个上下文总是得到
+    同一个 OrderedDict, 因此下一层可以直接用 id 查找缓存, 不必重复复制.
+    返回的 OrderedDict 是共享的, 不要修改.
+
+    """
+    key = id(BASE_NODES), node_class
+    try:
+        return _ALLOWED_NODES[key][1]
+    except KeyError:
+        nodes = node_class.NODES(BASE_NODES)
+        # 同时保存 BASE_NODES 的引用, 避免 id 被复用
+        _ALLOWED_NODES[key] = BASE_NODES, nodes
+        return nodes
+
+def _index_node(index, start, node, children=()):
+    """把 node 加入索引
+
+    children 以外的子节点 (比如 [url] 没有内容时由 value 生成的) 是 node 自己
+    创建的, 与 node 在同一位置, 一并加入.
+
+    """
+    index.setdefault(node.name, []).append((start, node))
+    if node.children is not children:
+        stack = list(reversed(node.children))
+        while stack:
+            child = stack.pop()
+            index.setdefault(child.name, []).append((start, child))
+            stack.extend(reversed(child.children))
+
+_SELECTORS = {}
+
+def parse_selector(selector):
+    """解析 CSS 选择器, 结果会被缓存"""
+    try:
+        return _SELECTORS[selector]
+    except KeyError:
+        trees = [sele.parsed_tree for sele in cssselect.parse(selector)]
+        if len(_SELECTORS) >= 256:
+            _SELECTORS.clear()
+        _SELECTORS[selector] = trees
+        return trees
+
+def registered_classes():
+    """给出所有已注册的节点类型"""
+    return [node_class for _, node_class in
+            chain(_NODES.itervalues(), _REGEX_NODES.itervalues())]
+
+def registry_version():
+    """给出注册表的版本号
+
+    由已注册的节点类型, hook, 以及它们 (包括基类) 所在模块的文件内容计算
+    得到. 注册新的节点或 hook, 或者改动了它们的代码, 版本号都会改变.
+
+    """
+    global _REGISTRY_VERSION
+    if _REGISTRY_VERSION is None:
+        names = []
+        modules = set()
+        for tagname, (weight, node_class) in chain(_NODES.iteritems(),
+                                                  _REGEX_NODES.iteritems()):
+            names.append('%s:%s:%s.%s' % (tagname, weight,
+                                          node_class.__module__,
+                                          node_class.__name__))
+            modules.update(klass.__module__ for klass in node_class.__mro__)
+        for hookname, funcs in sorted(_HOOKS.iteritems()):
+            for func in funcs:
+                names.append('%s:%s.%s:%s' % (hookname, func.__module__,
+                                              func.__name__,
+                                              func in _BATCH_HOOKS))
+                modules.add(func.__module__)
+        digest = hashlib.sha1('\n'.join(names).encode('U8'))
+        for modname in sorted(modules):
+            filename = getattr(sys.modules.get(modname), '__file__', None)
+            if not filename:
+                continue
+            if filename[-4:] in ('.pyc', '.pyo') and \
+               os.path.exists(filename[:-1]):
+                filename = filename[:-1]
+            with open(filename, 'rb') as fp:
+                digest.update(fp.read())
+        _REGISTRY_VERSION = digest.hexdigest()
+    return _REGISTRY_VERSION
 
 def register_node(tagname, *aliases, **kwargs):
     weight = kwargs.pop('weight', len(tagname))
     sorted_key = lambda k: k[1][0]
     def decorator(cls):
-        global _NODES, _REGEX_NODES
+        global _REGEX_NODES, _TAG_TRIE, _REGISTRY_VERSION
+        _ALLOWED_NODES.clear()
+        _REGISTRY_VERSION = None
         if issubclass(cls, RegexNode):
             _REGEX_NODES[tagname] = (weight, cls)
             _REGEX_NODES = OrderedDict(sorted(_REGEX_NODES.items(), key=sorted_key, reverse=True))
@@ -226,231 +445,1058 @@ def register_node(tagname, *aliases, **kwargs):
                 cls.__name__ + b'Alias' + str(alias.capitalize()),
                 (cls, ), {
                     'name': alias,
+                    '__slots__': (),
                 })
             _NODES[alias] = (len(alias), _AliasNode)
-        _NODES = OrderedDict(sorted(_NODES.items(), key=sorted_key, reverse=True))
+        _TAG_TRIE = None # 下次使用时重新构建
         return cls
     return decorator
 
-def register_hook(hookname):
+def register_hook(hookname, batch=False):
+    """注册 hook
+
+    batch 为 True 时 hook 的第一个参数是 BBCode 的列表, 批量渲染时对整批
+    文档只调用一次, 以便合并其中的查询; 单个文档时参数为只有一个元素的列表.
+
+    目前的 hook:
+        - after_parse (bbcode) 解析完成后
+        - before_render (bbcode) 渲染前, 渲染结果来自缓存时不会触发
+
+    """
     def decorator(func):
+        global _REGISTRY_VERSION
         _HOOKS.setdefault(hookname, []).append(func)
+        if batch:
+            _BATCH_HOOKS.add(func)
+        _REGISTRY_VERSION = None
         return func
     return decorator
 
 def trigger_hook(hookname, *args, **kwargs):
     for func in _HOOKS.get(hookname, []):
-        func(*args, **kwargs)
+        if func in _BATCH_HOOKS:
+            func([args[0]], *args[1:], **kwargs)
+        else:
+            func(*args, **kwargs)
+
+def trigger_batch_hook(hookname, bbcodes, *args, **kwargs):
+    """对一批文档触发 hook, batch hook 只调用一次, 其它的逐个调用"""
+    if not bbcodes:
+        return
+    for func in _HOOKS.get(hookname, []):
+        if func in _BATCH_HOOKS:
+            func(bbcodes, *args, **kwargs)
+        else:
+            for bbcode in bbcodes:
+                func(bbcode, *args, **kwargs)
+
+class RenderContext(object):
+    """一个请求中渲染所有文档共用的, 由请求决定的输入
+
+    比如浏览器支持的公式图片格式, 只有一个参数不同的链接的模板等, 每个
+    请求只计算一次, 供所有节点和所有文档使用. 通过 render_context() 取得.
+
+    """
+
+    # 生成链接模板时代替参数的值
+    PLACEHOLDER = '__bbcode_placeholder__'
+
+    def __init__(self):
+        self.values = {}
+        self.url_templates = {}
+
+    def get(self, key, func):
+        """给出 func() 的结果, 同一个 key 每个请求只计算一次"""
+        try:
+            return self.values[key]
+        except KeyError:
+            value = self.values[key] = func()
+            return value
+
+    def url_for(self, endpoint, name, value):
+        """相当于 url_for(endpoint, **{name: value})
+
+        第一次调用时用占位的值生成模板, 之后只替换参数. 模板的结果会和第一
+        个真实的值用 url_for 生成的链接比较一次, 不一致 (比如参数的转义方式
+        不同) 时不再使用模板.
+
+        """
+        from flask import url_for
+        key = (endpoint, name)
+        template = self.url_templates.get(key)
+        if template is None:
+            parts = url_for(endpoint, **{name: self.PLACEHOLDER}).split(
+                self.PLACEHOLDER)
+            # [前缀, 后缀, 是否已经验证], 无法生成模板时为 False
+            template = parts + [False] if len(parts) == 2 else False
+            self.url_templates[key] = template
+        if template is False:
+            return url_for(endpoint, **{name: value})
+        url = template[0] + url_quote(value) + template[1]
+        if not template[2]:
+            if url == url_for(endpoint, **{name: value}):
+                template[2] = True
+            else:
+                self.url_templates[key] = False
+                return url_for(endpoint, **{name: value})
+        return url
+
+
+def render_context():
+    """给出当前请求的 RenderContext, 不在请求中时为 None"""
+    from flask import g, request
+    if not request:
+        return None
+    context = getattr(g, '_bbcode_render_context', None)
+    if context is None:
+        context = g._bbcode_render_context = RenderContext()
+    return context
 
 class BBCode(object):
+    """BBCode 文档
+
+    解析的开销可以通过以下参数限制, 以应对恶意的输入:
+        - max_nodes 节点 (包括纯文本片段) 的数量
+        - max_depth 标签嵌套的层数, 更深的标签按纯文本处理; 渲染等操作是
+          递归的, 不要超过 Python 的递归深度限制
+        - timeout 解析的耗时 (秒)
+
+    超出节点数量或耗时的限制时, 整篇文档作为纯文本, 并设置 degraded.
 
-    def __init__(self, source):
+    """
+
+    max_nodes = None
+    max_depth = MAXIMUM_DEPTH
+    timeout = None
+    degraded = False
+
+    def __init__(self, source, max_nodes=None, max_depth=None, timeout=None):
         # convert to unix
         source = smart_unicode(source)
         self.source = (source.replace('\r\n', '\n')
                              .replace('\r', '\n')
                              .replace('\u00a0', ' ')) # 不换行空格
         self.stack = []
+        self._markups = {}
+        # 没有找到的 markup: {markup: 查找的起始位置}, 见 edit
+        self._missing = {}
+        if max_nodes is not None:
+            self.max_nodes = max_nodes
+        if max_depth is not None:
+            self.max_depth = max_depth
+        if timeout is not None:
+            self.timeout = timeout
 
     def __call__(self, selector):
         return self.filter(selector)
 
     def filter(self, selector):
-        selectors = cssselect.parse(selector)
+        """按 CSS 选择器查找节点, 结果与 self.nodes._filter 相同
+
+        利用 node_index, 耗时只与 (各级) 匹配的节点数量有关, 而与整个文档的
+        大小无关.
+
+        """
         result = []
-        for sele in selectors:
-            result.extend(self.nodes._filter(sele.parsed_tree))
+        for tree in parse_selector(selector):
+            result.extend(node for _, node in self._select(tree))
         return result
 
-    @staticmethod
-    def len_lstrip(text):
-        length = len(text)
-        text = text.lstrip()
-        return length - len(text), text
-
-    def parse_left(self, source, NODES, REGEX_NODES):
-        offset = 1
-        add, part = self.len_lstrip(source[1:])
-        offset += add
-        # 这里从最长的 tagname 开始匹配, 避免互相干扰
-        for tagname, (t_length, node_class) in NODES.iteritems():
-            if part[:t_length].lower() == tagname:
-                break
+    def node_index(self):
+        """给出 {name: [(排序用的位置, 节点), ...]}
+
+        解析时建立; 从 AST 载入等没有索引的情况下遍历一次节点树. 索引中
+        可能有未通过校验而没有加入节点树的节点.
+
+        """
+        top = self.nodes
+        index = getattr(self, '_node_index', None)
+        if index is None:
+            index = {}
+            order = 0
+            stack = list(reversed(top.children))
+            while stack:
+                node = stack.pop()
+                index.setdefault(node.name, []).append((order, node))
+                order += 1
+                stack.extend(reversed(node.children))
+            self._node_index = index
+        return index
+
+    def _select(self, selector):
+        """按 _filter 的语义给出 [(位置, 节点), ...], 按文档顺序排列"""
+        top = self.nodes
+        index = self.node_index()
+        if isinstance(selector, Element):
+            # 只保留在节点树上, 且没有同名祖先的节点
+            name = selector.element
+            result = []
+            for item in index.get(name, ()):
+                parent = item[1]._parent
+                while parent is not None and parent is not top and \
+                      parent.name != name:
+                    parent = parent._parent
+                if parent is top:
+                    result.append(item)
+            result.sort(key=lambda item: item[0])
+            return result
+        elif isinstance(selector, CombinedSelector) and \
+             selector.combinator == ' ':
+            subselector = selector.subselector
+            if not isinstance(subselector, Element):
+                raise ValueError('Unsupported selector: %s' % repr(selector))
+            ancestors = self._select(selector.selector)
+            name = subselector.element
+            # 自身符合的祖先节点就是结果, 不再向下查找
+            result = [item for item in ancestors if item[1].name == name]
+            ancestors = set(id(node) for _, node in ancestors)
+            for item in index.get(name, ()):
+                parent = item[1]._parent
+                while parent is not None and id(parent) not in ancestors and \
+                      parent.name != name:
+                    parent = parent._parent
+                if parent is not None and id(parent) in ancestors and \
+                   parent.name != name:
+                    result.append(item)
+            result.sort(key=lambda item: item[0])
+            return result
         else:
+            raise ValueError('Unsupported selector: %s' % repr(selector))
+
+    def match_tagname(self, pos, NODES):
+        """在 source[pos] 处查找 NODES 中允许的 tagname, 大小写不敏感
+
+        沿前缀树逐字符匹配, 取最长的一个, 避免互相干扰. 找不到时返回 None.
+
+        """
+        source = self.source
+        length = len(source)
+        node = tag_trie()
+        matched = []
+        while pos < length:
+            node = node.get(source[pos].lower())
+            if node is None:
+                break
+            if None in node:
+                matched.append(node[None])
+            pos += 1
+        for tagname in reversed(matched):
+            if tagname in NODES:
+                return tagname
+        return None
+
+    def next_markup(self, markup, start):
+        """同 next_not_escaped_markup, 但会记住上一次查找的结果
+
+        查找的起点落在上一次的起点和结果之间时, 结果不变 (除非起点本身就是
+        markup), 这样连续的 ``[b=`` 之类不会反复扫描到 source 的结尾.
+
+        """
+        source = self.source
+        last = self._markups.get(markup)
+        if last is not None:
+            last_start, end = last
+            if last_start <= start and (end is None or start <= end):
+                if source.startswith(markup, start):
+                    end = start
+                self._markups[markup] = start, end
+                if end is None:
+                    raise BBCodeSyntaxError(start)
+                return end
+        try:
+            end = next_not_escaped_markup(source, markup, start)
+        except BBCodeSyntaxError:
+            self._markups[markup] = start, None
+            self._missing[markup] = min(start,
+                                        self._missing.get(markup, start))
+            raise
+        self._markups[markup] = start, end
+        return end
+
+    def parse_tag(self, start, NODES):
+        """解析从 source[start] (即 ``[``) 开始的开标签
+
+        :Returns
+            (开标签之后的位置, tagname, 节点类型, 值)
+
+        :Raises
+            BBCodeSyntaxError 其参数为出错后继续扫描的位置
+
+        """
+        source = self.source
+        pos = skip_spaces(source, start + 1)
+        tagname = self.match_tagname(pos, NODES)
+        if tagname is None:
             # markup Not found
-            raise BBCodeSyntaxError(offset)
-    
-        add, part = self.len_lstrip(part[t_length:])
-        offset += t_length + add
-        if part[:1] == ']':
+            raise BBCodeSyntaxError(pos)
+        t_length = len(tagname)
+        node_class = NODES[tagname][1]
+
+        pos = skip_spaces(source, pos + t_length)
+        markup = source[pos:pos + 1]
+        if markup == ']':
             value = None
-        elif part[:1] == '=':
-            add, part = self.len_lstrip(part[1:])
-            offset += 1 + add
-            if part[:1] == '"': # 允许双引号
-                part = part[1:]
-                offset += 1
-                try:
-                    value, end = next_not_escaped_markup(part, '"')
-                except BBCodeSyntaxError:
-                    raise BBCodeSyntaxError(offset)
-                add, part = self.len_lstrip(part[end + 1:])
-                offset += 1 + end + add
-                if part[:1] != ']':
-                    raise BBCodeSyntaxError(offset)
-                try:
-                    value = json.loads('"' + value + '"')
-                except ValueError:
-                    raise BBCodeSyntaxError(offset)
-            elif part[:1] == "'": # 允许单引号
-                part = part[1:]
-                offset += 1
-                try:
-                    value, end = next_not_escaped_markup(part, "'")
-                except BBCodeSyntaxError:
-                    raise BBCodeSyntaxError(offset)
-                add, part = self.len_lstrip(part[end + 1:])
-                offset += 1 + end + add
-                if part[:1] != ']':
-                    raise BBCodeSyntaxError(offset)
+        elif markup == '=':
+            pos = skip_spaces(source, pos + 1)
+            quote = source[pos:pos + 1]
+            if quote == '"' or quote == "'": # 允许双引号和单引号
+                pos += 1
+                end = self.next_markup(quote, pos)
+                value = source[pos:end]
+                pos = skip_spaces(source, end + 1)
+                if not source.startswith(']', pos):
+                    raise BBCodeSyntaxError(pos)
                 try:
                     value = json.loads('"' + value + '"')
                 except ValueError:
-                    raise BBCodeSyntaxError(offset)
+                    raise BBCodeSyntaxError(pos)
             else:
-                try:
-                    value, end = next_not_escaped_markup(part, ']')
-                except BBCodeSyntaxError:
-                    raise BBCodeSyntaxError(offset)
-                add, part = self.len_lstrip(part[end:])
-                offset += end + add
+                end = self.next_markup(']', pos)
+                value = source[pos:end]
+                pos = end
                 try:
                     value = json.loads('"' + value.replace('"', '\\"').replace('\n', '\\n').replace("'", "\\'").replace('\\', '\\\\') + '"')
                 except ValueError:
-                    raise BBCodeSyntaxError(offset)
+                    raise BBCodeSyntaxError(pos)
         else:
             # not a tag
-            raise BBCodeSyntaxError(offset)
-    
-        part = part[1:]
-        offset += 1
-        if len(self.stack) < MAXIMUM_DEPTH:
-            self.stack.append((tagname, t_length))
-        else:
-            raise BBCodeSyntaxError(offset)
-        add, nodelist = self.parse(part, node_class.NODES(NODES), node_class.NODES(REGEX_NODES))
-        offset += add
-        try:
-            return offset, node_class(value, nodelist)
-        except NodeError:
-            raise BBCodeSyntaxError(offset)
-    
-    def parse_right(self, source):
-        offset = 1
+            raise BBCodeSyntaxError(pos)
+        return pos + 1, tagname, node_class, value
+
+    def parse_right(self, start):
+        """解析从 source[start] 开始的闭标签, 返回结束位置"""
+        source = self.source
         if not self.stack:
-            raise BBCodeSyntaxError(offset)
-        add, part = self.len_lstrip(source[1:])
-        offset += add
-        if part[:1] != '/':
-            raise BBCodeSyntaxError(offset)
-        add, part = self.len_lstrip(part[1:])
-        offset += 1 + add
+            raise BBCodeSyntaxError(start + 1)
+        pos = skip_spaces(source, start + 1)
+        if not source.startswith('/', pos):
+            raise BBCodeSyntaxError(pos)
+        pos = skip_spaces(source, pos + 1)
         tagname, t_length = self.stack[-1]
-        if part[:t_length].lower() != tagname:
-            raise BBCodeSyntaxError(offset)
-        add, part = self.len_lstrip(part[t_length:])
-        offset += t_length + add
-        if part[:1] != ']':
-            raise BBCodeSyntaxError(offset)
+        if source[pos:pos + t_length].lower() != tagname:
+            raise BBCodeSyntaxError(pos)
+        pos = skip_spaces(source, pos + t_length)
+        if not source.startswith(']', pos):
+            raise BBCodeSyntaxError(pos)
 
         self.stack.pop()
-        offset += 1
-        return offset
-
-    def _append_plains(self, nodelist, plains, REGEX_NODES):
-        """根据 \n 切分 plains"""
-        while plains:
-            for name, nodecls in REGEX_NODES.itervalues():
-                # 尝试匹配正则表达式成为节点
-                m = nodecls.regex.search(plains)
-                if not m:
-                    continue
-                start, stop = m.span()
-                if start == stop:
-                    raise RuntimeError(
-                        'Potential infinite loop detected in '
-                        '%s, please check your regular expression.' % repr(nodecls))
-                before = plains[:start]
-                if before:
-                    self._append_plains(nodelist, before, REGEX_NODES)
-                nodelist.append(nodecls(m))
-                plains = plains[stop:]
-                break
-            else:
-                # 没有任何一次匹配上, 直接作为plain处理
-                plains = plains.split('\n')
-                nodelist.extend(map(lambda t: PlainNode(t + '\n'), plains[:-1]))
-                last = plains[-1]
-                if last:
-                    nodelist.append(PlainNode(last))
-                break
+        return pos + 1
+
+    def _append_plains(self, nodelist, start, end, REGEX_NODES):
+        """根据正则节点和 \\n 切分 source[start:end]"""
+        nodeclasses = tuple(nodecls for _, nodecls in REGEX_NODES.itervalues())
+        return self._append_matches(nodelist, start, end, nodeclasses)
+
+    def _append_matches(self, nodelist, start, end, nodeclasses):
+        """按权重从高到低依次尝试 nodeclasses 中的正则节点
+
+        权重最高的正则表达式用 finditer 扫描整段文本, 两次匹配之间的文本再交给
+        其余的正则表达式, 因此每段文本对每个正则表达式只扫描一次. 不在同一个
+        alternation 里一起匹配, 是为了保证高权重的节点不会被更靠前的低权重节点
+        截断 (比如 "@果壳网http://guokr.com").
+
+        """
+        source = self.source
+        if not nodeclasses:
+            # 没有任何一次匹配上, 直接作为plain处理
+            pos = source.find('\n', start, end)
+            while pos > -1:
+                nodelist.append(PlainNode(source[start:pos + 1], start=start))
+                start = pos + 1
+                pos = source.find('\n', start, end)
+            if start < end:
+                nodelist.append(PlainNode(source[start:end], start=start))
+            return nodelist
+
+        nodecls, rest = nodeclasses[0], nodeclasses[1:]
+        for m in nodecls.regex.finditer(source, start, end):
+            m_start, m_stop = m.span()
+            if m_start == m_stop:
+                raise RuntimeError(
+                    'Potential infinite loop detected in '
+                    '%s, please check your regular expression.' % repr(nodecls))
+            self._append_matches(nodelist, start, m_start, rest)
+            nodelist.append(nodecls(m))
+            start = m_stop
+        return self._append_matches(nodelist, start, end, rest)
+
+    def parse_bounded(self, max_nodes=None, max_depth=MAXIMUM_DEPTH,
+                      timeout=None, blocks=False):
+        """用显式的栈解析整个 source
+
+        每一层标签对应栈上的一项, 不消耗 Python 的调用栈. 节点数量和耗时
+        超出限制时抛出 BBCodeBudgetExceeded.
+
+        同时按节点的 name 建立索引, 供 filter 使用, 见 node_index. blocks
+        为 True 时还记录顶层的分块, 供 edit 使用.
+
+        :Returns
+            节点列表
+
+        """
+        nodelist, self._blocks, _ = self._parse_blocks(
+            0, max_nodes, max_depth, timeout, blocks)
         return nodelist
 
-    def parse(self, source, NODES, REGEX_NODES):
-        offset = 0
-        remains = ''
-        nodelist = []
-        while source:
-            pos = source.find('[')
-            pos = pos if pos > -1 else (len(source) + 1)
-            remains += source[:pos]
-            source = source[pos:]
-            offset += pos
+    def _parse_blocks(self, start, max_nodes, max_depth, timeout, blocks=True,
+                      resync=None):
+        """parse_bounded 的实现, 从 start 处的分块位置开始解析
+
+        顶层的分块位置是 display 为 block 的节点之后, 以及顶层纯文本中的
+        换行之后 (扫描没有越过换行, 即不在失败的标签之内). 之前的解析只读取
+        了分块位置之前的 source, 之后的解析也与之前无关, 因此可以从任意一个
+        分块位置开始重新解析. 这要求正则节点不跨行, 反向预查不超过一个字符.
+
+        resync(pos) 不为 None 时, 在分块位置 pos 结束解析, 之后沿用旧的结果.
+
+        :Returns
+            (节点列表, [(分块位置, 之前的顶层节点数量), ...], resync 的结果),
+            blocks 为 False 时不记录分块, 第二项为 None
+
+        """
+        source = self.source
+        length = len(source)
+        deadline = timeout and time.time() + timeout
+        count = 0 # 已创建的节点数量
+        self._node_index = index = {}
+        # 每一层为 [节点类型, 值, 开标签的位置, NODES, REGEX_NODES,
+        #           节点列表, 尚未处理的纯文本的起始位置]
+        top = [TopNode, None, start, _NODES, _REGEX_NODES, [], start]
+        frames = [top]
+        # 换行之后的分块在切分纯文本时才知道之前的节点数量, 暂时记为 None
+        blocks = [(start, 0)] if blocks else None
+        stop = length
+        synced = None
+        pos = start
+        loops = 0
+        while synced is None:
+            loops += 1
+            if deadline and not loops & 0xff and time.time() > deadline:
+                raise BBCodeBudgetExceeded('timeout')
+            found = source.find('[', pos)
+            frame = frames[-1]
+            if frame is top and blocks is not None:
+                line = source.find('\n', pos, length if found < 0 else found)
+                while line >= 0 and line + 1 < length:
+                    line += 1
+                    if resync is not None:
+                        synced = resync(line)
+                        if synced is not None:
+                            stop = line
+                            break
+                    blocks.append((line, None))
+                    line = source.find('\n', line,
+                                       length if found < 0 else found)
+                if synced is not None:
+                    break
+            pos = found
+            if pos < 0:
+                break
             try:
-                if source[1:].lstrip()[:1] == '/':
-                    add = self.parse_right(source)
-                    if remains:
-                        self._append_plains(nodelist, remains, REGEX_NODES)
-                        remains = ''
-                    # end of the nodelist, jump out
-                    offset += add
-                    return offset, nodelist
+                if source.startswith('/', skip_spaces(source, pos + 1)):
+                    end = self.parse_right(pos)
+                    count += self._flush(frame, pos, index)
+                    frames.pop()
+                    size = len(top[5])
+                    count += self._close_frame(frame, frames[-1], end, index)
+                    if blocks is not None and len(top[5]) > size and \
+                       top[5][-1].display == 'block' and end < length:
+                        if resync is not None:
+                            synced = resync(end)
+                            if synced is not None:
+                                stop = end
+                        if synced is None:
+                            blocks.append((end, len(top[5])))
                 else:
-                    # has nested parse in parse_left
-                    add, node = self.parse_left(source, NODES, REGEX_NODES)
-                    if remains:
-                        self._append_plains(nodelist, remains, REGEX_NODES)
-                        remains = ''
-                    nodelist.append(node)
+                    end, tagname, node_class, value = \
+                        self.parse_tag(pos, frame[3])
+                    if len(self.stack) >= max_depth:
+                        raise BBCodeSyntaxError(end)
+                    self.stack.append((tagname, len(tagname)))
+                    frames.append([node_class, value, pos,
+                                   allowed_nodes(node_class, frame[3]),
+                                   allowed_nodes(node_class, frame[4]),
+                                   [], end])
+                    count += 1
             except BBCodeSyntaxError, ex:
-                add = ex.args[0]
-                remains += source[:add]
-            source = source[add:]
-            offset += add
-        if remains:
-            self._append_plains(nodelist, remains, REGEX_NODES)
-        return offset, nodelist
+                end = ex.args[0]
+            if max_nodes is not None and count > max_nodes:
+                raise BBCodeBudgetExceeded('nodes')
+            pos = end
+
+        # 到达结尾 (或者 resync), 未闭合的标签自动闭合
+        frame = frames[-1]
+        while True:
+            count += self._flush(frame, stop, index)
+            if max_nodes is not None and count > max_nodes:
+                raise BBCodeBudgetExceeded('nodes')
+            if len(frames) == 1:
+                break
+            frames.pop()
+            count += self._close_frame(frame, frames[-1], stop, index)
+            frame = frames[-1]
+
+        # 换行之后的分块: 找到以这个换行结尾的纯文本
+        nodelist = top[5]
+        i = 0
+        for j, (pos, size) in enumerate(blocks or ()):
+            if size is None:
+                while True:
+                    node = nodelist[i]
+                    i += 1
+                    if node.__class__ is PlainNode and \
+                       node.start + len(node.value) == pos:
+                        break
+                blocks[j] = pos, i
+            else:
+                i = size
+        return nodelist, blocks, synced
+
+    def _flush(self, frame, end, index):
+        """把 frame 中尚未处理的纯文本 (到 end 为止) 切分为节点, 返回新节点
+        的数量"""
+        nodelist = frame[5]
+        size = len(nodelist)
+        self._append_plains(nodelist, frame[6], end, frame[4])
+        for i in xrange(size, len(nodelist)):
+            node = nodelist[i]
+            if isinstance(node, PlainNode):
+                start = node.start
+            else:
+                start = node.value.start()
+            _index_node(index, start, node)
+        return len(nodelist) - size
+
+    def _close_frame(self, frame, parent, end, index):
+        """创建 frame 对应的节点并加入上一层, 失败时整个标签按纯文本处理
+
+        返回新节点的数量. 失败的标签中已经加入索引的节点会留在索引中,
+        它们不在文档的节点树上, 查询时会被排除.
+
+        """
+        node_class, value, start, _, _, nodelist, _ = frame
+        try:
+            node = node_class(value, nodelist)
+        except NodeError:
+            # 上一层的 remains 不变, 这段 source 稍后作为纯文本
+            return 0
+        count = self._flush(parent, start, index)
+        parent[5].append(node)
+        parent[6] = end
+        _index_node(index, start, node, nodelist)
+        return count + 1
 
     def text(self):
         return self.nodes.text()
 
+    def plain_text(self, max_chars=None):
+        """同 iter_text, 一次给出全部纯文本"""
+        return ''.join(self.iter_text(max_chars))
+
+    def iter_text(self, max_chars=None):
+        """不创建节点, 直接从 source 中逐段给出纯文本, 适合建索引和摘要
+
+        标签的划分与解析时相同, 但不会调用节点的构造函数 (视频地址的解析,
+        ref 的校验等) 和 after_parse 的 hook. 因此未通过校验的标签在 text()
+        中是原文, 在这里是其内容的文本. 同样受 max_nodes 和 timeout 的限制,
+        超出时余下的 source 原样作为纯文本.
+
+        :Parameters
+            - max_chars 最多给出的字符数, 达到后不再继续扫描
+
+        """
+        if max_chars is None:
+            for text, _, _ in self._text_spans():
+                yield text
+            return
+        left = max_chars
+        if left <= 0:
+            return
+        for text, _, _ in self._text_spans():
+            if len(text) >= left:
+                yield text[:left]
+                return
+            left -= len(text)
+            yield text
+
+    def _text_spans(self):
+        """逐段给出 (纯文本, 在 source 中的起始位置, 结束位置)
+
+        不是取自 source 的文本 (比如没有内容的 URL 给出的地址), 起止位置
+        都是所在标签的结束位置.
+
+        标签和给出的文本片段的数量超过 max_nodes, 或者耗时超过 timeout 时,
+        余下的 source 作为一段给出, 并设置 _text_degraded.
+
+        """
+        source = self.source
+        max_nodes = self.max_nodes
+        deadline = self.timeout and time.time() + self.timeout
+        count = loops = 0
+        self._text_degraded = False
+        self.stack = []
+        # 每一层为 [节点类型, 值, NODES, 是否给出文本, 是否没有内容]
+        frames = [[TopNode, None, _NODES, True, True]]
+        pos = remains = 0 # remains 为尚未给出的纯文本的起始位置
+        while True:
+            loops += 1
+            if max_nodes is not None and count > max_nodes or \
+               deadline and not loops & 0xff and time.time() > deadline:
+                # 超出限制, 余下的部分不再区分标签
+                self._text_degraded = True
+                self.stack = []
+                if remains < len(source):
+                    yield source[remains:], remains, len(source)
+                return
+            pos = source.find('[', pos)
+            frame = frames[-1]
+            if pos < 0:
+                break
+            try:
+                if source.startswith('/', skip_spaces(source, pos + 1)):
+                    end = self.parse_right(pos)
+                    frames.pop()
+                    if remains < pos:
+                        if frame[3]:
+                            count += 1
+                            yield source[remains:pos], remains, pos
+                    elif frame[4] and frame[3]:
+                        text = frame[0].empty_text(frame[1])
+                        if text:
+                            count += 1
+                            yield text, end, end
+                else:
+                    end, tagname, node_class, value = \
+                        self.parse_tag(pos, frame[2])
+                    if len(self.stack) >= self.max_depth:
+                        raise BBCodeSyntaxError(end)
+                    self.stack.append((tagname, len(tagname)))
+                    count += 1
+                    if remains < pos and frame[3]:
+                        count += 1
+                        yield source[remains:pos], remains, pos
+                    frame[4] = False
+                    frames.append([node_class, value,
+                                   allowed_nodes(node_class, frame[2]),
+                                   frame[3] and node_class.has_text, True])
+                remains = end
+            except BBCodeSyntaxError, ex:
+                end = ex.args[0]
+            pos = end
+
+        # 到达结尾, 未闭合的标签自动闭合
+        length = len(source)
+        if frame[3]:
+            if remains < length:
+                yield source[remains:], remains, length
+            elif frame[4] and len(frames) > 1:
+                text = frame[0].empty_text(frame[1])
+                if text:
+                    yield text, length, length
+        self.stack = []
+
+    def excerpt(self, n, **kwargs):
+        """给出前 n 个可见字符的 HTML, 用于列表页的摘要
+
+        只扫描到第 n 个可见字符, 之后的 source 直接丢弃, 未闭合的标签像
+        解析时一样自动闭合. 不会从链接, @ 等正则节点的中间截断, 而是
+        截断在它们之前. 扫描超出 max_nodes 或 timeout 的限制时, 摘要是
+        转义后的纯文本. 参数同 html.
+
+        :Returns
+            (HTML, 是否截断)
+
+        """
+        left = n
+        cut = 0
+        for text, start, stop in self._text_spans():
+            if left <= 0:
+                break
+            if len(text) > left and start < stop:
+                cut = self._excerpt_cut(start + left, start, stop)
+                break
+            left -= len(text)
+            cut = stop
+        else:
+            return self.html(**kwargs), False
+        excerpt = type(self)(self.source[:cut], max_nodes=self.max_nodes,
+                             max_depth=self.max_depth, timeout=self.timeout)
+        if self._text_degraded:
+            excerpt._degrade()
+            return excerpt.nodes.html(**kwargs), True
+        return excerpt.html(**kwargs), True
+
+    def _excerpt_cut(self, pos, start, stop, window=256):
+        """把截断的位置移到跨过它的正则节点之前"""
+        source = self.source
+        low, high = max(start, pos - window), min(stop, pos + window)
+        for _, node_class in _REGEX_NODES.itervalues():
+            for m in node_class.regex.finditer(source, low, high):
+                if m.start() >= pos:
+                    break
+                if m.end() > pos:
+                    pos = m.start()
+                    break
+        return pos
+
     def html(self, **kwargs):
-        return self.nodes.html(**kwargs)
+        """给出 HTML, 结果会被缓存, 见 cache.RenderCache"""
+        from .cache import render_cache
+        return render_cache.html(self, **kwargs)
+
+    def iter_html(self, **kwargs):
+        """逐段给出 HTML, 适合较长的文档直接流式输出
+
+        缓存中有结果时直接给出, 否则边渲染边给出, 不会写入缓存.
+
+        """
+        from .cache import render_cache
+        html = render_cache.get(render_cache.key(self, **kwargs))
+        if html is not None:
+            return iter([html])
+        self.prepare_many([self])
+        return self.nodes.iter_html(**kwargs)
+
+    def block_html(self, **kwargs):
+        """按顶层的分块给出 HTML 的列表, 连接起来就是整篇的 HTML
+
+        供编辑器的预览使用, 之后的修改通过 edit 只更新改动的块. 不经过缓存.
+
+        """
+        self._block_nodes()
+        self.prepare_many([self])
+        blocks = getattr(self, '_blocks', None) or [(0, 0)]
+        return self._render_blocks(0, len(blocks), **kwargs)
+
+    def _block_nodes(self):
+        """同 nodes, 但没有解析过时同时记录分块"""
+        if not hasattr(self, '_top_node'):
+            self._parse(blocks=True)
+            trigger_hook('after_parse', self)
+        return self._top_node
+
+    def _render_blocks(self, start, stop, **kwargs):
+        """给出第 start 到 stop 块 (不含 stop) 的 HTML 的列表"""
+        blocks = getattr(self, '_blocks', None) or [(0, 0)]
+        children = self._top_node.children
+        bounds = [size for _, size in blocks[start:stop + 1]]
+        if stop >= len(blocks):
+            bounds.append(len(children))
+        fragments = []
+        for i in xrange(len(bounds) - 1):
+            fragments.append(''.join(
+                fragment for node in children[bounds[i]:bounds[i + 1]]
+                for fragment in node.iter_html(**kwargs)))
+        return fragments
+
+    def edit(self, offset, length, text, **kwargs):
+        """把 source[offset:offset + length] 替换为 text, 只重新解析和渲染改动
+        所在的顶层分块, 供编辑器的预览使用
+
+        offset 和 length 是相对于 self.source (换行已经统一为 \\n) 的. 文档
+        就地更新: 从改动之前的分块位置开始重新解析, 直到与原来的分块位置重新
+        对齐, 之后的节点和分块都沿用, 因此耗时取决于改动涉及的分块, 与文档的
+        长度基本无关. hook 只对新的节点触发. 之前有 ``[b="`` 之类找不到结束
+        位置的标签, 而 text 补上了时, 从这个标签之前开始重新解析. 没有分块
+        (不是由 block_html 或 edit 解析的, 超出解析限制, 从 AST 载入) 或者
+        重新解析的部分超出限制时, 重新解析整篇.
+
+        :Returns
+            (start, stop, fragments) 原来的第 start 到 stop 块 (不含 stop)
+            替换为 fragments 中各块的 HTML. 紧接着的一块也会重新渲染, 因为
+            纯文本的换行是否输出 <br /> 取决于前一个节点.
+
+        """
+        top = self._block_nodes()
+        source = self.source
+        if not 0 <= offset <= offset + length <= len(source):
+            raise ValueError('Invalid edit: %r, %r' % (offset, length))
+        text = (smart_unicode(text).replace('\r\n', '\n')
+                                   .replace('\r', '\n')
+                                   .replace('\u00a0', ' '))
+        old_blocks = getattr(self, '_blocks', None)
+        self.source = source[:offset] + text + source[offset + length:]
+        self.stack = []
+        self._markups = {}
+        missing, self._missing = self._missing, {}
+        if old_blocks is None:
+            return self._edit_all(1, **kwargs)
+
+        # 找不到的 markup 可能因为 text 而出现 (或者不再被转义)
+        limit = offset
+        follow = source[offset + length:offset + length + 1]
+        for markup, pos in missing.iteritems():
+            if markup in text or markup == follow:
+                limit = min(limit, pos)
+        first = bisect.bisect_left(old_blocks, (limit + 1, )) - 1
+        if first and old_blocks[first][0] == len(self.source):
+            # 删除了结尾的内容, 分块位置不会在 source 的结尾
+            first -= 1
+        start, before = old_blocks[first]
+        delta = len(text) - length
+        edited = offset + len(text)
+
+        def resync(pos):
+            # 改动之后, 与原来的分块位置对齐的分块位置, 给出原来的块
+            if pos > edited:
+                i = bisect.bisect_left(old_blocks, (pos - delta, ), first)
+                if i < len(old_blocks) and old_blocks[i][0] == pos - delta:
+                    return i
+            return None
+
+        try:
+            nodelist, blocks, synced = self._parse_blocks(
+                start, self.max_nodes, self.max_depth, self.timeout,
+                resync=resync)
+        except BBCodeBudgetExceeded:
+            return self._edit_all(len(old_blocks), **kwargs)
+        finally:
+            self.stack = []
+
+        children = top.children
+        if synced is None:
+            stop, after = len(old_blocks), len(children)
+        else:
+            stop, after = synced, old_blocks[synced][1]
+        children[before:after] = nodelist
+        shift = len(nodelist) - (after - before)
+        # 节点数量不变时, 之后的节点在兄弟中的位置也不变
+        end = len(children) if shift else before + len(nodelist)
+        for i in xrange(before, end):
+            node = children[i]
+            node._parent = top
+            node._index = i
+
+        self._blocks = old_blocks[:first]
+        self._blocks.extend([(pos, size + before) for pos, size in blocks])
+        if delta or shift:
+            self._blocks.extend([(pos + delta, size + shift)
+                                 for pos, size in old_blocks[stop:]])
+        else:
+            self._blocks.extend(old_blocks[stop:])
+        suffix = old_blocks[stop][0] if stop < len(old_blocks) else None
+        for markup, pos in missing.iteritems():
+            if pos < start:
+                pass
+            elif suffix is not None and pos >= suffix:
+                pos += delta
+            else:
+                continue
+            self._missing[markup] = min(pos, self._missing.get(markup, pos))
+        # 沿用的节点记录的位置已经改变, 见 to_ast
+        self._edited = True
+
+        # 只对新的节点触发 hook: 索引中只有它们
+        window = copy.copy(self)
+        self._node_index = None
+        trigger_hook('after_parse', window)
+        trigger_hook('before_render', window)
+        return first, min(stop + 1, len(old_blocks)), self._render_blocks(
+            first, min(first + len(blocks) + 1, len(self._blocks)), **kwargs)
+
+    def _edit_all(self, count, **kwargs):
+        """重新解析整篇, 原来的 count 块都替换掉"""
+        del self._top_node
+        self.degraded = False
+        self._edited = False
+        return 0, count, self.block_html(**kwargs)
+
+    @classmethod
+    def render_many(cls, sources, **kwargs):
+        """批量渲染, 比如一个页面上的所有回复, 按顺序给出 HTML 的列表
+
+        整批文档的 hook 一起触发, 公式, 图片等的查询合并为一次.
+
+        """
+        from .cache import render_cache
+        return render_cache.html_many([cls(source) for source in sources],
+                                      **kwargs)
+
+    @staticmethod
+    def prepare_many(bbcodes):
+        """在渲染之前解析一批文档, 并对整批文档触发 after_parse 和
+        before_render"""
+        parsed = [bbcode for bbcode in bbcodes
+                  if not hasattr(bbcode, '_top_node')]
+        for bbcode in parsed:
+            bbcode._parse()
+        trigger_batch_hook('after_parse', parsed)
+        trigger_batch_hook('before_render', bbcodes)
 
     def bbcode(self):
         return unicode(self.nodes)
 
+    def to_ast(self):
+        """把解析后的节点树序列化为紧凑的 JSON, 以便和 source 一起保存
+
+        格式为 ``[AST_VERSION, source 的 crc32, 节点类型列表, 字符串列表,
+        节点数组]``. 节点数组是按先序排列的整数:
+
+        * 取自 source 的纯文本占两项: ``-(与上一个片段之间的间隔) - 1`` 和
+          长度, 这里的片段是指纯文本和正则节点在 source 中的范围
+        * 正则节点占三项: 类型的下标, 与上一个片段之间的间隔和长度
+        * 标签节点占三项: 类型的下标, 值在字符串列表中的下标和其所有后代
+          节点所占的项数
+        * 不是取自 source 的纯文本 (比如 URLNode 补上的) 占两项: 类型的
+          下标和文本在字符串列表中的下标
+
+        """
+        if getattr(self, '_edited', False):
+            # edit 沿用的节点记录的还是修改前的位置, 序列化重新解析的结果
+            bbcode = type(self)(self.source, self.max_nodes, self.max_depth,
+                                self.timeout)
+            bbcode._parse()
+            return bbcode.to_ast()
+        typenames = []
+        types = {}
+        strings = []
+        interned = {}
+        flat = []
+        cursor = 0
+        stack = [(node, None) for node in reversed(self.nodes.children)]
+        while stack:
+            node, pos = stack.pop()
+            if pos is not None:
+                # 子节点都已经写入, 回填后代节点所占的项数
+                flat[pos + 2] = len(flat) - pos - 3
+                continue
+            if isinstance(node, PlainNode) and node.start is not None:
+                flat.extend((cursor - node.start - 1, len(node.value)))
+                cursor = node.start + len(node.value)
+                continue
+            name = node.name
+            if name not in types:
+                types[name] = len(typenames)
+                typenames.append(name)
+            if isinstance(node, RegexNode):
+                start, end = node.value.span()
+                flat.extend((types[name], start - cursor, end - start))
+                cursor = end
+                continue
+            value = node.value
+            if value not in interned:
+                interned[value] = len(strings)
+                strings.append(value)
+            if isinstance(node, PlainNode):
+                flat.extend((types[name], interned[value]))
+            else:
+                stack.append((node, len(flat)))
+                flat.extend((types[name], interned[value], 0))
+                stack.extend((child, None) for child in reversed(node.children))
+        return _json.dumps([AST_VERSION, self.checksum(), typenames, strings,
+                            flat], separators=(',', ':'))
+
+    def checksum(self):
+        return zlib.crc32(self.source.encode('U8')) & 0xffffffff
+
+    @classmethod
+    def from_ast(cls, source, ast):
+        """从 to_ast 的结果恢复, 省去解析 source 的开销
+
+        :Raises
+            ValueError 版本不符, source 被修改过或者含有未注册的节点类型,
+                       此时应当重新解析 source
+
+        """
+        bbcode = cls(source)
+        try:
+            version, checksum, typenames, strings, flat = json.loads(ast)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid BBCode AST')
+        if version != AST_VERSION:
+            raise ValueError('Unsupported BBCode AST version: %r' % version)
+        if checksum != bbcode.checksum():
+            raise ValueError('BBCode AST does not match the source')
+        types = []
+        for name in typenames:
+            if name == PlainNode.name:
+                types.append((PlainNode, 'plain'))
+            elif name in _NODES:
+                types.append((_NODES[name][1], 'tag'))
+            elif name in _REGEX_NODES:
+                types.append((_REGEX_NODES[name][1], 'regex'))
+            else:
+                raise ValueError('Unknown BBCode node: %s' % name)
+
+        # 顺便建立 node_index, 省去 filter 再遍历一次节点树
+        bbcode._node_index = {}
+        try:
+            nodelist, _ = bbcode._load_ast(types, strings, flat, 0,
+                                           len(flat), 0, itertools.count())
+        except (IndexError, TypeError, NodeError):
+            raise ValueError('Invalid BBCode AST')
+        bbcode._top_node = TopNode(None, nodelist)
+        trigger_hook('after_parse', bbcode)
+        return bbcode
+
+    def _load_ast(self, types, strings, flat, start, stop, cursor, order):
+        """给出 (节点列表, 最后一个片段的结束位置), order 为先序的计数"""
+        source = self.source
+        index = self._node_index
+        plains = index.setdefault(PlainNode.name, [])
+        nodelist = []
+        append = nodelist.append
+        while start < stop:
+            head = flat[start]
+            if head < 0:
+                offset = cursor - head - 1
+                cursor = offset + flat[start + 1]
+                node = PlainNode(source[offset:cursor], start=offset)
+                plains.append((next(order), node))
+                append(node)
+                start += 2
+                continue
+            node_class, kind = types[head]
+            position = next(order)
+            if kind == 'plain':
+                node = PlainNode(strings[flat[start + 1]])
+                start += 2
+            elif kind == 'tag':
+                end = start + 3 + flat[start + 2]
+                children, cursor = self._load_ast(types, strings, flat,
+                                                  start + 3, end, cursor, order)
+                node = node_class(strings[flat[start + 1]], children)
+                start = end
+            else:
+                # 在原来的位置重新匹配, 得到和解析时一样的 re.Match
+                offset = cursor + flat[start + 1]
+                cursor = offset + flat[start + 2]
+                m = node_class.regex.match(source, offset, cursor)
+                if not m or m.end() != cursor:
+                    raise ValueError('Invalid BBCode AST')
+                node = node_class(m)
+                start += 3
+            index.setdefault(node.name, []).append((position, node))
+            append(node)
+        return nodelist, cursor
+
+    def _parse(self, blocks=False):
+        try:
+            nodelist = self.parse_bounded(self.max_nodes, self.max_depth,
+                                          self.timeout, blocks)
+        except BBCodeBudgetExceeded:
+            self._degrade()
+        else:
+            self._top_node = TopNode(None, nodelist)
+        self.stack = [] # empty stack whatever
+
+    def _degrade(self):
+        """超出限制, 整篇作为转义后的纯文本"""
+        nodelist = self._append_matches([], 0, len(self.source), ())
+        self._top_node = TopNode(None, nodelist)
+        self.degraded = True
+        self._node_index = None
+        self._blocks = None
+
     @property
     def nodes(self):
         if not hasattr(self, '_top_node'):
-            _, nodelist = self.parse(self.source, _NODES, _REGEX_NODES)
-            self._top_node = TopNode(None, nodelist)
-            self.stack = [] # empty stack whatever
+            self._parse()
             trigger_hook('after_parse', self)
         return self._top_node
 
     def __html__(self):
-        return self.nodes.html()
+        return self.html()
 
     def __unicode__(self):
         return unicode(self.nodes)
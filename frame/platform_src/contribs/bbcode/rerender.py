@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""批量重新渲染数据库中保存的 BBCode
+
+修改了标签的 HTML (比如 ImageNode, VideoNode, MathMode) 之后, 用来重新生成
+已经保存的 HTML::
+
+    python -m frame.platform.contribs.bbcode.rerender \\
+        --app myapp:app --table post --source content --html content_html \\
+        --checkpoint /tmp/post.checkpoint
+
+主进程按主键顺序分块读取 (WHERE pk > 上一块的最后一个主键 ORDER BY pk
+LIMIT n), 解析和渲染交给进程池, 结果按块批量 UPDATE. 每写完一块记录一次
+检查点, 中断后用同一个检查点文件重新运行即从断点继续.
+
+进程池中视频只使用缓存中的地址 (video.CACHE_ONLY), 缓存没有的视频不访问
+网络, 所在的文档默认不更新, 主键记在 pending 中, 可以之后在线上环境重新
+渲染.
+
+"""
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import traceback
+import multiprocessing
+from collections import deque
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import table, column, select, text, bindparam
+
+__all__ = ['Rerenderer', 'render_chunk']
+
+RENDERED = 'rendered'
+PENDING = 'pending'
+FAILED = 'failed'
+
+# 工作进程中进入的请求上下文, 保持引用以免被回收
+_contexts = []
+
+def load_app(app):
+    """app 为 app 对象, 'module:name' 形式的导入路径, 或者创建 app 的函数
+    的导入路径"""
+    if isinstance(app, basestring):
+        from flask import Flask
+        from werkzeug.utils import import_string
+        app = import_string(app)
+        if not isinstance(app, Flask):
+            app = app()
+    return app
+
+def init_worker(app=None, base_url=None):
+    """工作进程的初始化: 视频只用缓存, 并进入 app 的请求上下文"""
+    from . import video
+    video.CACHE_ONLY = True
+    if app is not None:
+        ctx = load_app(app).test_request_context(base_url=base_url)
+        ctx.push()
+        _contexts.append(ctx)
+
+def _prepare(rows):
+    """解析一批文档并触发 hook, 整批出错时逐篇处理, 只让出错的文档失败
+
+    :Returns
+        BBCode 的列表, 出错的文档为出错信息
+
+    """
+    from .core import BBCode
+    bbcodes = [BBCode(source or '') for _, source in rows]
+    try:
+        BBCode.prepare_many(bbcodes)
+        return bbcodes
+    except Exception:
+        pass
+    result = []
+    for _, source in rows:
+        bbcode = BBCode(source or '')
+        try:
+            BBCode.prepare_many([bbcode])
+        except Exception:
+            bbcode = traceback.format_exc()
+        result.append(bbcode)
+    return result
+
+def render_chunk(rows, render_kwargs=None, write_pending=False):
+    """在工作进程中渲染一块文档
+
+    :Parameters
+        - `rows`: [(主键, BBCode 源码), ...]
+        - `render_kwargs`: 传给 html() 的参数
+        - `write_pending`: 有视频等待解析的文档是否也给出 HTML
+
+    :Returns
+        [(主键, 状态, HTML 或出错信息), ...], 状态为 RENDERED, PENDING 或
+        FAILED
+
+    """
+    render_kwargs = render_kwargs or {}
+    result = []
+    for (pk, _), bbcode in zip(rows, _prepare(rows)):
+        if isinstance(bbcode, basestring):
+            result.append((pk, FAILED, bbcode))
+            continue
+        try:
+            if not write_pending and any(
+               node.pending for node in bbcode.filter('video')):
+                result.append((pk, PENDING, None))
+                continue
+            # 不经过 render_cache, 以免旧的结果或者整个表的内容进入缓存
+            result.append((pk, RENDERED, bbcode.nodes.html(**render_kwargs)))
+        except Exception:
+            result.append((pk, FAILED, traceback.format_exc()))
+    return result
+
+
+class Rerenderer(object):
+    """把 tablename 表中 source 列的 BBCode 重新渲染, 写入 html 列
+
+    :Parameters
+        - `engine`: SQLAlchemy 的 engine
+        - `chunk_size`: 每块的行数, 也是每次 UPDATE 的行数
+        - `processes`: 工作进程数, 默认为 CPU 数; 为 0 时在当前进程中渲染
+        - `app`: 工作进程中使用的 app, 见 load_app
+        - `base_url`: 工作进程中请求上下文的地址, 影响生成的链接
+        - `where`: 只处理符合条件的行, SQL 表达式的字符串
+        - `checkpoint`: 检查点文件的路径, 文件存在时从中记录的位置继续;
+          检查点同时记录 pending 和 failures 的主键
+        - `report`: 接收进度信息的函数, 默认写到 stderr
+        - `report_interval`: 报告进度的间隔 (秒)
+
+    """
+
+    def __init__(self, engine, tablename, source='content', html='html',
+                 pk='id', chunk_size=500, processes=None, app=None,
+                 base_url=None, render_kwargs=None, write_pending=False,
+                 where=None, checkpoint=None, report=None,
+                 report_interval=10):
+        self.engine = engine
+        self.tablename = tablename
+        self.table = table(tablename, column(pk), column(source), column(html))
+        self.pk = self.table.c[pk]
+        self.source = self.table.c[source]
+        self.html = self.table.c[html]
+        self.chunk_size = chunk_size
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.app = app
+        self.base_url = base_url
+        self.render_kwargs = render_kwargs or {}
+        self.write_pending = write_pending
+        self.where = where
+        self.checkpoint = checkpoint
+        self.report = report or (lambda message: sys.stderr.write(message + '\n'))
+        self.report_interval = report_interval
+
+        self.last = None
+        self.counts = {RENDERED: 0, PENDING: 0, FAILED: 0}
+        self.pending = []
+        self.failures = []
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as fp:
+            state = json.load(fp)
+        if state['table'] != self.tablename:
+            raise ValueError('Checkpoint %s belongs to table %s' % (
+                self.checkpoint, state['table']))
+        self.last = state['last']
+        self.counts.update(state['counts'])
+        # 之前中断的运行中等待视频和出错的文档
+        self.pending = state.get('pending', [])
+        self.failures = [tuple(failure)
+                         for failure in state.get('failures', [])]
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        state = {'table': self.tablename, 'last': self.last,
+                 'counts': self.counts, 'pending': self.pending,
+                 'failures': self.failures}
+        # 先写临时文件再改名, 中断时不会留下不完整的检查点
+        tmpname = self.checkpoint + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(state, fp)
+        os.rename(tmpname, self.checkpoint)
+
+    def iter_chunks(self, limit=None):
+        """从检查点之后按主键顺序分块读取 [(主键, 源码), ...]"""
+        last = self.last
+        remains = limit
+        while remains is None or remains > 0:
+            size = self.chunk_size
+            if remains is not None:
+                size = min(size, remains)
+            query = select([self.pk, self.source]).order_by(self.pk).limit(size)
+            if last is not None:
+                query = query.where(self.pk > last)
+            if self.where:
+                query = query.where(text(self.where))
+            rows = self.engine.execute(query).fetchall()
+            if not rows:
+                return
+            rows = [(row[0], row[1]) for row in rows]
+            yield rows
+            last = rows[-1][0]
+            if remains is not None:
+                remains -= len(rows)
+
+    def update(self, rows):
+        """在一个事务中把 [(主键, HTML), ...] 写回"""
+        if not rows:
+            return
+        with self.engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                # 一条 UPDATE ... FROM (VALUES ...) 代替逐行执行
+                quote = conn.dialect.identifier_preparer.quote_identifier
+                params = {}
+                values = []
+                for i, (pk, html) in enumerate(rows):
+                    params['pk%d' % i] = pk
+                    params['html%d' % i] = html
+                    values.append('(:pk%d, :html%d)' % (i, i))
+                conn.execute(text(
+                    'UPDATE %s AS t SET %s = v.html FROM (VALUES %s) '
+                    'AS v (pk, html) WHERE t.%s = v.pk' % (
+                        '.'.join(quote(name) for name in
+                                 self.tablename.split('.')),
+                        quote(self.html.name), ', '.join(values),
+                        quote(self.pk.name))), **params)
+            else:
+                conn.execute(
+                    self.table.update()
+                    .where(self.pk == bindparam('_pk'))
+                    .values({self.html.name: bindparam('_html')}),
+                    [{'_pk': pk, '_html': html} for pk, html in rows])
+
+    def write(self, results):
+        """写回一块的结果并记录检查点"""
+        rendered = []
+        for pk, status, value in results:
+            self.counts[status] += 1
+            if status == RENDERED:
+                rendered.append((pk, value))
+            elif status == PENDING:
+                self.pending.append(pk)
+            else:
+                # 检查点中只保留出错信息的最后一行
+                message = value.strip().splitlines()[-1]
+                self.failures.append((pk, message))
+                self.report('failed %r: %s' % (pk, message))
+        self.update(rendered)
+        self.last = results[-1][0]
+        self.save_checkpoint()
+
+    def run(self, limit=None):
+        """处理检查点之后的所有行, limit 限制本次处理的行数
+
+        :Returns
+            {状态: 行数}, 包括之前中断的运行
+
+        """
+        self.load_checkpoint()
+        if self.processes:
+            # 先创建进程池, 工作进程不会继承数据库连接
+            pool = multiprocessing.Pool(self.processes, init_worker,
+                                        (self.app, self.base_url))
+        else:
+            from . import video
+            cache_only, video.CACHE_ONLY = video.CACHE_ONLY, True
+        progress = _Progress(self)
+        try:
+            if self.processes:
+                # 按顺序写回, 同时最多 2 * processes 块在渲染, 不会一次读入
+                # 整个表
+                inflight = deque()
+                for rows in self.iter_chunks(limit):
+                    inflight.append(pool.apply_async(render_chunk, (
+                        rows, self.render_kwargs, self.write_pending)))
+                    if len(inflight) >= self.processes * 2:
+                        self.write(_wait(inflight.popleft()))
+                        progress()
+                while inflight:
+                    self.write(_wait(inflight.popleft()))
+                    progress()
+                pool.close()
+            else:
+                for rows in self.iter_chunks(limit):
+                    self.write(render_chunk(
+                        rows, self.render_kwargs, self.write_pending))
+                    progress()
+        finally:
+            if self.processes:
+                pool.terminate()
+                pool.join()
+            else:
+                video.CACHE_ONLY = cache_only
+        progress.finish()
+        return dict(self.counts)
+
+
+def _wait(result):
+    # 不带超时的 get() 在 Python 2 中不响应 Ctrl-C
+    while not result.ready():
+        result.wait(1)
+    return result.get()
+
+
+class _Progress(object):
+    """按时间间隔报告吞吐量"""
+
+    def __init__(self, rerenderer):
+        self.rerenderer = rerenderer
+        self.start = self.last_report = time.time()
+        self.rows = self.last_rows = 0
+        # 从检查点继续时, 之前的行数不计入本次的吞吐量
+        self.initial = sum(rerenderer.counts.values())
+
+    def __call__(self):
+        self.rows = sum(self.rerenderer.counts.values()) - self.initial
+        now = time.time()
+        if now - self.last_report >= self.rerenderer.report_interval:
+            self.report(now, '%.1f rows/s recently' % (
+                (self.rows - self.last_rows) / (now - self.last_report)))
+            self.last_report = now
+            self.last_rows = self.rows
+
+    def report(self, now, extra):
+        counts = self.rerenderer.counts
+        elapsed = now - self.start
+        self.rerenderer.report(
+            '%d rows in %.1fs, %.1f rows/s, %s; rendered %d, pending %d, '
+            'failed %d, last %s' % (
+                self.rows, elapsed, self.rows / elapsed if elapsed else 0,
+                extra, counts[RENDERED], counts[PENDING], counts[FAILED],
+                self.rerenderer.last))
+
+    def finish(self):
+        self()
+        self.report(time.time(), 'done')
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Re-render stored BBCode')
+    parser.add_argument('--app', help='module:app or module:create_app')
+    parser.add_argument('--database',
+                        help='database URI, defaults to the app config')
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--pk', default='id')
+    parser.add_argument('--source', default='content')
+    parser.add_argument('--html', default='html')
+    parser.add_argument('--where', help='SQL condition of rows to re-render')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--checkpoint')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--base-url', default=None)
+    parser.add_argument('--write-pending', action='store_true',
+                        help='write documents with unresolved videos too')
+    args = parser.parse_args(argv)
+
+    app = args.app and load_app(args.app)
+    database = args.database
+    if database is None:
+        if app is None:
+            parser.error('either --database or --app is required')
+        database = app.config['SQLALCHEMY_DATABASE_URI']
+
+    rerenderer = Rerenderer(
+        create_engine(database), args.table, source=args.source,
+        html=args.html, pk=args.pk, chunk_size=args.chunk_size,
+        processes=args.processes, app=app, base_url=args.base_url,
+        write_pending=args.write_pending, where=args.where,
+        checkpoint=args.checkpoint)
+    rerenderer.run(args.limit)
+    for pk in rerenderer.pending:
+        print 'pending', pk
+    for pk, _ in rerenderer.failures:
+        print 'failed', pk
+
+if __name__ == '__main__':
+    main()
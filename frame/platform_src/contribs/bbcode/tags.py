@@ -2,66 +2,78 @@
 from __future__ import unicode_literals
 
 import re
+import time
+import threading
+from collections import OrderedDict
 
 from flask import current_app as app
 from pkg_resources import parse_version as V
 from werkzeug import escape, unescape, url_quote, html as html_builder
-from .core import register_node, register_hook, BaseNode, \
+from .core import register_node, register_hook, render_context, BaseNode, \
     PlainNode, RegexNode, NodeError
+from ..image import image_metas
 
 URL_QUOTE_SAFE = b'/:;"%&#()=?'
 
 
+def open_close(tagname, **attrs):
+    """给出 html_builder 生成的开标签和闭标签, 以便在两者之间逐段输出"""
+    closing = '</%s>' % tagname
+    return getattr(html_builder, tagname)(**attrs)[:-len(closing)], closing
+
+
 class _ListNode(BaseNode):
     display = 'block'
     list_builder = None
+    __slots__ = ()
 
-    def html(self, **kwargs):
-        children = []
-        innerhtml = ''
-
-        def append_li(html):
-            html = html.strip()
-            if html:
-                children.append(html_builder.li(html))
-            return ''
-
+    def iter_html(self, **kwargs):
+        opening, closing = open_close(self.html_tagname)
+        yield opening
+        innerhtml = []
         for node in self.children:
             if not node:
                 continue
             if isinstance(node, PlainNode):
-                innerhtml += node.html(**dict(kwargs, br=False))  # 此处不出现br
-                if node.has_linebreak:
-                    # 发现有换行符的纯文本, li 结束
-                    innerhtml = append_li(innerhtml)
+                innerhtml.extend(node.iter_html(**dict(kwargs, br=False)))  # 此处不出现br
+                # 发现有换行符的纯文本, li 结束
+                end_li = node.has_linebreak
             else:
-                innerhtml += node.html(**kwargs)
-                if node.display == 'block':
-                    # 发现块级元素, li 结束
-                    innerhtml = append_li(innerhtml)
+                innerhtml.extend(node.iter_html(**kwargs))
+                # 发现块级元素, li 结束
+                end_li = node.display == 'block'
+            if end_li:
+                html = ''.join(innerhtml).strip()
+                if html:
+                    yield html_builder.li(html)
+                innerhtml = []
 
         # 处理循环中没有处理的残留 innerhtml
-        append_li(innerhtml)
-        # html_builder 返回的函数只能用一次
-        return getattr(html_builder, self.html_tagname)(*children)
+        html = ''.join(innerhtml).strip()
+        if html:
+            yield html_builder.li(html)
+        yield closing
 
 
 @register_node('ul')
 class UlNode(_ListNode):
     name = 'ul'
     html_tagname = 'ul'
+    __slots__ = ()
 
 
 @register_node('ol')
 class OlNode(_ListNode):
     name = 'ol'
     html_tagname = 'ol'
+    __slots__ = ()
 
 
 @register_node('url')
 class URLNode(BaseNode):
     name = 'url'
     tag_excludes = ['url', '__at__', '__email__', '__url__']
+    __slots__ = ('url', )
 
     def __init__(self, value, children):
         if not value and not children:
@@ -74,17 +86,34 @@ class URLNode(BaseNode):
             url = '<!-- XSS removed -->'
         self.url = url
 
-    def html(self, **kwargs):
-        inside = self.children_html(**kwargs)
-        return '<a href="%s">%s</a>' % (
-            escape(url_quote(self.url, safe=URL_QUOTE_SAFE), quote=True),
-            inside)
+    @classmethod
+    def empty_text(cls, value):
+        return value or ''
+
+    def iter_html(self, **kwargs):
+        yield '<a href="%s">' % escape(
+            url_quote(self.url, safe=URL_QUOTE_SAFE), quote=True)
+        for fragment in self.children_iter_html(**kwargs):
+            yield fragment
+        yield '</a>'
+
+
+def image_meta(url):
+    """给出图片的 (hashkey, (宽, 高, 格式)), 不是果壳的图片时为 (None, None)
+
+    多张图片用 image_metas 一起解析.
+
+    """
+    return image_metas([url])[url]
 
 
 @register_node('image', 'img')
 class ImageNode(BaseNode):
     name = 'image'
     tag_includes = []
+    has_text = False
+    # meta 为 image_meta 的结果, 批量渲染时由 image_hook 一起查询
+    __slots__ = ('url', 'meta')
 
     def __init__(self, value, children):
         if value or not children:
@@ -95,22 +124,25 @@ class ImageNode(BaseNode):
            url.lower()[:9] == 'vbscript:':
             url = '<!-- XSS removed -->'
         self.url = url
+        self.meta = None
 
     def text(self):
         return ''
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         from guokr.platform.flask.helpers import resp_image
-        from guokr.platform.flask.helpers import get_params, url2hashkey
         width = kwargs.get('resp_width', 480)
         url = resp_image(self.url, width)
-        hashkey = url2hashkey(self.url, take_thumbnail=True)
+        if self.meta is None:
+            self.meta = image_meta(self.url)
+        hashkey, params = self.meta
         if not hashkey:
-            return '<img src="%s" style="max-width: %spx" />' % (
+            yield '<img src="%s" style="max-width: %spx" />' % (
                 escape(url_quote(url, safe=URL_QUOTE_SAFE), quote=True), width)
+            return
 
-        w, h, file_type = get_params(hashkey)
-        return ('<img src="%s" style="max-width: %spx" '
+        w, h, file_type = params
+        yield ('<img src="%s" style="max-width: %spx" '
                 'data-orig-width="%s" '
                 'data-orig-height="%s" '
                 'data-hashkey="%s"/>') % (
@@ -125,24 +157,30 @@ class ImageNode(BaseNode):
 class BoldNode(BaseNode):
     name = 'bold'
     tag_excludes = ['bold', 'b']
+    __slots__ = ()
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         if not self.children:
-            return ''
-        else:
-            return '<strong>%s</strong>' % self.children_html(**kwargs)
+            return
+        yield '<strong>'
+        for fragment in self.children_iter_html(**kwargs):
+            yield fragment
+        yield '</strong>'
 
 
 @register_node('italic', 'i')
 class ItalicNode(BaseNode):
     name = 'italic'
     tag_excludes = ['italic', 'i']
+    __slots__ = ()
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         if not self.children:
-            return ''
-        else:
-            return '<i>%s</i>' % self.children_html(**kwargs)
+            return
+        yield '<i>'
+        for fragment in self.children_iter_html(**kwargs):
+            yield fragment
+        yield '</i>'
 
 
 @register_node('color')
@@ -150,10 +188,11 @@ class ColorNode(BaseNode):
     name = 'color'
     tag_excludes = ['color']
     html_colors = re.compile('^([A-Za-z]+|#[0-9A-Fa-f]{,6})$')
+    __slots__ = ()
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         if not self.children:
-            return ''
+            return
         if self.value:  # 添加这个，判断无参数的情况
             color = self.value.strip()
         else:
@@ -163,8 +202,10 @@ class ColorNode(BaseNode):
         else:
             style = 'color: ' + color + ';'
         # 偷懒, 没有支持不带 # 的 16 进制写法
-        return '<span style="%s">%s</span>' % (
-            style, self.children_html(**kwargs))
+        yield '<span style="%s">' % style
+        for fragment in self.children_iter_html(**kwargs):
+            yield fragment
+        yield '</span>'
 
 
 @register_node('quote', 'blockquote')
@@ -172,48 +213,66 @@ class QuoteNode(BaseNode):
     name = 'quote'
     display = 'block'
     tag_excludes = ['quote', 'blockquote']
+    __slots__ = ()
 
-    def html(self, **kwargs):
-        return '<blockquote>%s</blockquote>' % self.children_html(**kwargs)
+    def iter_html(self, **kwargs):
+        yield '<blockquote>'
+        for fragment in self.children_iter_html(**kwargs):
+            yield fragment
+        yield '</blockquote>'
 
 
 @register_node('code')
 class CodeNode(BaseNode):
     name = 'code'
     tag_excludes = ['code']
+    __slots__ = ()
 
-    def html(self, **kwargs):
-        return '<pre>%s</pre>' % self.children_html(**dict(kwargs, br=False))
+    def iter_html(self, **kwargs):
+        yield '<pre>'
+        for fragment in self.children_iter_html(**dict(kwargs, br=False)):
+            yield fragment
+        yield '</pre>'
 
 
 @register_node('table', 'th', 'tr')
 class TableNode(BaseNode):
     name = 'table'
     display = 'block'
+    __slots__ = ()
 
-    def html(self, **kwargs):
-        innerhtml = []
+    def iter_html(self, **kwargs):
+        opening, closing = open_close(self.name)
+        yield opening
         for child in self.children:
             if isinstance(child, PlainNode):
-                innerhtml.append(child.html(**dict(kwargs, br=False)))
+                fragments = child.iter_html(**dict(kwargs, br=False))
             else:
-                innerhtml.append(child.html(**kwargs))
-        return getattr(html_builder, self.name)(*innerhtml)
+                fragments = child.iter_html(**kwargs)
+            for fragment in fragments:
+                yield fragment
+        yield closing
 
 
 @register_node('_html', 'td', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
 class HTMLNode(BaseNode):
     name = 'td'
     display = 'block'
+    __slots__ = ()
 
-    def html(self, **kwargs):
-        return getattr(html_builder, self.name)(self.children_html(**kwargs))
+    def iter_html(self, **kwargs):
+        opening, closing = open_close(self.name)
+        yield opening
+        for fragment in self.children_iter_html(**kwargs):
+            yield fragment
+        yield closing
 
 
 @register_node('ref')
 class RefNode(BaseNode):
     name = 'ref'
     tag_includes = []
+    __slots__ = ('url', )
 
     url_whitelist = re.compile(
         r'^(?:http://(?:(?:www)?\.guokr\.com|guo\.kr))?'
@@ -231,14 +290,15 @@ class RefNode(BaseNode):
         else:
             raise NodeError('Invalid ref URL')
 
-    def html(self, **kwargs):
-        return html_builder.a(self.url, href=self.url, class_='bbcode-ref')
+    def iter_html(self, **kwargs):
+        yield html_builder.a(self.url, href=self.url, class_='bbcode-ref')
 
 
 @register_node('flash')
 class FlashNode(BaseNode):
     name = 'flash'
     tag_includes = []
+    __slots__ = ('url', )
 
     def __init__(self, value, children):
         if value or not children:
@@ -249,11 +309,11 @@ class FlashNode(BaseNode):
             url = '<!-- XSS removed -->'
         self.url = url
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         width = kwargs.get('resp_width', 480)
         height = width * 5 / 6
         # TODO: use placeholder
-        return \
+        yield \
             '<embed src="%s" type="application/x-shockwave-flash" ' \
             'allowscriptaccess="sameDomain" allowfullscreen="true" ' \
             'wmode="transparent" quality="high" width="%s" ' \
@@ -268,17 +328,134 @@ class RegexURLNode(RegexNode):
     regex = re.compile(r"""(?iux)
                            (?:https?|ftps?|ssh|sftp|ed2k|git|svn|svn\+ssh|smb)
                            ://[\w\?\.=&+%/#;@:~!,()-]+""")
+    __slots__ = ()
 
     @property
     def url(self):
         return self.value.group(0)
 
-    def html(self, **kwargs):
-        return '<a href="%s">%s</a>' % (
+    def iter_html(self, **kwargs):
+        yield '<a href="%s">%s</a>' % (
             escape(url_quote(self.url, safe=URL_QUOTE_SAFE), quote=True),
             escape(self.url))
 
 
+def resolve_mentions():
+    """是否批量查询 @ 的用户, 直接链接到用户主页, 在 app 配置中设置
+    BBCODE_RESOLVE_MENTIONS = True 开启"""
+    return bool(app and app.config.get('BBCODE_RESOLVE_MENTIONS'))
+
+
+class MentionResolver(object):
+    """批量查询昵称对应的用户 ukey
+
+    结果在进程内缓存 ttl 秒, 在 Redis 中缓存 redis_ttl 秒, 不存在的昵称缓存
+    missing_ttl 秒. 接口出错时查询的昵称不缓存.
+
+    用户接口每个昵称一次请求, 每次 resolve 最多请求 max_fetches 次, 耗时
+    超过 fetch_timeout 秒后不再请求; 没有查询的昵称不在结果中, 也不缓存,
+    之后的渲染再查询.
+
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, redis_ttl=3600,
+                 missing_ttl=60, key_prefix='bbcode-mention:',
+                 max_fetches=5, fetch_timeout=0.5):
+        self.maxsize = maxsize
+        self.max_fetches = max_fetches
+        self.fetch_timeout = fetch_timeout
+        self.ttl = ttl
+        self.redis_ttl = redis_ttl
+        self.missing_ttl = missing_ttl
+        self.key_prefix = key_prefix
+        self.lock = threading.Lock()
+        self.local = OrderedDict() # {昵称: (ukey, 过期时间)}
+
+    def _set_local(self, nickname, ukey, now):
+        ttl = self.ttl if ukey else min(self.ttl, self.missing_ttl)
+        with self.lock:
+            self.local.pop(nickname, None)
+            self.local[nickname] = (ukey, now + ttl)
+            while len(self.local) > self.maxsize:
+                self.local.popitem(last=False)
+
+    def resolve(self, nicknames):
+        """给出 {昵称: ukey}, 不存在的昵称为 '', 接口出错或者超出请求限制
+        的昵称不在结果中. 按 nicknames 中的顺序查询
+
+        依次查找进程内的缓存, Redis (一次 mget) 和社区的用户接口 (见 fetch).
+
+        """
+        from guokr.platform.engines import _share_redis
+        now = time.time()
+        result = {}
+        missing = []
+        with self.lock:
+            for nickname in OrderedDict.fromkeys(nicknames):
+                item = self.local.get(nickname)
+                if item is not None and item[1] > now:
+                    result[nickname] = item[0]
+                else:
+                    missing.append(nickname)
+        if not missing:
+            return result
+
+        fetch = []
+        cached = _share_redis.mget([self.key_prefix + nickname
+                                    for nickname in missing])
+        for nickname, ukey in zip(missing, cached):
+            if ukey is None:
+                fetch.append(nickname)
+            else:
+                result[nickname] = ukey = ukey.decode('U8')
+                self._set_local(nickname, ukey, now)
+        if not fetch:
+            return result
+
+        users = self.fetch(fetch)
+        if users:
+            pipe = _share_redis.pipeline(transaction=False)
+            for nickname, ukey in users.iteritems():
+                result[nickname] = ukey
+                self._set_local(nickname, ukey, now)
+                pipe.setex(self.key_prefix + nickname, ukey.encode('U8'),
+                           self.redis_ttl if ukey else self.missing_ttl)
+            pipe.execute()
+        return result
+
+    def fetch(self, nicknames):
+        """通过社区的用户接口查询, 给出 {昵称: ukey}, 不存在的昵称为 ''
+
+        用户接口按昵称查询时只接受一个昵称 (和 wtf.filters.NicknameOrUid2Ukey
+        的用法相同), 每个昵称一次请求. 接口出错, 请求了 max_fetches 次或者
+        耗时超过 fetch_timeout 秒时不再查询余下的昵称, 它们和出错的昵称都
+        不在结果中.
+
+        """
+        from guokr.platform.apis import community, \
+            APIServerError, APIClientError
+        result = {}
+        deadline = time.time() + self.fetch_timeout
+        for count, nickname in enumerate(nicknames):
+            if count >= self.max_fetches or \
+               count and time.time() > deadline:
+                break
+            try:
+                user = community.user.retrieve(
+                    retrieve_type='by_nickname',
+                    nickname=nickname)
+            except (APIServerError, APIClientError):
+                break
+            try:
+                result[nickname] = user[nickname]['ukey']
+            except (KeyError, TypeError):
+                result[nickname] = ''
+        return result
+
+
+mentions = MentionResolver()
+
+
 @register_node('__at__', weight=30)
 class AtNode(RegexNode):
     name = '__at__'
@@ -286,34 +463,103 @@ class AtNode(RegexNode):
                            @(?P<nickname>
                                [\w\u3400-\u4db5\u4e00-\u9fcb\.-]{1,20}
                            )""")
+    # 用户主页, 参数为 ukey
+    profile_endpoint = 'community:profile.index'
+
+    # 用户的 ukey, 由 mention_hook 批量查询. 用户不存在时为 '', 没有查询
+    # 或者接口出错时为 None, 链接到按昵称跳转的地址
+    __slots__ = ('ukey', )
+
+    def __init__(self, value, children=None):
+        super(AtNode, self).__init__(value, children)
+        self.ukey = None
 
     @property
     def nickname(self):
         return self.value.group('nickname')
 
-    def html(self, **kwargs):
+    @property
+    def cacheable(self):
+        # 接口出错时不缓存, 以便之后重新查询
+        return self.ukey is not None or not resolve_mentions()
+
+    @classmethod
+    def cache_vary(cls):
+        # 链接取决于是否在 app 中, 当前请求的域名, 以及是否查询用户
+        from flask import request
+        if app:
+            return (request.host_url if request else True,
+                    resolve_mentions())
+
+    def iter_html(self, **kwargs):
         from flask import url_for
         nickname = self.value.group('nickname')
-        if app:
-            return '<a href="%s">@%s</a>' % (
-                url_for(
-                    'community:profile.nickname_redirect', nickname=nickname),
-                escape(nickname))
+        if not app:
+            yield '<a href="#">@%s</a>' % escape(nickname)
+            return
+        if self.ukey == '':
+            # 不存在的用户
+            yield '@' + escape(nickname)
+            return
+        if self.ukey:
+            endpoint, name, value = self.profile_endpoint, 'ukey', self.ukey
+        else:
+            endpoint, name, value = ('community:profile.nickname_redirect',
+                                     'nickname', nickname)
+        context = render_context()
+        if context is None:
+            url = url_for(endpoint, **{name: value})
         else:
-            return '<a href="#">@%s</a>' % escape(nickname)
+            # 每个请求只生成一次链接的模板
+            url = context.url_for(endpoint, name, value)
+        yield '<a href="%s">@%s</a>' % (url, escape(nickname))
+
+
+class RunStartRegex(object):
+    """结果与 re.compile(pattern, flags) 相同, 但 finditer 只在搜索的起点,
+    上一个匹配的结尾和一串 run 字符的开头尝试匹配
+
+    pattern 以一串 run 字符开头时, 从这串字符中间开始的匹配与从开头开始的
+    结果相同, 不必每个位置都重新扫描一遍, 否则没有匹配的长串字符的耗时是
+    长度的平方.
+
+    """
+
+    def __init__(self, pattern, run, flags=0):
+        self.regex = re.compile(pattern, flags)
+        self.run_start = re.compile(r'(?<!%s)(?:%s)' % (run, pattern), flags)
+        self.pattern = pattern
+
+    def match(self, string, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(string)
+        return self.regex.match(string, pos, endpos)
+
+    def finditer(self, string, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(string)
+        while pos < endpos:
+            m = self.regex.match(string, pos, endpos) or \
+                self.run_start.search(string, pos + 1, endpos)
+            if m is None:
+                return
+            yield m
+            pos = m.end()
 
 
 @register_node('__email__', weight=80)
 class EmailNode(RegexNode):
     name = '__email__'
-    regex = re.compile(r'(?i)[\w+\.-]+@[\w][\w\.-]*\.[a-z]{2,10}')
+    regex = RunStartRegex(r'[\w+\.-]+@[\w][\w\.-]*\.[a-z]{2,10}',
+                          r'[\w+\.-]', re.I)
+    __slots__ = ()
 
     @property
     def email(self):
         return self.value.group(0)
 
-    def html(self, **kwargs):
-        return '<a href="mailto:%s">%s</a>' % (
+    def iter_html(self, **kwargs):
+        yield '<a href="mailto:%s">%s</a>' % (
             escape(self.email, quote=True),
             escape(self.email))
 
@@ -322,6 +568,8 @@ class EmailNode(RegexNode):
 class MathMode(BaseNode):
     name = 'math'
     tag_includes = []
+    has_text = False
+    __slots__ = ()
 
     @property
     def math(self):
@@ -338,6 +586,14 @@ class MathMode(BaseNode):
 
     @property
     def format(self):
+        context = render_context()
+        if context is None:
+            return self.image_format()
+        return context.get('math_format', self.image_format)
+
+    @staticmethod
+    def image_format():
+        """根据浏览器决定公式图片的格式"""
         from flask import request
         browser = request.user_agent.browser
         version = V(request.user_agent.version or '')
@@ -356,11 +612,17 @@ class MathMode(BaseNode):
         else:
             return 'png'
 
-    def html(self, **kwargs):
+    @classmethod
+    def cache_vary(cls):
+        context = render_context()
+        if context is not None:
+            return context.get('math_format', cls.image_format)
+
+    def iter_html(self, **kwargs):
         from flask import url_for
         width = kwargs.get('resp_width', 480)
 
-        return ('<img src="%s" class="edui-faked-insertmathjax"'
+        yield ('<img src="%s" class="edui-faked-insertmathjax"'
                 ' data-code="%s" style="max-width: %spx" />') % (
                     url_for(
                         'image:formula',
@@ -378,12 +640,16 @@ class IndentNode(BaseNode):
     """缩进标签的显示"""
     name = 'indent'
     display = 'block'
+    __slots__ = ()
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         if not self.children:
-            return ''
-        return html_builder.div(self.children_html(**dict(kwargs, br=False)),
-                                class_="bbcode-indent")
+            return
+        opening, closing = open_close('div', class_="bbcode-indent")
+        yield opening
+        for fragment in self.children_iter_html(**dict(kwargs, br=False)):
+            yield fragment
+        yield closing
 
 
 @register_node('float')
@@ -394,10 +660,11 @@ class FloatNode(BaseNode):
     display = 'block'
     tag_excludes = ['float']
     html_float = re.compile('^left|right$')
+    __slots__ = ()
 
-    def html(self, **kwargs):
+    def iter_html(self, **kwargs):
         if not self.children:
-            return ''
+            return
         if self.value:  # 判断是否有参数，不判断会有AttributeError生成
             direction = self.value.strip()
         else:
@@ -406,29 +673,80 @@ class FloatNode(BaseNode):
             style = '<!-- XSS removed -->'
         else:
             style = 'bbcode-float-' + direction
-        return html_builder.div(self.children_html(**dict(kwargs, br=False)),
-                                class_=style)
+        opening, closing = open_close('div', class_=style)
+        yield opening
+        for fragment in self.children_iter_html(**dict(kwargs, br=False)):
+            yield fragment
+        yield closing
+
+
+# 刚创建过的公式在这段时间 (秒) 内不再创建, 等待公式服务写入 image-formula
+FORMULA_PENDING_EXPIRE = 300
+
+
+@register_hook('after_parse', batch=True)
+def math_hook(bbcodes):
+    """整批文档中的公式通过一次 pipeline 检查是否已经生成或者刚创建过,
+    其余的逐个创建
 
+    image-formula 由公式服务写入, 这里只读取; 创建成功的公式另外记录
+    FORMULA_PENDING_EXPIRE 秒, 过期后仍未生成的会再次创建.
 
-@register_hook('after_parse')
-def math_hook(bbcode):
+    """
     from guokr.platform.apis import APIServerError, APIClientError
     from guokr.platform.apis.confidential import formula
     from guokr.platform.engines import _share_redis
     math_map = {}
-    for node in bbcode.filter('math'):
-        math_map[node.hashed] = node.math
+    for bbcode in bbcodes:
+        for node in bbcode.filter('math'):
+            math_map[node.hashed] = node.math
     if not math_map:
         return
     hashed = math_map.keys()
     # 通过redis检查公式是否已经生成过
-    result = _share_redis.hmget('image-formula', hashed)
-    math_exist = zip(hashed, result)
-    for hashed, is_exist in math_exist:
-        if is_exist is None:
+    pipe = _share_redis.pipeline(transaction=False)
+    pipe.hmget('image-formula', hashed)
+    pipe.mget(['image-formula-pending:' + h for h in hashed])
+    result, pending = pipe.execute()
+    created = []
+    for hashed, is_exist, is_pending in zip(hashed, result, pending):
+        if is_exist is None and is_pending is None:
             # 同步创建, 确保正常显示
             # 生成公式是重操作, 所以单独请求避免造成过大负载
             try:
                 formula.create(tex=math_map[hashed], confirm=True)
             except (APIServerError, APIClientError):
-                pass
+                continue
+            created.append(hashed)
+    if created:
+        pipe = _share_redis.pipeline(transaction=False)
+        for hashed in created:
+            pipe.setex('image-formula-pending:' + hashed, 1,
+                       FORMULA_PENDING_EXPIRE)
+        pipe.execute()
+
+
+@register_hook('before_render', batch=True)
+def mention_hook(bbcodes):
+    """整批文档中的 @ 一起查询用户, 相同的昵称只查询一次"""
+    if not resolve_mentions():
+        return
+    nodes = [node for bbcode in bbcodes for node in bbcode.filter('__at__')
+             if node.ukey is None]
+    if not nodes:
+        return
+    users = mentions.resolve(node.nickname for node in nodes)
+    for node in nodes:
+        node.ukey = users.get(node.nickname)
+
+
+@register_hook('before_render', batch=True)
+def image_hook(bbcodes):
+    """整批文档中的图片一起解析 hashkey, 相同的图片只解析一次"""
+    nodes = [node for bbcode in bbcodes for node in bbcode.filter('image, img')
+             if node.meta is None]
+    if not nodes:
+        return
+    metas = image_metas(set(node.url for node in nodes))
+    for node in nodes:
+        node.meta = metas[node.url]
@@ -6,6 +6,10 @@ import re
 import time
 import json
 import base64
+import threading
+from Queue import Queue, Full
+from urlparse import urlsplit
+from flask import current_app as app
 from werkzeug import html as html_builder
 
 from guokr.platform import urlfetch
@@ -17,6 +21,86 @@ class URLNotMatch(NodeError):
     pass
 
 
+class VideoPending(Exception):
+    """需要访问网络才能解析视频地址, 而当前不允许同步访问
+
+    参数为 (解析函数, 参数), 解析函数会在后台执行, 把结果写入缓存.
+
+    """
+    pass
+
+
+def background_resolution():
+    """是否在后台解析需要访问网络的视频地址, 在 app 配置中设置
+    BBCODE_VIDEO_BACKGROUND = True 开启"""
+    return bool(app and app.config.get('BBCODE_VIDEO_BACKGROUND'))
+
+
+# 批量重新渲染等不能访问网络的场景下设为 True, 见 cache_only
+CACHE_ONLY = False
+
+def cache_only():
+    """是否只使用缓存中的视频地址, 缓存没有时既不访问网络, 也不提交后台
+    解析, 直接渲染占位的链接. 设置 CACHE_ONLY 或 app 配置
+    BBCODE_VIDEO_CACHE_ONLY = True 开启"""
+    return CACHE_ONLY or bool(
+        app and app.config.get('BBCODE_VIDEO_CACHE_ONLY'))
+
+
+class ThreadResolver(object):
+    """在后台线程中依次执行解析函数
+
+    同一个参数同时只排队一次, 失败的参数在 retry_after 秒内不再重试.
+    需要使用任务队列时, 把 video.resolver 替换为有 submit(func, *args)
+    方法的对象即可.
+
+    """
+
+    def __init__(self, maxsize=1024, retry_after=600):
+        self.queue = Queue(maxsize)
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failures = {}
+        self.thread = None
+
+    def submit(self, func, *args):
+        key = (func, ) + args
+        with self.lock:
+            if key in self.pending or \
+               self.failures.get(key, 0) > time.time():
+                return
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            try:
+                self.queue.put_nowait(key)
+            except Full:
+                return
+            self.pending.add(key)
+
+    def run(self):
+        while True:
+            key = self.queue.get()
+            try:
+                key[0](*key[1:])
+            except Exception:
+                with self.lock:
+                    self.failures[key] = time.time() + self.retry_after
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+    def join(self):
+        """等待已提交的解析全部完成"""
+        self.queue.join()
+
+
+resolver = ThreadResolver()
+
+
 def render_embed(src, **kwargs):
     width = kwargs.get('resp_width', 480)
     height = width * 5 / 6
@@ -38,8 +122,37 @@ def render_iframe(src, **kwargs):
         width=width, height=height)
 
 
+def render_pending(url):
+    return html_builder.a(url, href=url, class_='bbcode-video-pending')
+
+
+_HOST_INDEX = {}
+
+def adapters_for(adapters, url):
+    """按 URL 的域名给出可能匹配的 adapter, 顺序与 adapters 中相同"""
+    key = tuple(adapters)
+    index = _HOST_INDEX.get(key)
+    if index is None:
+        index = {}
+        for order, adapter in enumerate(adapters):
+            for host in adapter.hosts or [None]:
+                index.setdefault(host, []).append((order, adapter))
+        _HOST_INDEX[key] = index
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        host = ''
+    candidates = index.get(host, []) + index.get(None, [])
+    if '.' in host:
+        candidates += index.get('*.' + host.split('.', 1)[1], [])
+    return [adapter for _, adapter in sorted(candidates)]
+
+
 class _SiteAdapter(object):
 
+    # 可以处理的域名, "*." 开头的匹配任意一级子域名; 为 None 时总是尝试
+    hosts = None
+
     def __init__(self, url):
         self.url = url
         self.renderer = self.init(url)
@@ -102,6 +215,7 @@ class _FlashAdapter(_SiteAdapter):
 class YoukuAdapter(_IframeAdapter):
     """优酷网HTML5"""
 
+    hosts = ['v.youku.com', 'player.youku.com']
     # 优酷的 id 模式: X<b64encoded id>
     _regex = [
         re.compile(r'^http://v\.youku\.com/v_show/id_(?P<id>X[\w=-]+)\.html'),
@@ -114,6 +228,7 @@ class YoukuAdapter(_IframeAdapter):
 class TudouAdapter(_IframeAdapter):
     """土豆网HTML5"""
 
+    hosts = ['tudou.com', 'www.tudou.com']
     _regex = [
         re.compile(r'^http://(?:www\.)?tudou\.com/programs/view/(?P<id>[\w-]+)/'),
         re.compile(r'^http://(?:www\.)?tudou\.com/programs/view/html5embed\.action\?code=(?P<id>[\w-]+)'),
@@ -126,6 +241,7 @@ class TudouAdapter(_IframeAdapter):
 class Ku6Adapter(_FlashAdapter):
     """酷6网"""
 
+    hosts = ['v.ku6.com', 'player.ku6.com']
     _regex = [
         re.compile(r'^http://v\.ku6\.com/show/(?P<id>[\w\.-]+)\.html'),
         re.compile(r'^http://player\.ku6\.com/refer/(?P<id>[\w\.-]+)/v\.swf'),
@@ -136,6 +252,7 @@ class Ku6Adapter(_FlashAdapter):
 class W56Adapter(_IframeAdapter):
     """56网HTML5"""
 
+    hosts = ['56.com', 'www.56.com', 'player.56.com']
     _regex = [
         re.compile(r'^http://(?:www\.)?56\.com/(?:u\d+/v_|w\d+/play_album-aid-\d+_vid-)(?P<id>[\w=-]+)\.html'),
         re.compile(r'^http://player\.56\.com/v_(?P<id>[\w=-]+)\.swf'),
@@ -147,6 +264,7 @@ class W56Adapter(_IframeAdapter):
 class W56PicAdapter(_FlashAdapter):
     """56网图片"""
 
+    hosts = ['56.com', 'www.56.com', 'player.56.com']
     _regex = [
         re.compile(r'^http://(?:www\.)?56\.com/p\d+/v_(?P<id_b64decode>v_[\w=-]+)\.html'),
         re.compile(r'^http://player\.56\.com/deux_(?P<id>v_[\w=-]+)\.swf'),
@@ -162,6 +280,7 @@ class W56PicAdapter(_FlashAdapter):
 class QQAdapter(_FlashAdapter):
     """腾讯视频"""
 
+    hosts = ['v.qq.com', 'static.video.qq.com']
     _regex = [
         re.compile(r'^http://v\.qq\.com/cover/./[\w=-]+\.html\?vid=(?P<id>[\w=-]+)'),
         re.compile(r'^http://v\.qq\.com/cover/./[\w=-]+/(?P<id>[\w=-]+)\.html'),
@@ -174,6 +293,8 @@ class QQAdapter(_FlashAdapter):
 class SinaAdapter(_FlashAdapter):
     """新浪视频"""
 
+    hosts = ['video.sina.com.cn', 'video.weibo.com',
+             'you.video.sina.com.cn']
     _regex = [
         re.compile(r'^http://video\.sina\.com\.cn/v/b/(?P<vid>\d+)-(?P<uid>\d+)\.html'),
         re.compile(r'^http://video\.weibo\.com/v/weishipin/(?P<mix_vid>[\w-]+).htm'),
@@ -181,6 +302,7 @@ class SinaAdapter(_FlashAdapter):
     ]
     _page_regex = _regex[0]
     _srctpl = 'http://you.video.sina.com.cn/api/sinawebApi/outplayrefer.php/vid=%(vid)s_%(uid)s/s.swf'
+    _api_url = 'http://video.weibo.com/'
 
     def kw_handler(self, kw):
         if 'vid' in kw and 'uid' in kw:
@@ -194,39 +316,47 @@ class SinaAdapter(_FlashAdapter):
                 return kw
             except (ValueError, TypeError):
                 pass
-
-            try:
-                resp = urlfetch.get(
-                    'http://video.weibo.com/',
-                    params={
-                        's': 'v',
-                        'a': 'play_list',
-                        'format': 'json',
-                        'mix_video_id': mix_vid,
-                        'date': int(time.time() * 1000),
-                        'for': ''
-                    })
-            except KeyboardInterrupt:
-                raise
-            except:
-                raise URLNotMatch()
-            if resp.status_code != 200:
-                raise URLNotMatch()
-            try:
-                page = resp.json['result']['data'][0]['play_page_url']
-                m = self._page_regex.search(page)
-            except (KeyError, TypeError):
-                raise URLNotMatch()
-            if not m:
-                raise URLNotMatch()
-            kw.update(m.groupdict())
-            _share_redis.hset('bbcode-video-weibo-url', mix_vid, json.dumps([kw['vid'], kw['uid']]))
+            if background_resolution() or cache_only():
+                raise VideoPending(self.resolve, mix_vid)
+            kw.update(self.resolve(mix_vid))
             return kw
 
+    @classmethod
+    def resolve(cls, mix_vid):
+        """通过微博的接口得到 vid 和 uid, 并写入缓存"""
+        try:
+            resp = urlfetch.get(
+                cls._api_url,
+                params={
+                    's': 'v',
+                    'a': 'play_list',
+                    'format': 'json',
+                    'mix_video_id': mix_vid,
+                    'date': int(time.time() * 1000),
+                    'for': ''
+                })
+        except KeyboardInterrupt:
+            raise
+        except:
+            raise URLNotMatch()
+        if resp.status_code != 200:
+            raise URLNotMatch()
+        try:
+            page = resp.json['result']['data'][0]['play_page_url']
+            m = cls._page_regex.search(page)
+        except (KeyError, TypeError, IndexError):
+            raise URLNotMatch()
+        if not m:
+            raise URLNotMatch()
+        kw = m.groupdict()
+        _share_redis.hset('bbcode-video-weibo-url', mix_vid, json.dumps([kw['vid'], kw['uid']]))
+        return kw
+
 
 class SohuAdapter(_FlashAdapter):
     """搜狐视频"""
 
+    hosts = ['share.vrs.sohu.com', 'tv.sohu.com']
     _regex = [
         re.compile(r'^http://share\.vrs\.sohu\.com/(?P<id>\d+)/v\.swf'),
         re.compile(r'^(?P<url>http://tv\.sohu\.com/\d+/n\d+\.shtml)'),
@@ -235,6 +365,7 @@ class SohuAdapter(_FlashAdapter):
 
     # XXX: 没错, sohu 用的是 & 而不是 ?
     _srctpl = 'http://share.vrs.sohu.com/%(id)s/v.swf&autoplay=false'
+    _api_url = 'http://open.tv.sohu.com/tools/flash/url/get.do'
 
     def kw_handler(self, kw):
         if 'id' in kw:
@@ -245,11 +376,16 @@ class SohuAdapter(_FlashAdapter):
         if vid:
             kw['id'] = vid
             return kw
+        if background_resolution() or cache_only():
+            raise VideoPending(self.resolve, url)
+        kw['id'] = self.resolve(url)
+        return kw
 
+    @classmethod
+    def resolve(cls, url):
+        """通过搜狐的接口得到视频的 id, 并写入缓存"""
         try:
-            resp = urlfetch.post(
-                'http://open.tv.sohu.com/tools/flash/url/get.do',
-                data={'url': url})
+            resp = urlfetch.post(cls._api_url, data={'url': url})
         except KeyboardInterrupt:
             raise
         except:
@@ -258,19 +394,20 @@ class SohuAdapter(_FlashAdapter):
             raise URLNotMatch()
         try:
             flash = resp.json['flash']
-            m = self._swf_regex.search(flash)
+            m = cls._swf_regex.search(flash)
         except (KeyError, TypeError):
             raise URLNotMatch()
         if not m:
             raise URLNotMatch()
-        kw['id'] = vid = int(m.group('id'))
+        vid = int(m.group('id'))
         _share_redis.hset('bbcode-sohu-url', url, vid)
-        return kw
+        return vid
 
 
 class Open163Adapter(_FlashAdapter):
     """网易公开课"""
 
+    hosts = ['v.163.com', 'swf.ws.126.net']
     _regex = [
         re.compile(r'^http://v\.163\.com/movie/\d{4}/\d{1,2}/[A-Z\d]/[A-Z\d]/(?P<id>[A-Z\d]+_[A-Z\d]+).html'),
         re.compile(r'^http://swf\.ws\.126\.net/openplayer/v01/-0-2_(?P<id>[A-Z\d]+_[A-Z\d]+)-'),
@@ -281,6 +418,7 @@ class Open163Adapter(_FlashAdapter):
 class NeteaseAdapter(_FlashAdapter):
     """网易视频"""
 
+    hosts = ['v.163.com', 'swf.ws.126.net']
     _regex = [
         re.compile(r'^http://v\.163\.com/(?P<vtype>[^/]+)/(?P<sid>[A-Z\d]+)/(?P<vid>[A-Z\d]+)\.html'),
         re.compile(r'^http://swf\.ws\.126\.net/v/ljk/shareplayer/ShareFlvPlayer\.swf\?pltype=(?P<pltype>\d+)&topicid=(?P<topicid>\d+)&vid=(?P<vid>[A-Z\d]+)&sid=(?P<sid>[A-Z\d]+)'),
@@ -311,6 +449,7 @@ class NeteaseAdapter(_FlashAdapter):
 class LetvAdapter(_FlashAdapter):
     """乐视网"""
 
+    hosts = ['www.letv.com', 'i7.imgs.letv.com', 'img1.c0.letv.com']
     _regex = [
         re.compile(r'^http://www\.letv\.com/ptv/vplay/(?P<id>\d+)\.html'),
         re.compile(r'^http://(i7\.imgs|img1\.c0)\.letv\.com/.+?/swfPlayer\.swf\?.*?id=(?P<id>\d+)')
@@ -321,6 +460,7 @@ class LetvAdapter(_FlashAdapter):
 class AcfunAdapter(_FlashAdapter):
     """Acfun弹幕网"""
 
+    hosts = ['www.acfun.tv', 'cdn.acfun.tv']
     _regex = [
         re.compile(r'^(?P<id>http://www\.acfun\.tv/v/ac\d+)'),
         re.compile(r'^http://cdn\.acfun\.tv/player/ACFlashPlayer\.weibo2\.swf\?type=page&url=(?P<id>[^\&]+)'),
@@ -331,6 +471,7 @@ class AcfunAdapter(_FlashAdapter):
 class BilibiliAdapter(_FlashAdapter):
     """Bilibili弹幕网"""
 
+    hosts = ['www.bilibili.tv', 'static.hdslb.com']
     _regex = [
         re.compile(r'^http://www\.bilibili\.tv/video/av(?P<id>\d+)(?:/index_(?P<page>\d+))?'),
         re.compile(r'^http://static\.hdslb\.com/miniloader\.swf\?aid=(?P<id>\d+)(?:&page=(?P<page>\d+))?'),
@@ -345,6 +486,10 @@ class BilibiliAdapter(_FlashAdapter):
 
 class WhitelistFlashAdapter(_FlashAdapter):
 
+    hosts = ['player.youku.com', 'www.tudou.com', 'player.ku6.com',
+             'player.56.com', 'share.vrs.sohu.com', '*.video.sina.com.cn',
+             '*.video.qq.com', 'swf.ws.126.net', 'player.cntv.cn',
+             'union.bokecc.com', '*.video.qiyi.com']
     _regex = re.compile(r'^(?P<url>https?://(?:player\.youku\.com|www\.tudou\.com|'
                         r'player\.ku6\.com|player\.56\.com|'
                         r'share\.vrs\.sohu\.com|\w+\.video\.sina\.com\.cn|'
@@ -359,6 +504,10 @@ class VideoNode(BaseNode):
     name = 'video'
     #display = 'block'
     tag_includes = []
+    has_text = False
+
+    # 等待后台解析时渲染占位的链接, 不能缓存
+    __slots__ = ('renderer', 'pending')
 
     adapters = [
         YoukuAdapter,
@@ -380,17 +529,28 @@ class VideoNode(BaseNode):
     def __init__(self, value, children):
         super(VideoNode, self).__init__(value, children)
         url = self.children_unicode().strip()
-        for adapter in self.adapters:
+        self.pending = False
+        for adapter in adapters_for(self.adapters, url):
             try:
                 self.renderer = adapter(url)
                 break
             except URLNotMatch:
                 continue
+            except VideoPending, ex:
+                if not cache_only():
+                    resolver.submit(*ex.args)
+                self.renderer = lambda **kwargs: render_pending(url)
+                self.pending = True
+                break
         else:
             raise NodeError('Invalid video URL')
 
+    @property
+    def cacheable(self):
+        return not self.pending
+
     def text(self):
         return ''
 
-    def html(self, **kwargs):
-        return self.renderer(**kwargs)
+    def iter_html(self, **kwargs):
+        yield self.renderer(**kwargs)
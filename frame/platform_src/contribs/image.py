@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+"""图片 hashkey 的批量解析
+
+hashkey 是 ``struct.pack(b'<32sII2s', 摘要, 宽, 高, 格式)`` 的
+urlsafe_b64encode, 56 个字符正好是 42 个字节, 没有补齐的 ``=``. 因此多个
+hashkey 连接起来可以一次解码, 再用一个 struct 一次拆开.
+
+图片地址到 hashkey 的转换在同一个请求中只做一次, 一个页面上的多篇文档,
+模板中的 resp_image, thumbnail_for 等共用.
+
+"""
+import re
+import base64
+import struct
+from functools import wraps
+
+from flask import g, request
+
+HASHKEY_LAYOUT = b'32sII2s'
+HASHKEY_SIZE = struct.calcsize(b'<' + HASHKEY_LAYOUT)
+FORMATS = {
+    'GI': 'GIF',
+    'PN': 'PNG',
+    'JP': 'JPEG'}
+# 一次拆开的 hashkey 数量, 每个数量的 struct 都会缓存
+CHUNK_SIZE = 64
+
+_HASHKEY = re.compile(r'[A-Za-z0-9_-]{56}\Z')
+_STRUCTS = {}
+
+
+def _struct(count):
+    try:
+        return _STRUCTS[count]
+    except KeyError:
+        s = _STRUCTS[count] = struct.Struct(b'<' + HASHKEY_LAYOUT * count)
+        return s
+
+
+def decode_hashkeys(hashkeys):
+    """批量解析 hashkey
+
+    :Returns
+        {hashkey: (宽, 高, 格式)}, 格式为 GIF, PNG 或 JPEG; 不合法的 hashkey
+        不在结果中
+
+    """
+    valid = [hashkey for hashkey in set(hashkeys)
+             if hashkey and _HASHKEY.match(hashkey)]
+    result = {}
+    for start in xrange(0, len(valid), CHUNK_SIZE):
+        chunk = valid[start:start + CHUNK_SIZE]
+        data = base64.urlsafe_b64decode(''.join(chunk).encode('ascii'))
+        fields = _struct(len(chunk)).unpack(data)
+        for i, hashkey in enumerate(chunk):
+            _, width, height, format_ = fields[i * 4:i * 4 + 4]
+            if format_ in FORMATS:
+                result[hashkey] = width, height, FORMATS[format_]
+    return result
+
+
+def decode_hashkey(hashkey):
+    """解析一个 hashkey, 给出 (宽, 高, 格式), 不合法时为 None"""
+    return decode_hashkeys([hashkey]).get(hashkey)
+
+
+def _request_cache(name):
+    """当前请求中名为 name 的 dict, 不在请求中时为 None"""
+    if not request:
+        return None
+    cache = getattr(g, name, None)
+    if cache is None:
+        cache = {}
+        setattr(g, name, cache)
+    return cache
+
+
+def url_hashkeys(urls, take_thumbnail=True):
+    """给出 {图片地址: hashkey}, 不是果壳的图片时 hashkey 为 None
+
+    同一个请求中每个地址只转换一次.
+
+    """
+    from guokr.platform.flask.helpers import url2hashkey
+    cache = _request_cache('_image_hashkeys')
+    if cache is None:
+        cache = {}
+    result = {}
+    for url in urls:
+        key = url, take_thumbnail
+        try:
+            result[url] = cache[key]
+        except KeyError:
+            result[url] = cache[key] = \
+                url2hashkey(url, take_thumbnail=take_thumbnail) or None
+    return result
+
+
+def image_metas(urls):
+    """给出 {图片地址: (hashkey, (宽, 高, 格式))}, 不是果壳的图片或者 hashkey
+    不合法时为 (None, None)"""
+    hashkeys = url_hashkeys(urls)
+    params = decode_hashkeys(hashkey for hashkey in hashkeys.itervalues()
+                             if hashkey)
+    result = {}
+    for url, hashkey in hashkeys.iteritems():
+        if hashkey in params:
+            result[url] = hashkey, params[hashkey]
+        else:
+            result[url] = None, None
+    return result
+
+
+def request_memoize(func):
+    """同一个请求中以相同的参数调用 func 时只计算一次
+
+    用于模板中反复以相同的图片调用的 resp_image, thumbnail_for 和 image_for.
+    参数不能作为 dict 的键时直接调用.
+
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = _request_cache('_image_memoized')
+        if cache is None:
+            return func(*args, **kwargs)
+        key = func, args, tuple(sorted(kwargs.iteritems()))
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = func(*args, **kwargs)
+            return value
+        except TypeError:
+            return func(*args, **kwargs)
+    return wrapper
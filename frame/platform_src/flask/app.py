@@ -149,12 +149,14 @@ class StudioFlask(Flask):
             from . import helpers
             from . import users
             from . import privileges
+            from ..contribs.image import request_memoize
             from random import choice
+            # 模板中同一张图片的地址每个请求只生成一次
             self.jinja_env.globals.update(
                 user_home=helpers.user_home,
-                resp_image=helpers.resp_image,
-                thumbnail_for=helpers.thumbnail_for,
-                image_for=helpers.image_for,
+                resp_image=request_memoize(helpers.resp_image),
+                thumbnail_for=request_memoize(helpers.thumbnail_for),
+                image_for=request_memoize(helpers.image_for),
                 static_file=helpers.static_file,
                 preload_user_meta=users.preload_user_meta,
                 user_meta=users.user_meta,
@@ -2,7 +2,8 @@
 from __future__ import unicode_literals
 """在 flask-sqlalchemy 上的定制扩展"""
 
-import random
+import time
+import itertools
 import contextlib
 import threading
 
@@ -10,7 +11,8 @@ from functools import partial
 
 from flask import g, request
 from flask.helpers import locked_cached_property
-from sqlalchemy import orm, sql, types, exc
+from sqlalchemy import orm, sql, types, exc, event, schema
+from sqlalchemy.sql import util as sql_util
 from sqlalchemy.util import OrderedDict, to_list
 from sqlalchemy.orm import attributes, loading
 from sqlalchemy.ext.compiler import compiles
@@ -22,9 +24,15 @@ from flask.ext import sqlalchemy as flask_sqlalchemy
 from . import types as custom_types
 from . import mutable as custom_mutable
 from . import hybrid as custom_hybrid
+from .cache import ModelCache, record_bulk_write
+from .replicas import Replica, ReplicaPool
 
 __all__ = ['SQLAlchemy']
 
+# batch_get 每条 SELECT 默认包含的主键数量
+BATCH_GET_CHUNK_SIZE = 500
+SQLITE_MAX_VARIABLES = 999
+
 
 def copy_inst(fromobj, tocls, keys, **extra_kw):
     kwargs = dict((key, getattr(fromobj, key)) for key in keys)
@@ -118,10 +126,14 @@ class PreserveDeleted(object):
 
 class _SignallingSessionMixin(object):
 
-    def get_bind(self, mapper, clause=None):
+    def get_bind(self, mapper, clause=None, max_staleness=None):
         # 增加 master/slave 支持
         # mapper is None if someone tries to just get a connection
 
+        if isinstance(clause, (sql.expression.Update, sql.expression.Delete)):
+            # 不知道修改了哪些行, 提交后整张表的二级缓存失效
+            record_bulk_write(self, clause.table)
+
         if mapper is not None:
             info = getattr(mapper.mapped_table, 'info', {})
             bind_key = info.get('bind_key')
@@ -131,10 +143,20 @@ class _SignallingSessionMixin(object):
 
         # 通过全局变量 _disable_db_slaves 来控制 slave 行为
         # 不在 request context 内的读操作一律使用主库
-        if g and not hasattr(g, 'disable_db_slaves') and \
-           isinstance(clause, sql.Select):
+        if g and isinstance(clause, sql.expression.UpdateBase):
+            # Query.update, Query.delete 等直接执行的写操作
+            _record_writes(self.app, [clause.table])
+        if g and not getattr(g, 'disable_db_slaves', False) and \
+           isinstance(clause, sql.Select) and \
+           not _reads_written_tables(self.app, clause):
+            # 最大延迟依次取自 query.max_staleness, db.max_staleness
+            # 和配置 SQLALCHEMY_MAX_STALENESS
+            if max_staleness is None:
+                max_staleness = getattr(g, 'db_max_staleness', None)
+            if max_staleness is None:
+                max_staleness = self.app.config['SQLALCHEMY_MAX_STALENESS']
             state = get_state(self.app)
-            return state.db.get_engine(self.app, bind='__slave__')
+            return state.db.get_replica_engine(self.app, max_staleness)
 
         return super(_SignallingSessionMixin, self).get_bind(mapper, clause)
 
@@ -151,14 +173,15 @@ class _SignallingSessionMixin(object):
 
 class _EngineConnectorMixin(object):
 
+    def __init__(self, *args, **kwargs):
+        super(_EngineConnectorMixin, self).__init__(*args, **kwargs)
+        self.replica_pool = None
+        self._replicas_loaded = False
+
     def get_uri(self):
-        if self._bind == '__slave__':
-            slaves = self._app.config.get(
-                'SQLALCHEMY_DATABASE_SLAVE_URIS') or ()
-            if slaves:
-                return random.choice(slaves)
-            else:
-                self._bind = None
+        if isinstance(self._bind, tuple):
+            # 从库池中的一个从库: ('__replica__', uri)
+            return self._bind[1]
         if self._bind is None:
             return self._app.config['SQLALCHEMY_DATABASE_URI']
         binds = self._app.config.get('SQLALCHEMY_BINDS') or ()
@@ -167,6 +190,51 @@ class _EngineConnectorMixin(object):
             'configuration variable' % self._bind
         return binds[self._bind]
 
+    def get_engine(self, max_staleness=None):
+        # __slave__ 每次都从从库池中选择, 没有合适的从库时使用主库
+        if self._bind != '__slave__':
+            return super(_EngineConnectorMixin, self).get_engine()
+        pool = self.get_replica_pool()
+        replica = pool.choose(max_staleness) if pool is not None else None
+        if replica is None:
+            return self._master_engine()
+        return replica.engine
+
+    def get_replica_pool(self):
+        """从库池, 没有配置从库时为 None"""
+        if self._replicas_loaded:
+            return self.replica_pool
+        with self._lock:
+            if not self._replicas_loaded:
+                config = self._app.config
+                replicas = []
+                for uri in config.get('SQLALCHEMY_DATABASE_SLAVE_URIS') or ():
+                    uri, weight = uri if isinstance(uri, (tuple, list)) \
+                        else (uri, 1)
+                    connector = self._sa.make_connector(
+                        self._app, ('__replica__', uri))
+                    replicas.append(
+                        Replica(uri, connector.get_engine(), weight))
+                if replicas:
+                    self.replica_pool = ReplicaPool(
+                        replicas,
+                        max_errors=config['SQLALCHEMY_REPLICA_MAX_ERRORS'],
+                        check_interval=config[
+                            'SQLALCHEMY_REPLICA_CHECK_INTERVAL'])
+                    self.replica_pool.start()
+                self._replicas_loaded = True
+            return self.replica_pool
+
+    def _master_engine(self):
+        # 可能在 SQLAlchemy.get_engine 的锁内, 不能再调用它; 并发时多建的
+        # connector 还没有 engine, 丢弃即可
+        connectors = get_state(self._app).connectors
+        connector = connectors.get(None)
+        if connector is None:
+            connector = connectors.setdefault(
+                None, self._sa.make_connector(self._app))
+        return connector.get_engine()
+
 
 @contextlib.contextmanager
 def disable_slaves():
@@ -178,12 +246,113 @@ def disable_slaves():
         g.disable_db_slaves = old
 
 
+@contextlib.contextmanager
+def max_staleness(seconds):
+    """在这个范围内只从复制延迟不超过 seconds 秒的从库读取"""
+    if g:
+        old = getattr(g, 'db_max_staleness', None)
+        g.db_max_staleness = seconds
+    try:
+        yield
+    finally:
+        if g:
+            g.db_max_staleness = old
+
+
+def _record_writes(app, tables):
+    """记录当前请求写过的表, 之后对这些表的读取使用主库
+
+    SQLALCHEMY_READ_YOUR_WRITES_WINDOW 大于 0 时, 同一用户在这么多秒内的
+    请求也读取主库. 按 SQLALCHEMY_READ_YOUR_WRITES_STORE 记录在 flask 的
+    session ('session') 或者以 request.ukey 区分的 Redis ('redis') 中.
+
+    """
+    names = set(table.fullname for table in tables)
+    written = getattr(g, 'db_written_tables', None)
+    if written is None:
+        written = g.db_written_tables = set()
+    names -= written
+    if not names:
+        return
+    written |= names
+
+    window = app.config['SQLALCHEMY_READ_YOUR_WRITES_WINDOW']
+    if not window:
+        return
+    now = time.time()
+    deadline = int(now + window)
+    if app.config['SQLALCHEMY_READ_YOUR_WRITES_STORE'] == 'redis':
+        ukey = getattr(request, 'ukey', None)
+        if ukey:
+            from frame.platform.engines import redis
+            key = 'db-written-tables:%s' % ukey
+            pipe = redis.pipeline(transaction=False)
+            for name in names:
+                pipe.hset(key, name, deadline)
+            pipe.expire(key, window)
+            pipe.execute()
+    else:
+        from flask import session
+        recent = dict((name, t) for name, t in
+                      (session.get('_db_written_tables') or {}).iteritems()
+                      if t > now)
+        recent.update(dict.fromkeys(names, deadline))
+        session['_db_written_tables'] = recent
+
+
+def _recent_writes(app):
+    """窗口内同一用户写过的表, 每个请求只读取一次"""
+    recent = getattr(g, 'db_recent_tables', None)
+    if recent is not None:
+        return recent
+    recent = {}
+    if app.config['SQLALCHEMY_READ_YOUR_WRITES_WINDOW']:
+        if app.config['SQLALCHEMY_READ_YOUR_WRITES_STORE'] == 'redis':
+            ukey = getattr(request, 'ukey', None)
+            if ukey:
+                from frame.platform.engines import redis
+                recent = redis.hgetall('db-written-tables:%s' % ukey) or {}
+        else:
+            from flask import session
+            recent = session.get('_db_written_tables') or {}
+    now = time.time()
+    recent = g.db_recent_tables = frozenset(
+        name for name, t in recent.iteritems() if int(t) > now)
+    return recent
+
+
+def _reads_written_tables(app, clause):
+    written = getattr(g, 'db_written_tables', None) or set()
+    written = written.union(_recent_writes(app))
+    if not written:
+        return False
+    return any(isinstance(table, schema.Table) and table.fullname in written
+               for table in sql_util.find_tables(clause, check_columns=True))
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _after_flush(session, flush_context):
+    app = getattr(session, 'app', None)
+    if app is None or not g:
+        return
+    tables = set()
+    for instance in itertools.chain(session.new, session.deleted):
+        tables.update(orm.object_mapper(instance).tables)
+    for instance in session.dirty:
+        if session.is_modified(instance, include_collections=False):
+            tables.update(orm.object_mapper(instance).tables)
+    if tables:
+        _record_writes(app, tables)
+
+
 def _include_custom(obj):
     for module in custom_types, custom_mutable, custom_hybrid:
         for key in module.__all__:
             if not hasattr(obj, key):
                 setattr(obj, key, getattr(module, key))
     obj.disable_slaves = disable_slaves
+    obj.max_staleness = max_staleness
+    obj.model_cache = ModelCache
     obj.current_ukey = current_ukey
     obj.set_current_ukey = set_current_ukey
 
@@ -197,6 +366,13 @@ class SQLAlchemyMixin(object):
     def init_app(self, app):
         # 增加 master/slaves 支持
         app.config.setdefault('SQLALCHEMY_DATABASE_SLAVE_URIS', None)
+        app.config.setdefault('SQLALCHEMY_BATCH_GET_CHUNK_SIZE',
+                              BATCH_GET_CHUNK_SIZE)
+        app.config.setdefault('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 5)
+        app.config.setdefault('SQLALCHEMY_REPLICA_MAX_ERRORS', 3)
+        app.config.setdefault('SQLALCHEMY_READ_YOUR_WRITES_WINDOW', 0)
+        app.config.setdefault('SQLALCHEMY_READ_YOUR_WRITES_STORE', 'session')
+        app.config.setdefault('SQLALCHEMY_MAX_STALENESS', None)
         config_binds = app.config.get('SQLALCHEMY_BINDS')
         if config_binds and '__slave__' in config_binds:
             raise KeyError('__slave__ is a reserved word.')
@@ -231,6 +407,33 @@ class SQLAlchemyMixin(object):
         """Creates the connector for a given state and bind."""
         return _EngineConnector(self, app, bind)
 
+    def get_replica_engine(self, app, max_staleness=None):
+        """选择一个从库的 engine, 延迟超过 max_staleness 秒的从库不选
+
+        每次读取都会调用, 只在第一次建立 connector 时加锁.
+
+        """
+        state = get_state(app)
+        connector = state.connectors.get('__slave__')
+        if connector is None:
+            with self._engine_lock:
+                connector = state.connectors.get('__slave__')
+                if connector is None:
+                    connector = state.connectors['__slave__'] = \
+                        self.make_connector(app, '__slave__')
+        return connector.get_engine(max_staleness)
+
+    def get_replica_pool(self, app=None):
+        """从库池, 没有配置从库时为 None"""
+        app = self.get_app(app)
+        self.get_engine(app, bind='__slave__')
+        return get_state(app).connectors['__slave__'].get_replica_pool()
+
+    def replica_stats(self, app=None):
+        """每个从库的权重, 健康状况, 平均延迟, 语句数和错误数"""
+        pool = self.get_replica_pool(app)
+        return pool.stats() if pool is not None else []
+
 
 class BaseQueryMixin(object):
 
@@ -261,14 +464,72 @@ class BaseQueryMixin(object):
             self.session.add(instance)
             return instance, True
 
-    def batch_get(self, *idents):
+    def max_staleness(self, seconds):
+        """只从复制延迟不超过 seconds 秒的从库读取, 没有时读取主库"""
+        return self.execution_options(max_staleness=seconds)
+
+    def _connection_from_session(self, **kw):
+        # 通过 session.connection 把最大延迟传给 get_bind
+        staleness = self._execution_options.get('max_staleness')
+        if staleness is not None:
+            kw['max_staleness'] = staleness
+        return super(BaseQueryMixin, self)._connection_from_session(**kw)
+
+    def get(self, ident):
+        # 启用了 db.model_cache 的模型经过二级缓存
+        mapper = self._only_full_mapper_zero('get')
+        if self._model_cache(mapper) is None:
+            return super(BaseQueryMixin, self).get(ident)
+        return self.batch_get(ident)[0]
+
+    # 支持 ``(a, b) IN ((1, 2), (3, 4))`` 的方言, 其余的用 OR 连接
+    row_value_in_dialects = ('postgresql', 'mysql')
+
+    def batch_get(self, *idents, **kwargs):
+        """按主键批量获取对象, 结果和 idents 一一对应, 不存在时为 None
+
+        Args:
+            chunk_size: 每条 SELECT 最多包含的主键数量, 默认为配置
+                        SQLALCHEMY_BATCH_GET_CHUNK_SIZE
+
+        """
+        return list(self.iter_batch_get(idents, **kwargs))
+
+    def iter_batch_get(self, idents, chunk_size=None):
+        """batch_get 的流式版本, 按 idents 的顺序逐个给出对象
+
+        idents 可以是任意可迭代对象, 每次只取出 chunk_size 个主键查询,
+        适合遍历大量的主键.
+
+        """
         mapper = self._only_full_mapper_zero('batch_get')
-        lazyload_idents = {}
-        or_list = []
+        chunk_size = self._batch_chunk_size(mapper, chunk_size)
+        idents = iter(idents)
+        while True:
+            chunk = list(itertools.islice(idents, chunk_size))
+            if not chunk:
+                break
+            for instance in self._batch_get_chunk(mapper, chunk):
+                yield instance
+
+    def _batch_chunk_size(self, mapper, chunk_size):
+        if chunk_size is None:
+            app = getattr(self.session, 'app', None)
+            chunk_size = app.config.get('SQLALCHEMY_BATCH_GET_CHUNK_SIZE') \
+                if app else None
+            chunk_size = chunk_size or BATCH_GET_CHUNK_SIZE
+        if self.session.get_bind(mapper).dialect.name == 'sqlite':
+            # sqlite 一条语句最多 999 个参数
+            chunk_size = min(chunk_size,
+                             SQLITE_MAX_VARIABLES // len(mapper.primary_key))
+        return max(chunk_size, 1)
+
+    def _batch_get_chunk(self, mapper, idents):
+        lazyload_idents = OrderedDict()
         return_list = [None] * len(idents)
         for idx, ident in enumerate(idents):
             if hasattr(ident, '__composite_values__'):
-                ident = ident.__coposite_values__()
+                ident = ident.__composite_values__()
             ident = to_list(ident)
             if len(ident) != len(mapper.primary_key):
                 raise exc.InvalidRequestError(
@@ -293,19 +554,49 @@ class BaseQueryMixin(object):
                     continue
 
             lazyload_idents.setdefault(key[1], []).append(idx)
-            and_list = [col == ide for col, ide in
-                        zip(mapper.primary_key, ident)]
-            or_list.append(sql.and_(*and_list))
 
-        if or_list:
+        cache = self._model_cache(mapper) if lazyload_idents else None
+        if cache is not None:
+            # 从二级缓存中构造对象
+            for pk, values in cache.get_many(lazyload_idents.keys()) \
+                    .iteritems():
+                instance = cache.instance(self.session, values)
+                for idx in lazyload_idents.pop(pk):
+                    return_list[idx] = instance
+
+        if lazyload_idents:
             # 加载未缓存对象到 return_list 中
-            for instance in self.filter(sql.or_(*or_list)):
+            clause = self._batch_get_clause(mapper, lazyload_idents.keys())
+            loaded = []
+            for instance in self.filter(clause):
                 ident = mapper.primary_key_from_instance(instance)
-                for idx in lazyload_idents[tuple(ident)]:
+                for idx in lazyload_idents.get(tuple(ident), ()):
                     return_list[idx] = instance
+                loaded.append(instance)
+            if cache is not None:
+                cache.set_many(loaded)
 
         return return_list
 
+    def _model_cache(self, mapper):
+        """模型启用了 db.model_cache, 并且查询没有附加条件时给出缓存"""
+        cache = getattr(mapper.class_, '__model_cache__', None)
+        if cache is None or cache.class_ is not mapper.class_ or \
+                self._criterion is not None or self._with_options or \
+                self._lockmode is not None or self._populate_existing:
+            return None
+        return cache
+
+    def _batch_get_clause(self, mapper, idents):
+        pk = mapper.primary_key
+        if len(pk) == 1:
+            return pk[0].in_([ident[0] for ident in idents])
+        dialect = self.session.get_bind(mapper).dialect
+        if dialect.name in self.row_value_in_dialects:
+            return sql.tuple_(*pk).in_(idents)
+        return sql.or_(*[sql.and_(*[col == v for col, v in zip(pk, ident)])
+                         for ident in idents])
+
 _SignallingSession = type(_SignallingSession.__name__,
                           (_SignallingSessionMixin, _SignallingSession), {})
 _EngineConnector = type(_EngineConnector.__name__,
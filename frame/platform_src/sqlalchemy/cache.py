@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+"""按主键的二级缓存
+
+Query.get 和 Query.batch_get 在 identity map 之后依次查找:
+
+* 进程内的 LRU, 有数量上限, 条目只保留 lru_expire 秒, 以限制其它进程
+  修改后本进程读到旧数据的时间
+* Redis, 通过 frame.platform.engines.redis 访问, 保存 pickle 后的列值元组
+
+都没有命中时查询数据库并写入缓存. 只缓存没有附加条件, options 和锁的
+查询. session 提交后 (after_commit), flush 中插入, 修改和删除的对象失效,
+包括 PreserveDeleted 写入和删除的 _deleted 表中的行.
+
+通过 session 执行的 UPDATE 和 DELETE 语句 (Query.update, Query.delete,
+session.execute(table.update()) 等) 不知道修改了哪些行, 提交后整张表的
+缓存失效: 缓存键中含有表的版本, 提交时把版本改为当前时间. 其它进程在
+lru_expire 秒内还会使用旧的版本. 文本形式的 SQL 和不经过 session 执行的
+语句无法识别, 需要自行调用 Model.__model_cache__.invalidate_all().
+
+未命中的对象可能是从有延迟的从库读到的, 也可能在提交之前就读出了旧数据.
+因此失效时不是删除, 而是写入保留 tombstone_expire 秒的墓碑, 写入缓存时
+使用 SETNX, 墓碑存在期间读到的旧数据不会写回缓存. 同样, 表的版本改变后
+tombstone_expire 秒内不写入缓存.
+
+:Usage
+
+    @db.model_cache(expire=3600)
+    class ChannelModel(db.Model):
+        ...
+
+    ChannelModel.query.get(1)
+    ChannelModel.__model_cache__.stats()
+
+"""
+
+import time
+import hashlib
+import threading
+import itertools
+import cPickle as pickle
+from collections import OrderedDict
+
+from sqlalchemy import orm, event
+from sqlalchemy.util import memoized_property
+from sqlalchemy.orm import attributes
+
+__all__ = ['ModelCache', 'model_cache_stats']
+
+# 失效后占住缓存键的值
+TOMBSTONE = b'-'
+
+# 所有模型的缓存, 用于 model_cache_stats
+_caches = []
+
+
+class ModelCache(object):
+
+    def __init__(self, expire=3600, lru_size=1024, lru_expire=5,
+                 tombstone_expire=30, key_prefix='db-cache:'):
+        self.expire = expire
+        self.tombstone_expire = tombstone_expire
+        self.lru_size = lru_size
+        self.lru_expire = lru_expire
+        self.key_prefix = key_prefix
+        self.lock = threading.Lock()
+        self.lru = OrderedDict()
+        # (表的版本, 从 Redis 读取的时间)
+        self._generation = None, 0
+        self.class_ = None
+        self.counters = {'hits': 0, 'lru_hits': 0, 'misses': 0,
+                         'invalidations': 0}
+
+    def __call__(self, class_):
+        self.class_ = class_
+        class_.__model_cache__ = self
+        _caches.append(self)
+        # PreserveDeleted 的归档表使用同样的设置
+        deleted = getattr(class_, 'deleted', None)
+        if deleted is not None and \
+                getattr(deleted, '__model_cache__', None) is None:
+            ModelCache(self.expire, self.lru_size, self.lru_expire,
+                       self.tombstone_expire, self.key_prefix)(deleted)
+        return class_
+
+    @property
+    def redis(self):
+        from frame.platform.engines import redis
+        return redis
+
+    @memoized_property
+    def mapper(self):
+        return orm.class_mapper(self.class_)
+
+    @memoized_property
+    def _keys(self):
+        return [prop.key for prop in self.mapper.column_attrs]
+
+    @memoized_property
+    def _pk_keys(self):
+        return [self.mapper.get_property_by_column(col).key
+                for col in self.mapper.primary_key]
+
+    @memoized_property
+    def _key_prefix(self):
+        # 列改动后版本随之改变, 旧的缓存自然失效
+        digest = hashlib.sha1(repr([
+            (prop.key, [unicode(col.type) for col in prop.columns])
+            for prop in self.mapper.column_attrs]))
+        return '%s%s:%s:' % (self.key_prefix, self.mapper.mapped_table.name,
+                             digest.hexdigest()[:8])
+
+    @memoized_property
+    def _generation_key(self):
+        return '%sgeneration:%s' % (self.key_prefix,
+                                    self.mapper.mapped_table.name)
+
+    def generation(self):
+        """表的版本, 即最近一次 invalidate_all 的时间, 没有时为 '0'
+
+        在进程内保留 lru_expire 秒.
+
+        """
+        now = time.time()
+        with self.lock:
+            generation, checked = self._generation
+        if generation is None or now - checked >= self.lru_expire:
+            generation = self.redis.get(self._generation_key) or b'0'
+            generation = generation.decode('ascii')
+            with self.lock:
+                self._generation = generation, now
+        return generation
+
+    def key(self, pk, generation=None):
+        if generation is None:
+            generation = self.generation()
+        return '%s%s:%s' % (self._key_prefix, generation,
+                            ':'.join(unicode(v) for v in pk))
+
+    def stats(self):
+        """给出 hits (其中命中 LRU 的 lru_hits), misses 和 invalidations"""
+        with self.lock:
+            return dict(self.counters)
+
+    def get_many(self, pks):
+        """给出 {主键: 列值元组}, 不在缓存中的主键不在结果中"""
+        generation = self.generation()
+        keys = [self.key(pk, generation) for pk in pks]
+        result = {}
+        missing = []
+        now = time.time()
+        with self.lock:
+            for pk, key in itertools.izip(pks, keys):
+                item = self.lru.pop(key, None)
+                if item is not None and item[1] > now:
+                    self.lru[key] = item
+                    result[pk] = item[0]
+                else:
+                    missing.append((pk, key))
+        lru_hits = len(result)
+        if missing:
+            for (pk, key), data in itertools.izip(
+                    missing, self.redis.mget([key for _, key in missing])):
+                if data is not None and data != TOMBSTONE:
+                    result[pk] = values = pickle.loads(data)
+                    self._set_lru(key, values)
+        with self.lock:
+            self.counters['hits'] += len(result)
+            self.counters['lru_hits'] += lru_hits
+            self.counters['misses'] += len(pks) - len(result)
+        return result
+
+    def _set_lru(self, key, values):
+        if self.lru_size <= 0:
+            return
+        with self.lock:
+            self.lru.pop(key, None)
+            self.lru[key] = values, time.time() + self.lru_expire
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def set_many(self, instances):
+        """写入从数据库加载的对象, 有未加载的列 (比如 deferred) 时跳过
+
+        键已存在 (包括失效后的墓碑) 时不写入, 本进程的 LRU 也不写入.
+        SETNX 之后再对写入成功的键设置过期时间, 以免延长墓碑的过期时间.
+        表的版本改变后 tombstone_expire 秒内不写入.
+
+        """
+        generation = self.generation()
+        if time.time() - float(generation) < self.tombstone_expire:
+            return
+        items = []
+        for instance in instances:
+            dict_ = attributes.instance_dict(instance)
+            if all(key in dict_ for key in self._keys):
+                values = tuple(dict_[key] for key in self._keys)
+                pk = [dict_[key] for key in self._pk_keys]
+                items.append((self.key(pk, generation), values))
+        if not items:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for key, values in items:
+            pipe.setnx(key, pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+        stored = [(key, values) for (key, values), ok in
+                  itertools.izip(items, pipe.execute()) if ok]
+        if not stored:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for key, values in stored:
+            pipe.expire(key, self.expire)
+            self._set_lru(key, values)
+        pipe.execute()
+
+    def invalidate_many(self, pks):
+        generation = self.generation()
+        keys = [self.key(pk, generation) for pk in pks]
+        with self.lock:
+            for key in keys:
+                self.lru.pop(key, None)
+            self.counters['invalidations'] += len(keys)
+        if keys:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.setex(key, TOMBSTONE, self.tombstone_expire)
+            pipe.execute()
+
+    def invalidate_all(self):
+        """整张表的缓存失效, 用于不经过 session 或者文本形式的 SQL 的修改"""
+        generation = '%.6f' % time.time()
+        # 旧版本的缓存都过期之后, 版本才可以回到 '0'
+        self.redis.setex(self._generation_key, generation.encode('ascii'),
+                         self.expire + self.tombstone_expire)
+        with self.lock:
+            self._generation = generation, time.time()
+            self.lru.clear()
+            self.counters['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+
+    def instance(self, session, values):
+        """由缓存的列值构造 session 中的 persistent 对象, 不查询数据库"""
+        mapper = self.mapper
+        instance = mapper.class_manager.new_instance()
+        state = attributes.instance_state(instance)
+        # 直接写入 dict, 不经过属性事件, 对象不会被标记为修改过
+        state.dict.update(itertools.izip(self._keys, values))
+        state.key = mapper.identity_key_from_primary_key(
+            [state.dict[key] for key in self._pk_keys])
+        session.add(instance)
+        state.manager.dispatch.load(state, None)
+        return instance
+
+
+def model_cache_stats():
+    """给出 {表名: 计数}"""
+    return dict((cache.mapper.mapped_table.name, cache.stats())
+                for cache in _caches)
+
+
+def record_bulk_write(session, table):
+    """session 中执行了修改 table 的 UPDATE 或 DELETE 语句, 提交后
+    table 上的缓存全部失效"""
+    session.__dict__.setdefault('_model_cache_tables', set()).add(table)
+
+
+def _cache_of(instance):
+    cache = getattr(type(instance), '__model_cache__', None)
+    if cache is not None and cache.class_ is type(instance):
+        return cache
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _after_flush(session, flush_context):
+    # 此时 new, dirty 和 deleted 还是 flush 之前的状态, 新对象已有主键
+    pending = None
+    for instance in itertools.chain(session.new, session.dirty,
+                                    session.deleted):
+        cache = _cache_of(instance)
+        if cache is not None:
+            if pending is None:
+                pending = session.__dict__.setdefault(
+                    '_model_cache_pending', set())
+            pk = cache.mapper.primary_key_from_instance(instance)
+            pending.add((cache, tuple(pk)))
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _after_commit(session):
+    tables = session.__dict__.get('_model_cache_tables')
+    if tables:
+        for cache in _caches:
+            if cache.mapper.mapped_table in tables:
+                cache.invalidate_all()
+        if not session.transaction.nested:
+            tables.clear()
+    pending = session.__dict__.get('_model_cache_pending')
+    if not pending:
+        return
+    grouped = {}
+    for cache, pk in pending:
+        grouped.setdefault(cache, []).append(pk)
+    for cache, pks in grouped.iteritems():
+        cache.invalidate_many(pks)
+    # savepoint 提交后外层事务的提交仍需要再次失效
+    if not session.transaction.nested:
+        pending.clear()
+
+
+@event.listens_for(orm.Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    # savepoint 回滚时保留, 外层提交时多失效一些无妨
+    if not previous_transaction.nested:
+        session.__dict__.pop('_model_cache_pending', None)
+        session.__dict__.pop('_model_cache_tables', None)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+"""从库池
+
+SQLALCHEMY_DATABASE_SLAVE_URIS 中的每个从库一个 engine, 每次读取时选择:
+
+* 按权重随机取两个健康的从库, 选其中平均延迟 / 权重较小的一个; 从库
+  可以写成 ``(uri, 权重)``, 默认权重为 1
+* 连续 max_errors 次 OperationalError 的从库被摘除, 后台线程每隔
+  check_interval 秒对所有从库执行 ``SELECT 1``, 成功后恢复
+* 没有健康的从库时使用主库
+* 指定了最大延迟 (query.max_staleness 或者 db.max_staleness) 时, 只选择
+  复制延迟不超过它的从库, 都超过时使用主库
+
+复制延迟由检查的后台线程顺便取得, 不在每次读取时查询; 没有对应查询的
+数据库 (见 ReplicaPool.lag_queries), 以及超过 3 个检查周期没有更新的延迟
+视为未知, 不满足任何最大延迟. PostgreSQL 的延迟是最后重放的事务到现在的
+时间, 主库一段时间没有写入时也会增大.
+
+语句耗时是指数移动平均, 和延迟一起通过 db.replica_stats() 查看.
+
+"""
+
+import time
+import random
+import logging
+import threading
+
+from sqlalchemy import event, sql
+from sqlalchemy.engine.url import make_url
+
+__all__ = ['Replica', 'ReplicaPool']
+
+logger = logging.getLogger(__name__)
+
+
+def _is_probe(context):
+    return context is not None and \
+        context.execution_options.get('replica_probe', False)
+
+
+class Replica(object):
+
+    # 延迟的指数移动平均中新样本的比重
+    alpha = 0.2
+
+    def __init__(self, uri, engine, weight=1):
+        self.uri = uri
+        self.engine = engine
+        self.weight = weight
+        self.latency = 0.0
+        self.queries = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.healthy = True
+        self.last_error = None
+        self.lag = None
+        self.lag_sampled_at = None
+
+    @property
+    def score(self):
+        return self.latency / self.weight
+
+    def record(self, elapsed):
+        self.queries += 1
+        self.consecutive_errors = 0
+        if self.queries == 1:
+            self.latency = elapsed
+        else:
+            self.latency += (elapsed - self.latency) * self.alpha
+
+    def within(self, max_staleness, now, max_age=None):
+        """复制延迟已知并且不超过 max_staleness 秒"""
+        if self.lag is None:
+            return False
+        if max_age and now - self.lag_sampled_at > max_age:
+            return False
+        return self.lag <= max_staleness
+
+    def record_error(self, error):
+        self.errors += 1
+        self.consecutive_errors += 1
+        self.last_error = '%s: %s' % (type(error).__name__, error)
+
+    def stats(self):
+        return {
+            'uri': repr(make_url(self.uri)),
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'latency_ms': self.latency * 1000,
+            'queries': self.queries,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'lag': self.lag,
+        }
+
+
+class ReplicaPool(object):
+
+    # 查询复制延迟 (秒) 的语句, 结果为 NULL 时延迟未知
+    lag_queries = {
+        'postgresql': 'SELECT CASE WHEN pg_is_in_recovery() THEN '
+                      'EXTRACT(EPOCH FROM now() - '
+                      'pg_last_xact_replay_timestamp()) ELSE 0 END',
+    }
+
+    def __init__(self, replicas, max_errors=3, check_interval=5):
+        self.replicas = replicas
+        self.max_errors = max_errors
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        for replica in replicas:
+            self._instrument(replica)
+
+    def _instrument(self, replica):
+        """通过 engine 的事件统计每条语句的耗时和错误, 不包括 check 的语句"""
+        engine = replica.engine
+        operational_error = getattr(engine.dialect.dbapi,
+                                    'OperationalError', ())
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before(conn, cursor, statement, parameters, context, many):
+            if _is_probe(context):
+                return
+            conn.info.setdefault('replica_query_start', []) \
+                .append(time.time())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after(conn, cursor, statement, parameters, context, many):
+            if _is_probe(context):
+                return
+            start = conn.info['replica_query_start'].pop()
+            with self.lock:
+                replica.record(time.time() - start)
+
+        @event.listens_for(engine, 'dbapi_error')
+        def error(conn, cursor, statement, parameters, context, exception):
+            if _is_probe(context):
+                return
+            starts = conn.info.get('replica_query_start')
+            if starts:
+                starts.pop()
+            # 只有连接断开, 超时一类的错误才计入摘除的次数
+            if isinstance(exception, operational_error):
+                self.failed(replica, exception)
+
+    def failed(self, replica, error):
+        with self.lock:
+            replica.record_error(error)
+            if replica.healthy and \
+                    replica.consecutive_errors >= self.max_errors:
+                replica.healthy = False
+                logger.warning('replica %s ejected: %s',
+                               repr(make_url(replica.uri)), error)
+
+    def choose(self, max_staleness=None):
+        """选择一个从库, 都不健康或者延迟都超过 max_staleness 秒时为 None"""
+        healthy = [r for r in self.replicas if r.healthy]
+        if max_staleness is not None:
+            now = time.time()
+            max_age = self.check_interval * 3
+            healthy = [r for r in healthy
+                       if r.within(max_staleness, now, max_age)]
+        if len(healthy) <= 1:
+            return healthy[0] if healthy else None
+        total = sum(r.weight for r in healthy)
+        candidates = []
+        for _ in range(2):
+            point = random.uniform(0, total)
+            for replica in healthy:
+                point -= replica.weight
+                if point <= 0:
+                    break
+            candidates.append(replica)
+        return min(candidates, key=lambda r: r.score)
+
+    def check(self):
+        """对所有从库执行 ``SELECT 1`` 或者查询延迟, 失败时摘除, 成功时恢复
+
+        这些语句带有 replica_probe 的执行选项, 不计入语句耗时和错误次数.
+
+        """
+        for replica in self.replicas:
+            query = self.lag_queries.get(replica.engine.dialect.name)
+            try:
+                conn = replica.engine.connect()
+                try:
+                    probe = conn.execution_options(replica_probe=True)
+                    lag = probe.scalar(sql.text(query) if query else
+                                       sql.select([sql.literal(1)]))
+                finally:
+                    conn.close()
+            except Exception as e:
+                with self.lock:
+                    replica.record_error(e)
+                    replica.healthy = False
+            else:
+                with self.lock:
+                    if not replica.healthy:
+                        logger.info('replica %s recovered',
+                                    repr(make_url(replica.uri)))
+                    replica.healthy = True
+                    if query:
+                        replica.lag = float(lag) if lag is not None else None
+                        replica.lag_sampled_at = time.time()
+
+    def start(self):
+        """启动定期检查的后台线程, check_interval 为 0 时不检查"""
+        if self.check_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='replica-check')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception('replica check failed')
+
+    def stats(self):
+        with self.lock:
+            return [replica.stats() for replica in self.replicas]
@@ -0,0 +1,746 @@
+# -*- coding: utf-8 -*-
+"""frame.platform.contribs.bbcode 的性能测试
+
+不会被测试框架自动收集, 需要单独运行::
+
+    python -m frame.platform.tests.bench_bbcode
+    python -m frame.platform.tests.bench_bbcode suite --json result.json
+    python -m frame.platform.tests.bench_bbcode compare old.json new.json
+
+"""
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+import random
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from frame.platform.contribs import bbcode
+from frame.platform.contribs.bbcode import core
+
+
+def nested_content(depth=64, repeat=20):
+    """交替嵌套的 [ul]/[quote], 每层都带有若干行文本"""
+    lines = 'item\n[b]bold[/b] @nickname http://guokr.com/\n'
+    source = ''
+    for level in range(depth):
+        tagname = 'ul' if level % 2 else 'quote'
+        source = '[%s]%s%s[/%s]' % (tagname, lines, source, tagname)
+    return source * repeat
+
+
+def long_article(size=1024 * 1024):
+    """约 size 个字符的长文章, 包含段落, 列表, 表格, 链接和 @"""
+    paragraph = (
+        '[b]果壳网[/b]是一个开放, 多元的[i]泛科技兴趣社区[/i], '
+        '详见 http://www.guokr.com/ 或者问问 @果壳网孙小年\n'
+        '[quote]引用的内容 [color=red]红色[/color][/quote]\n'
+        '[ul]第一项\n第二项 [url=http://guo.kr]链接[/url]\n[/ul]\n'
+        '[table][tr][td]1[/td][td]2[/td][/tr][/table]\n')
+    return paragraph * (size / len(paragraph) + 1)
+
+
+class CountNODES(object):
+    """统计 BaseNode.NODES 被调用 (即复制注册表) 的次数"""
+
+    def __enter__(self):
+        self.count = 0
+        self.origin = core.BaseNode.__dict__['NODES']
+        origin = self.origin.__func__
+
+        def NODES(cls, BASE_NODES):
+            self.count += 1
+            return origin(cls, BASE_NODES)
+
+        core.BaseNode.NODES = classmethod(NODES)
+        return self
+
+    def __exit__(self, *exc_info):
+        core.BaseNode.NODES = self.origin
+
+
+def bench_allowed_nodes(number=20):
+    """嵌套内容解析时复制注册表的次数, 以及解析耗时"""
+    source = nested_content()
+    core._ALLOWED_NODES.clear()
+    with CountNODES() as cold:
+        bbcode.BBCode(source).nodes
+    with CountNODES() as warm:
+        start = time.time()
+        for _ in range(number):
+            bbcode.BBCode(source).nodes
+        elapsed = (time.time() - start) / number
+    print('nested [ul]/[quote]: %d chars' % len(source))
+    print('  registry copies, first parse: %d' % cold.count)
+    print('  registry copies, later parses: %d' % (warm.count / number))
+    print('  parse: %.2f ms' % (elapsed * 1000))
+
+
+def peak_memory(func, *args):
+    """在子进程中执行 func, 给出子进程的内存峰值 (KB)"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        func(*args)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wfd, str(maxrss))
+        os._exit(0)
+    os.close(wfd)
+    maxrss = int(os.read(rfd, 64))
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return maxrss
+
+
+def bench_streaming(size=1024 * 1024):
+    """html() 与逐段输出 iter_html() 的内存峰值"""
+    source = long_article(size)
+
+    def parse():
+        bbcode.BBCode(source).nodes
+
+    def render():
+        bbcode.BBCode(source).nodes.html()
+
+    def stream():
+        with open(os.devnull, 'wb') as fp:
+            for fragment in bbcode.BBCode(source).nodes.iter_html():
+                fp.write(fragment.encode('U8'))
+
+    parsed = peak_memory(parse)
+    print('long article: %d chars' % len(source))
+    print('  peak memory, parse only: %d KB' % parsed)
+    print('  peak memory, html(): %+d KB' % (peak_memory(render) - parsed))
+    print('  peak memory, iter_html(): %+d KB' % (peak_memory(stream) - parsed))
+
+
+def count_nodes(node):
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+
+def bench_nodes(size=1024 * 1024, lines=100000):
+    """每个节点的内存占用, 以及长文章和长纯文本的渲染耗时"""
+    source = long_article(size)
+
+    def parse():
+        bbcode.BBCode(source).nodes
+
+    # 先于其它解析测量, 以免子进程复用父进程已经释放的内存
+    parsed = peak_memory(parse) - peak_memory(lambda: None)
+    nodes = count_nodes(bbcode.BBCode(source).nodes)
+    plain = core.PlainNode('x', start=0)
+    size = sys.getsizeof(plain)
+    if hasattr(plain, '__dict__'):
+        size += sys.getsizeof(plain.__dict__)
+    print('long article: %d chars, %d nodes' % (len(source), nodes))
+    print('  peak memory per node: %d bytes' % (parsed * 1024 / nodes))
+    print('  PlainNode instance: %d bytes' % size)
+
+    top = bbcode.BBCode(source).nodes
+    start = time.time()
+    top.html()
+    print('  html(): %.2f ms' % ((time.time() - start) * 1000))
+
+    # 纯文本的每一行都是同一层的兄弟节点, 换行的处理要找前一个兄弟节点
+    top = bbcode.BBCode('line\n' * lines).nodes
+    start = time.time()
+    top.html()
+    print('%d plain lines' % lines)
+    print('  html(): %.2f ms' % ((time.time() - start) * 1000))
+
+
+def bench_text(size=1024 * 1024):
+    """text() 与不创建节点的 plain_text() 的耗时"""
+    source = long_article(size)
+    start = time.time()
+    bbcode.BBCode(source).text()
+    full = time.time() - start
+    start = time.time()
+    bbcode.BBCode(source).plain_text()
+    fast = time.time() - start
+    start = time.time()
+    bbcode.BBCode(source).plain_text(max_chars=200)
+    excerpt = time.time() - start
+    print('long article: %d chars' % len(source))
+    print('  text(): %.2f ms' % (full * 1000))
+    print('  plain_text(): %.2f ms (%.1fx)' % (fast * 1000, full / fast))
+    print('  plain_text(max_chars=200): %.2f ms' % (excerpt * 1000))
+
+
+def bench_excerpt(n=200, number=20):
+    """excerpt(n) 的耗时只取决于 n, 与文章长度无关"""
+    for size in (4 * 1024, 64 * 1024, 1024 * 1024):
+        source = long_article(size)
+        start = time.time()
+        for _ in range(number):
+            bbcode.cache.render_cache.clear()
+            bbcode.BBCode(source).excerpt(n)
+        elapsed = (time.time() - start) / number
+        print('excerpt(%d) of %d chars: %.2f ms' % (
+            n, len(source), elapsed * 1000))
+
+
+def bench_video(number=2000):
+    """按顺序尝试所有 adapter 与按域名查找 adapter 的耗时"""
+    from frame.platform.contribs.bbcode import video
+    urls = ['http://www.bilibili.tv/video/av123/index_2',
+            'http://a.video.qiyi.com/x',
+            'http://v.youku.com/v_show/id_XNDg1NzIzNjYw.html',
+            'http://example.com/not-a-video']
+    adapters = video.VideoNode.adapters
+
+    def sequential(url):
+        for adapter in adapters:
+            try:
+                return adapter(url)
+            except video.URLNotMatch:
+                continue
+
+    def indexed(url):
+        for adapter in video.adapters_for(adapters, url):
+            try:
+                return adapter(url)
+            except video.URLNotMatch:
+                continue
+
+    for func in (sequential, indexed):
+        start = time.time()
+        for _ in range(number):
+            for url in urls:
+                func(url)
+        print('%s adapters: %.2f us per URL' % (
+            func.__name__, (time.time() - start) * 1e6 / number / len(urls)))
+
+
+def bench_image_meta(images=2000, distinct=300, number=20):
+    """一个图片很多的页面: 逐个与批量解析 hashkey 的耗时"""
+    import base64
+    import struct
+    from frame.platform.contribs import image
+    rng = random.Random(0)
+    keys = [base64.urlsafe_b64encode(struct.pack(
+        b'<32sII2s', os.urandom(32), rng.randint(1, 2000),
+        rng.randint(1, 2000), b'JP')).decode('ascii')
+        for _ in range(distinct)]
+    hashkeys = [rng.choice(keys) for _ in range(images)]
+
+    def one_by_one():
+        return [image.decode_hashkey(hashkey) for hashkey in hashkeys]
+
+    def batch():
+        return image.decode_hashkeys(hashkeys)
+
+    for func in (one_by_one, batch):
+        start = time.time()
+        for _ in range(number):
+            func()
+        print('%s: %.2f ms for %d images' % (
+            func.__name__, (time.time() - start) * 1000 / number, images))
+
+
+# 恶意输入的片段, 每一种重复 n 次
+HOSTILE_PIECES = {
+    'unclosed tags': '[ul][ol]',
+    'brackets': '[',
+    'unclosed values': '[b=',
+    'unclosed quotes': '[url="x',
+    'closers': '[/b]',
+    'word runs': 'a',
+    'dotted runs': 'a.',
+    'mentions': '@',
+    'spaces': '[   ',
+    'escapes': '[color=\\',
+}
+
+
+def hostile_fuzz(n, seed=0):
+    """随机拼接恶意片段和普通的标签"""
+    rng = random.Random(seed)
+    pieces = HOSTILE_PIECES.values() + ['[b]', '[/b]', '[quote]', '\n',
+                                        'http://', 'x@y.cn']
+    return ''.join(rng.choice(pieces) for _ in range(n))
+
+
+def bench_hostile(size=16 * 1024, steps=3):
+    """恶意输入的解析耗时, 长度每增加一倍, 耗时也应当只增加约一倍"""
+    cases = sorted(HOSTILE_PIECES.items())
+    cases.append(('random', None))
+    for name, piece in cases:
+        timings = []
+        for step in range(steps):
+            n = size << step
+            if piece is None:
+                source = hostile_fuzz(n / 4)
+            else:
+                source = piece * (n / len(piece))
+            start = time.time()
+            bbcode.BBCode(source).nodes
+            timings.append((len(source), time.time() - start))
+        print('%s:' % name)
+        for i, (length, elapsed) in enumerate(timings):
+            ratio = elapsed / timings[i - 1][1] if i and timings[i - 1][1] else 0
+            print('  %8d chars: %8.2f ms%s' % (
+                length, elapsed * 1000, ' (x%.1f)' % ratio if i else ''))
+
+    source = hostile_fuzz(size * 4)
+    start = time.time()
+    bb = bbcode.BBCode(source, max_nodes=1000, timeout=0.05)
+    bb.nodes
+    print('random with budgets: %d chars, %.2f ms, degraded: %s' % (
+        len(source), (time.time() - start) * 1000, bb.degraded))
+
+
+def bench_ast(size=256 * 1024, number=5):
+    """从持久化的 AST 载入与重新解析的耗时"""
+    source = long_article(size)
+    ast = bbcode.BBCode(source).to_ast()
+
+    start = time.time()
+    for _ in range(number):
+        bbcode.BBCode(source).nodes
+    parse = (time.time() - start) / number
+
+    start = time.time()
+    for _ in range(number):
+        bbcode.BBCode.from_ast(source, ast).nodes
+    load = (time.time() - start) / number
+
+    print('long article: %d chars, AST %d bytes' % (len(source), len(ast)))
+    print('  parse: %.2f ms' % (parse * 1000))
+    print('  from_ast: %.2f ms (%.1fx)' % (load * 1000, parse / load))
+
+
+def bench_filter(number=20):
+    """filter() 的耗时只取决于各级选择器匹配的节点数量, 与文章长度无关"""
+    tail = '[math]x^2[/math] [ul]\n[url=http://guo.kr]a[/url]\n[/ul]'
+    for size in (4 * 1024, 64 * 1024, 1024 * 1024):
+        # 文章本身不含 [math] 和 [ul], 只有结尾的几个节点会匹配
+        source = long_article(size).replace('[ul]', '[quote]').replace(
+            '[/ul]', '[/quote]') + tail
+        bb = bbcode.BBCode(source)
+        bb.nodes
+        print('%d chars:' % len(source))
+        for selector in ('math', 'ul url'):
+            start = time.time()
+            for _ in range(number):
+                bb.nodes._filter(core.parse_selector(selector)[0])
+            walk = (time.time() - start) / number
+            start = time.time()
+            for _ in range(number):
+                bb.filter(selector)
+            indexed = (time.time() - start) / number
+            print('  %s: tree walk %.2f ms, indexed %.3f ms' % (
+                selector, walk * 1000, indexed * 1000))
+
+
+def bench_render_context(replies=200, number=5):
+    """一个请求中渲染大量 @ 和公式时, 使用与不使用 RenderContext 的耗时"""
+    from flask import Flask
+    from frame.platform.contribs.bbcode import tags
+    rng = random.Random(0)
+    sources = [' '.join('@%s [math]x^%d[/math]' % (
+        _cjk(rng, 4), rng.randint(1, 9)) for _ in range(10))
+        for _ in range(replies)]
+    app = Flask(__name__)
+    app.add_url_rule('/formula/<hashed>.<format>', 'image:formula')
+    app.add_url_rule('/i/<nickname>/', 'community:profile.nickname_redirect')
+    render_context = tags.render_context
+    for name, func in (('without', lambda: None), ('with', render_context)):
+        tags.render_context = func
+        try:
+            elapsed = 0
+            for _ in range(number):
+                bbcodes = [bbcode.BBCode(source) for source in sources]
+                for bb in bbcodes:
+                    bb.nodes
+                with app.test_request_context('/', headers={
+                        'User-Agent': 'Mozilla/5.0 Firefox/20.0'}):
+                    start = time.time()
+                    for bb in bbcodes:
+                        bb.nodes.html()
+                    elapsed += time.time() - start
+        finally:
+            tags.render_context = render_context
+        print('%d replies, %s render context: %.2f ms' % (
+            replies, name, elapsed / number * 1000))
+
+
+# 输入的内容: 字符, 换行, 完整的标签
+TYPING = ['x', '果', '\n', '[b]x[/b]', 'http://www.guokr.com/ ']
+
+
+def bench_edit(sizes=(16 * 1024, 256 * 1024, 1024 * 1024), number=100):
+    """编辑器预览: 输入时 edit 与重新解析渲染整篇的耗时
+
+    输入使标签失效时 (比如落在闭标签中), 之后的内容都要重新解析, 这里
+    不测量这种情况.
+
+    """
+    with offline():
+        for size in sizes:
+            rng = random.Random(size)
+            source = _article(rng, size)
+            start = time.time()
+            full = bbcode.BBCode(source).block_html()
+            whole = time.time() - start
+            doc = bbcode.BBCode(source)
+            fragments = doc.block_html()
+            timings = []
+            for i in range(number):
+                # 在随机一行的开头输入, 不破坏已有的标签
+                offset = doc.source.rfind(
+                    '\n', 0, rng.randint(0, len(doc.source))) + 1
+                start = time.time()
+                first, stop, html = doc.edit(offset, 0, TYPING[i % len(TYPING)])
+                timings.append(time.time() - start)
+                fragments[first:stop] = html
+            assert ''.join(fragments) == ''.join(
+                bbcode.BBCode(doc.source).block_html())
+            timings.sort()
+            print('%7d chars, %5d blocks: edit median %.2f ms, 90%% %.2f ms, '
+                  'full %.1f ms' % (len(source), len(full),
+                                    timings[number // 2] * 1000,
+                                    timings[number * 9 // 10] * 1000,
+                                    whole * 1000))
+
+
+# 基准测试套件: 固定的语料, 机器可读的结果, 用于比较不同提交之间的性能
+
+CJK_CHARS = (
+    '的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也'
+    '得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把'
+    '还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经'
+    '长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感'
+    '果壳网科学技术兴趣社区')
+
+
+def _words(rng, n):
+    return ' '.join(rng.choice(('guokr', 'science', 'bbcode', 'render',
+                                'question', 'answer', 'x^2', '1+1'))
+                    for _ in range(n))
+
+
+def _cjk(rng, n):
+    return ''.join(rng.choice(CJK_CHARS) for _ in range(n))
+
+
+def _cjk_article(rng, size):
+    """以中文为主的长文, 每段约 200 字, 偶尔有加粗和链接"""
+    parts = []
+    length = 0
+    while length < size:
+        part = _cjk(rng, rng.randint(100, 300))
+        if rng.randint(0, 3) == 0:
+            part += '[b]%s[/b]' % _cjk(rng, 6)
+        if rng.randint(0, 7) == 0:
+            part += '@%s ' % _cjk(rng, 4)
+        parts.append(part + '。\n')
+        length += len(parts[-1])
+    return ''.join(parts)
+
+
+def _reply(rng):
+    """一条短回复"""
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        kind = rng.randint(0, 5)
+        if kind == 0:
+            parts.append('[b]%s[/b]' % _words(rng, rng.randint(1, 4)))
+        elif kind == 1:
+            parts.append('@%s ' % _cjk(rng, rng.randint(2, 6)))
+        elif kind == 2:
+            parts.append('http://www.guokr.com/post/%d/ ' % rng.randint(1, 10 ** 6))
+        elif kind == 3:
+            parts.append('[quote]%s[/quote]\n' % _cjk(rng, rng.randint(5, 30)))
+        else:
+            parts.append(_cjk(rng, rng.randint(5, 40)) + '\n')
+    return ''.join(parts)
+
+
+def _article(rng, size):
+    """一篇长文章, 包含标题, 段落, 列表, 引用和链接"""
+    parts = []
+    length = 0
+    while length < size:
+        kind = rng.randint(0, 5)
+        if kind == 0:
+            part = '[h1]%s[/h1]\n' % _cjk(rng, 12)
+        elif kind == 1:
+            part = '[ul]\n%s[/ul]\n' % ''.join(
+                '%s\n' % _cjk(rng, 20) for _ in range(rng.randint(2, 6)))
+        elif kind == 2:
+            part = '[quote][i]%s[/i][/quote]\n' % _words(rng, 20)
+        elif kind == 3:
+            part = '[url=http://www.guokr.com/article/%d/]%s[/url]\n' % (
+                rng.randint(1, 10 ** 6), _cjk(rng, 8))
+        else:
+            part = '%s[b]%s[/b]%s\n' % (_cjk(rng, 80), _words(rng, 3),
+                                         _cjk(rng, 80))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def _nested_list(rng, depth):
+    source = ''
+    for level in range(depth):
+        tagname = 'ul' if level % 2 else 'ol'
+        source = '[%s]%s\n%s%s\n[/%s]' % (
+            tagname, _cjk(rng, 6), source, _words(rng, 2), tagname)
+    return source
+
+
+def _table(rng, rows, cols):
+    return '[table]\n%s[/table]\n' % ''.join(
+        '[tr]%s[/tr]\n' % ''.join(
+            '[td]%s[/td]' % _cjk(rng, rng.randint(1, 8)) for _ in range(cols))
+        for _ in range(rows))
+
+
+def _links(rng, n):
+    return ' '.join(rng.choice((
+        'http://www.guokr.com/question/%d/' % rng.randint(1, 10 ** 6),
+        '@%s' % _cjk(rng, rng.randint(2, 8)),
+        'someone%d@guokr.com' % rng.randint(1, 1000),
+        '[url]http://guo.kr/%d[/url]' % rng.randint(1, 1000),
+    )) for _ in range(n))
+
+
+def _media(rng, n):
+    return '\n'.join(rng.choice((
+        '[img]http://img1.guokr.com/gkimage/%02x/%02x/xx/abcdef.jpg[/img]' % (
+            rng.randint(0, 255), rng.randint(0, 255)),
+        '[math]x^%d + y^2 = z^2[/math]' % rng.randint(1, 9),
+        '[video]http://v.youku.com/v_show/id_XNDg1NzIzNjYw.html[/video]',
+        _cjk(rng, 20),
+    )) for _ in range(n))
+
+
+def _malformed(rng, n):
+    pieces = HOSTILE_PIECES.values() + ['[b]', '[/i]', '[ul]', '[/quote]',
+                                        '[url=', ']', '\n', _cjk(rng, 4)]
+    return ''.join(rng.choice(pieces) for _ in range(n))
+
+
+def corpus(scale=1, seed=0):
+    """生成固定的语料, 同样的 scale 和 seed 总是给出同样的结果
+
+    :Returns
+        OrderedDict, {语料名: [BBCode 源码, ...]}
+
+    """
+    rng = random.Random(seed)
+    return OrderedDict([
+        ('short_replies', [_reply(rng) for _ in range(1000 * scale)]),
+        ('long_articles', [_article(rng, 128 * 1024) for _ in range(2 * scale)]),
+        ('nested_lists', [_nested_list(rng, 128) for _ in range(20 * scale)]),
+        ('tables', [_table(rng, 40, 8) for _ in range(20 * scale)]),
+        ('urls_mentions', [_links(rng, 2000) for _ in range(5 * scale)]),
+        ('cjk', [_cjk_article(rng, 16 * 1024) for _ in range(10 * scale)]),
+        ('media', [_media(rng, 200) for _ in range(10 * scale)]),
+        ('malformed', [_malformed(rng, 20000) for _ in range(5 * scale)]),
+    ])
+
+
+@contextmanager
+def offline():
+    """不访问网络和存储: 图片不查询尺寸, 公式不检查是否已经生成, 视频只用
+    缓存, 链接在一个只有所需路由的 app 中生成"""
+    from flask import Flask
+    from frame.platform.contribs.bbcode import tags, video
+
+    def math_hook(bbcodes):
+        # 保留收集公式的开销, 不做查询
+        for bb in bbcodes:
+            for node in bb.filter('math'):
+                node.hashed
+
+    hooks = core._HOOKS['after_parse']
+    position = hooks.index(tags.math_hook)
+    hooks[position] = math_hook
+    core._BATCH_HOOKS.add(math_hook)
+    image_metas = tags.image_metas
+    tags.image_metas = lambda urls: dict.fromkeys(urls, (None, None))
+    cache_only = video.CACHE_ONLY
+    video.CACHE_ONLY = True
+    app = Flask(__name__)
+    app.add_url_rule('/formula/<hashed>.<format>', 'image:formula')
+    app.add_url_rule('/i/<nickname>/', 'community:profile.nickname_redirect')
+    ctx = app.test_request_context('/', headers={
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) Firefox/20.0'})
+    ctx.push()
+    try:
+        yield
+    finally:
+        ctx.pop()
+        video.CACHE_ONLY = cache_only
+        tags.image_metas = image_metas
+        hooks[position] = tags.math_hook
+        core._BATCH_HOOKS.discard(math_hook)
+
+
+def _parse(sources):
+    bbcodes = [bbcode.BBCode(source) for source in sources]
+    for bb in bbcodes:
+        bb.nodes
+    return bbcodes
+
+
+def _render(sources):
+    # 不经过 render_cache, 测量的是 hook 和渲染本身
+    bbcodes = [bbcode.BBCode(source) for source in sources]
+    bbcode.BBCode.prepare_many(bbcodes)
+    return [bb.nodes.html() for bb in bbcodes]
+
+
+# 每项测量: (名称, 准备, 计时的操作); 准备的结果作为操作的参数, 不计入耗时
+OPERATIONS = [
+    ('parse', lambda sources: sources, _parse),
+    ('html', lambda sources: sources, _render),
+    ('text', _parse, lambda bbcodes: [bb.text() for bb in bbcodes]),
+    ('plain_text', lambda sources: [bbcode.BBCode(source) for source in sources],
+     lambda bbcodes: [bb.plain_text() for bb in bbcodes]),
+    ('unicode', _parse, lambda bbcodes: [unicode(bb) for bb in bbcodes]),
+]
+
+
+def run_suite(scale=1, seed=0, repeat=3, memory=True, report=None):
+    """在 offline() 中对 corpus 的每一类语料执行 OPERATIONS
+
+    耗时取 repeat 次中最短的一次. memory 为 True 时在子进程中测量 parse 和
+    html 的内存峰值 (相对于空操作的增量, KB).
+
+    :Returns
+        可以 json 序列化的 dict
+
+    """
+    data = corpus(scale, seed)
+    results = []
+    with offline():
+        for name, sources in data.iteritems():
+            chars = sum(len(source) for source in sources)
+            for op, setup, func in OPERATIONS:
+                timings = []
+                for _ in range(repeat):
+                    args = setup(sources)
+                    start = time.time()
+                    func(args)
+                    timings.append(time.time() - start)
+                elapsed = min(timings)
+                result = {
+                    'corpus': name, 'op': op, 'docs': len(sources),
+                    'chars': chars, 'seconds': elapsed,
+                    'chars_per_second': chars / elapsed if elapsed else None,
+                }
+                if memory and op in ('parse', 'html'):
+                    # 子进程从当前进程复制而来, 减去空操作的峰值
+                    args = setup(sources)
+                    result['peak_kb'] = peak_memory(func, args) - \
+                        peak_memory(lambda: None)
+                results.append(result)
+                if report:
+                    report(result)
+    return {
+        'python': sys.version.split()[0],
+        'commit': _git_commit(),
+        'scale': scale,
+        'seed': seed,
+        'repeat': repeat,
+        'time': int(time.time()),
+        'results': results,
+    }
+
+
+def _git_commit():
+    import subprocess
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold=1.1):
+    """比较两次 run_suite 的结果, 给出耗时超过旧结果 threshold 倍的项
+
+    :Returns
+        [(语料名, 操作, 旧耗时, 新耗时), ...]
+
+    """
+    # 语料不同 (scale, seed 或者生成器改变) 的项不比较
+    timings = dict(((r['corpus'], r['op'], r['chars']), r['seconds'])
+                   for r in old['results'])
+    regressions = []
+    for r in new['results']:
+        before = timings.get((r['corpus'], r['op'], r['chars']))
+        if before and r['seconds'] > before * threshold:
+            regressions.append((r['corpus'], r['op'], before, r['seconds']))
+    return regressions
+
+
+def _print_result(result):
+    print('%-14s %-10s %8.2f ms %10.0f chars/s%s' % (
+        result['corpus'], result['op'], result['seconds'] * 1000,
+        result['chars_per_second'] or 0,
+        ' %8d KB' % result['peak_kb'] if 'peak_kb' in result else ''))
+
+
+def main(argv=None):
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(description='BBCode benchmarks')
+    parser.add_argument('command', nargs='?', default='all',
+                        choices=['all', 'suite', 'compare'],
+                        help='all: the ad-hoc benchmarks; suite: the corpus '
+                             'suite; compare: compare two suite results')
+    parser.add_argument('files', nargs='*',
+                        help='compare: OLD.json NEW.json')
+    parser.add_argument('--json', help='suite: write results to this file')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--threshold', type=float, default=1.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'all':
+        bench_allowed_nodes()
+        bench_streaming()
+        bench_nodes()
+        bench_ast()
+        bench_text()
+        bench_excerpt()
+        bench_video()
+        bench_hostile()
+        bench_filter()
+        bench_render_context()
+    elif args.command == 'suite':
+        data = run_suite(args.scale, args.seed, args.repeat,
+                         memory=not args.no_memory, report=_print_result)
+        if args.json:
+            with open(args.json, 'w') as fp:
+                json.dump(data, fp, indent=2, sort_keys=True)
+    else:
+        if len(args.files) != 2:
+            parser.error('compare needs OLD.json and NEW.json')
+        old, new = [json.load(open(filename)) for filename in args.files]
+        regressions = compare(old, new, args.threshold)
+        for name, op, before, after in regressions:
+            print('%-14s %-10s %8.2f ms -> %8.2f ms (x%.2f)' % (
+                name, op, before * 1000, after * 1000, after / before))
+        return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""frame.platform.sqlalchemy 的性能测试
+
+不会被测试框架自动收集, 需要单独运行, 默认使用临时的 sqlite 数据库::
+
+    python -m frame.platform.tests.bench_db
+    python -m frame.platform.tests.bench_db --uri postgresql://localhost/bench
+
+"""
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from flask import Flask
+from sqlalchemy import sql, exc
+
+from frame.platform.sqlalchemy import SQLAlchemy
+
+
+def make_app(uri, rows):
+    """建立只有一张 rows 行的表的 app, 给出 (app, db, 模型)"""
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=uri)
+    db = SQLAlchemy(app)
+
+    class BenchItem(db.Model):
+        __tablename__ = 'bench_item'
+
+        id = db.Column(db.Integer(), primary_key=True)
+        data = db.Column(db.String(64))
+
+    with app.test_request_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(BenchItem.__table__.insert(), [
+            {'id': i, 'data': 'item %d' % i} for i in xrange(1, rows + 1)])
+        db.session.commit()
+    return app, db, BenchItem
+
+
+def or_batch_get(query, idents):
+    """原来的 batch_get: 每个主键一个 ``pk = ?``, 用 OR 连接成一条语句"""
+    pk = query._only_full_mapper_zero('batch_get').primary_key[0]
+    found = dict((instance.id, instance) for instance in
+                 query.filter(sql.or_(*[pk == i for i in idents])))
+    return [found.get(i) for i in idents]
+
+
+def bench_batch_get(uri, sizes=(10, 1000, 50000), number=3):
+    """不同数量的主键: OR 连接, IN 分批和流式 batch_get 的耗时"""
+    app, db, BenchItem = make_app(uri, max(sizes))
+    rng = random.Random(0)
+    print('%s:' % db.get_engine(app).dialect.name)
+    for size in sizes:
+        idents = rng.sample(xrange(1, max(sizes) * 2), size)
+        funcs = [
+            ('or', lambda: or_batch_get(BenchItem.query, idents)),
+            ('in', lambda: BenchItem.query.batch_get(*idents)),
+            ('stream', lambda: sum(1 for _ in
+                                   BenchItem.query.iter_batch_get(idents))),
+        ]
+        for name, func in funcs:
+            with app.test_request_context():
+                with db.disable_slaves():
+                    start = time.time()
+                    try:
+                        for _ in range(number):
+                            func()
+                            # 每次都从数据库加载, 不走 identity map
+                            db.session.expunge_all()
+                    except exc.DBAPIError as e:
+                        db.session.rollback()
+                        print('  %6d ids %-6s failed: %s' % (
+                            size, name, e.orig))
+                        continue
+            print('  %6d ids %-6s %9.2f ms' % (
+                size, name, (time.time() - start) * 1000 / number))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='SQLAlchemy benchmarks')
+    parser.add_argument('--uri', help='database URI, default: a temporary '
+                                      'sqlite file')
+    args = parser.parse_args(argv)
+
+    if args.uri:
+        bench_batch_get(args.uri)
+        return
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        bench_batch_get('sqlite:///%s' % path)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import os
+import json
+import hashlib
 import unittest
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from flask import Flask
 from werkzeug import html as html_builder
 from frame.platform.contribs import bbcode
+from frame.platform.contribs.bbcode import core, tags, video
+from frame.platform.contribs.bbcode.cache import RenderCache, CHAR_SIZE
 
 class BBCodeTestCase(unittest.TestCase):
 
@@ -77,6 +85,16 @@ class BBCodeTestCase(unittest.TestCase):
         self.assertEqual(bb.html(),
             "坑<strong>爹</strong>呢<i>啊</i>!<br />\n")
 
+    def test_tagname_longest_match(self):
+        bb = bbcode.BBCode(
+            "[i]x[/i][IMG]http://a[/img][Italic]y[/italic][imgx]")
+        self.assertEqual(bb.html(),
+            '<i>x</i><img src="http://a" style="max-width: 480px" />'
+            '<i>y</i>[imgx]')
+        # 被 tag_excludes 排除的别名
+        bb = bbcode.BBCode("[b][bold]x[/bold][/b]")
+        self.assertEqual(bb.html(), '<strong>[bold]x[/bold]</strong>')
+
     def test_br(self):
         bb = bbcode.BBCode("aaaaaa\nbbbbbb\r\ncccccc\r")
         self.assertEqual(bb.nodes.html(),
@@ -169,6 +187,58 @@ class BBCodeTestCase(unittest.TestCase):
             'type="application/x-shockwave-flash">' %
             'http://www.tudou.com/fakeurl.swf&quot; src=&quot;javascript:alert(\'xss\')')
 
+    def test_video_resolution(self):
+        requests = []
+
+        class SohuHandler(BaseHTTPRequestHandler):
+            # 代替搜狐的接口, 总是给出 id 为 456 的视频
+            def do_POST(self):
+                requests.append(self.rfile.read(
+                    int(self.headers['Content-Length'])))
+                body = json.dumps({'flash': 'http://share.vrs.sohu.com/456/v.swf'})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), SohuHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        api_url = video.SohuAdapter._api_url
+        video.SohuAdapter._api_url = 'http://127.0.0.1:%d/' % server.server_port
+        urls = ['http://tv.sohu.com/20130101/n%d.shtml' % i for i in (1, 2)]
+        redis = video._share_redis
+        app = Flask(__name__)
+        try:
+            redis.hdel('bbcode-sohu-url', *urls)
+            swf = 'http://share.vrs.sohu.com/456/v.swf&amp;autoplay=false'
+
+            # 同步解析
+            bb = bbcode.BBCode('[video]%s[/video]' % urls[0])
+            self.assertIn(swf, bb.html())
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(int(redis.hget('bbcode-sohu-url', urls[0])), 456)
+
+            # 后台解析, 先给出占位的链接
+            app.config['BBCODE_VIDEO_BACKGROUND'] = True
+            with app.app_context():
+                source = '[video]%s[/video]' % urls[1]
+                html = bbcode.BBCode(source).html()
+                self.assertIn('bbcode-video-pending', html)
+                video.resolver.join()
+                self.assertEqual(len(requests), 2)
+                # 占位的链接没有被缓存
+                self.assertIn(swf, bbcode.BBCode(source).html())
+        finally:
+            video.SohuAdapter._api_url = api_url
+            redis.hdel('bbcode-sohu-url', *urls)
+            server.shutdown()
+
     def test_ref(self):
         bb = bbcode.BBCode('xx [REF]/article/123465[/REF] yy')
         self.assertEqual(bb.html(),
@@ -221,9 +291,176 @@ class BBCodeTestCase(unittest.TestCase):
         # email
         bb = bbcode.BBCode(u'求种！邮箱：diaosi@gmail.com')
         self.assertEqual(bb.html(), u'求种！邮箱：<a href="mailto:diaosi@gmail.com">diaosi@gmail.com</a>')
+        # 紧接着上一个邮件地址的地址也能匹配
+        bb = bbcode.BBCode(u'a@b.comx.y@z.co')
+        self.assertEqual(bb.html(), u'<a href="mailto:a@b.comx">a@b.comx</a>'
+                                    u'<a href="mailto:.y@z.co">.y@z.co</a>')
         # url contains at
         bb = bbcode.BBCode(u'[url="http://guo.kr"]我@不到用户[/url]，@果壳网孙小年')
         self.assertEqual(bb.html(), u'<a href="http://guo.kr">我@不到用户</a>，<a href="#">@果壳网孙小年</a>')
+        # 权重高的 url 不会被之前的 @ 截断
+        bb = bbcode.BBCode(u'@果壳网http://guokr.com/ 和 a@b.com')
+        self.assertEqual(bb.html(), u'<a href="#">@果壳网</a><a href="http://guokr.com/">http://guokr.com/</a> 和 <a href="mailto:a@b.com">a@b.com</a>')
+
+    def test_mention_resolution(self):
+        requests = []
+
+        class Resolver(tags.MentionResolver):
+            # 代替社区的用户接口, 只有"果壳网"这个用户
+            def fetch(self, nicknames):
+                requests.append(sorted(nicknames))
+                if self.broken:
+                    return {}
+                return dict((nickname, 'abcdef' if nickname == '果壳网' else '')
+                            for nickname in nicknames)
+
+        app = Flask(__name__)
+        app.add_url_rule('/i/<ukey>/', 'community:profile.index')
+        app.add_url_rule('/n/<nickname>/', 'community:profile.nickname_redirect')
+        app.config['BBCODE_RESOLVE_MENTIONS'] = True
+        resolver = Resolver(key_prefix='test-bbcode-mention:')
+        resolver.broken = False
+        mentions = tags.mentions
+        tags.mentions = resolver
+        redis = video._share_redis
+        try:
+            with app.test_request_context('/'):
+                sources = ['@果壳网 和 @不存在', '@果壳网 @果壳网']
+                bbcodes = [bbcode.BBCode(source) for source in sources]
+                bbcode.BBCode.prepare_many(bbcodes)
+                html = [bb.nodes.html() for bb in bbcodes]
+                self.assertEqual(html, ['<a href="/i/abcdef/">@果壳网</a> 和 @不存在',
+                                        '<a href="/i/abcdef/">@果壳网</a> '
+                                        '<a href="/i/abcdef/">@果壳网</a>'])
+                # 整批只查询一次
+                self.assertEqual(requests, [['不存在', '果壳网']])
+                # 进程内的缓存
+                bb = bbcode.BBCode('@果壳网')
+                bb.prepare_many([bb])
+                self.assertEqual(len(requests), 1)
+                # 其它进程从 Redis 读取
+                tags.mentions = Resolver(key_prefix='test-bbcode-mention:')
+                bb = bbcode.BBCode('@不存在 @果壳网')
+                bb.prepare_many([bb])
+                self.assertEqual(bb.nodes.html(),
+                                 '@不存在 <a href="/i/abcdef/">@果壳网</a>')
+                self.assertEqual(len(requests), 1)
+                # 接口出错时链接到按昵称跳转的地址, 并且不缓存
+                tags.mentions = resolver
+                resolver.broken = True
+                bb = bbcode.BBCode('@其他人')
+                bb.prepare_many([bb])
+                self.assertEqual(bb.nodes.html(),
+                                 '<a href="/n/%E5%85%B6%E4%BB%96%E4%BA%BA/">@其他人</a>')
+                self.assertFalse(RenderCache().cacheable(bb))
+                self.assertEqual(len(requests), 2)
+        finally:
+            tags.mentions = mentions
+            redis.delete(*['test-bbcode-mention:' + nickname
+                           for nickname in ('果壳网', '不存在')])
+
+    def test_mention_fetch(self):
+        from guokr.platform.apis import community, APIServerError
+        calls = []
+
+        def retrieve(retrieve_type, nickname):
+            # 和社区的用户接口一样, 每次只查询一个昵称
+            self.assertEqual(retrieve_type, 'by_nickname')
+            self.assertIsInstance(nickname, unicode)
+            calls.append(nickname)
+            if nickname == '出错':
+                raise APIServerError()
+            if nickname == '果壳网':
+                return {nickname: {'ukey': 'abcdef', 'nickname': nickname}}
+            return {}
+
+        retrieve_ = community.user.retrieve
+        community.user.retrieve = retrieve
+        try:
+            resolver = tags.MentionResolver()
+            self.assertEqual(resolver.fetch(['果壳网', '不存在']),
+                             {'果壳网': 'abcdef', '不存在': ''})
+            self.assertEqual(calls, ['果壳网', '不存在'])
+            # 出错之后的昵称不再查询, 都不在结果中
+            self.assertEqual(resolver.fetch(['果壳网', '出错', '不存在']),
+                             {'果壳网': 'abcdef'})
+            self.assertEqual(calls[2:], ['果壳网', '出错'])
+            # 请求次数和耗时的限制
+            resolver = tags.MentionResolver(max_fetches=2)
+            self.assertEqual(resolver.fetch(['a', 'b', 'c']),
+                             {'a': '', 'b': ''})
+            resolver = tags.MentionResolver(fetch_timeout=0)
+            self.assertEqual(resolver.fetch(['a', 'b', 'c']), {'a': ''})
+
+            # 超出限制的 @ 链接到按昵称跳转的地址, 不缓存, 之后再查询
+            app = Flask(__name__)
+            app.add_url_rule('/i/<ukey>/', 'community:profile.index')
+            app.add_url_rule('/n/<nickname>/',
+                             'community:profile.nickname_redirect')
+            app.config['BBCODE_RESOLVE_MENTIONS'] = True
+            mentions = tags.mentions
+            tags.mentions = tags.MentionResolver(
+                key_prefix='test-bbcode-mention-fetch:', max_fetches=1)
+            del calls[:]
+            try:
+                with app.test_request_context('/'):
+                    bb = bbcode.BBCode('@果壳网 @x')
+                    bb.prepare_many([bb])
+                    self.assertEqual(bb.nodes.html(),
+                                     '<a href="/i/abcdef/">@果壳网</a> '
+                                     '<a href="/n/x/">@x</a>')
+                    self.assertFalse(RenderCache().cacheable(bb))
+                    bb = bbcode.BBCode('@果壳网 @x')
+                    bb.prepare_many([bb])
+                    self.assertEqual(bb.nodes.html(),
+                                     '<a href="/i/abcdef/">@果壳网</a> @x')
+                    self.assertEqual(calls, ['果壳网', 'x'])
+            finally:
+                tags.mentions = mentions
+                video._share_redis.delete(
+                    'test-bbcode-mention-fetch:果壳网',
+                    'test-bbcode-mention-fetch:x')
+        finally:
+            community.user.retrieve = retrieve_
+
+    def test_render_context(self):
+        import flask
+        app = Flask(__name__)
+        app.add_url_rule('/i/<nickname>/', 'community:profile.nickname_redirect')
+        app.add_url_rule('/formula/<hashed>.<format>', 'image:formula')
+        calls = {'url_for': 0, 'image_format': 0}
+        url_for = flask.url_for
+        image_format = tags.MathMode.__dict__['image_format']
+
+        def counting_url_for(*args, **kwargs):
+            calls['url_for'] += 1
+            return url_for(*args, **kwargs)
+
+        def counting_image_format():
+            calls['image_format'] += 1
+            return image_format.__func__()
+
+        flask.url_for = counting_url_for
+        tags.MathMode.image_format = staticmethod(counting_image_format)
+        try:
+            sources = ['@果壳网孙小年 [math]x^2[/math] @a.b-c',
+                       '@天蓝提琴 [math]y^2[/math] @果壳网孙小年']
+            with app.test_request_context('/', headers={
+                    'User-Agent': 'Mozilla/5.0 Firefox/20.0'}):
+                html = [bbcode.BBCode(source).nodes.html() for source in sources]
+                self.assertIn('<a href="/i/%E6%9E%9C%E5%A3%B3%E7%BD%91%E5%AD%99'
+                              '%E5%B0%8F%E5%B9%B4/">@果壳网孙小年</a>', html[0])
+                self.assertIn('<a href="/i/a.b-c/">@a.b-c</a>', html[0])
+                self.assertIn('.svg"', html[1])
+                # 链接的模板, 验证模板, 两个公式
+                self.assertEqual(calls, {'url_for': 4, 'image_format': 1})
+            # 新的请求重新计算
+            with app.test_request_context('/'):
+                self.assertIn('.png"', bbcode.BBCode(sources[1]).nodes.html())
+                self.assertEqual(calls['image_format'], 2)
+        finally:
+            flask.url_for = url_for
+            tags.MathMode.image_format = image_format
 
     def test_regex_url(self):
         bb = bbcode.BBCode(u'访问一下https://zh.wikipedia.org/wiki/果壳网（没骗你）')
@@ -243,3 +480,331 @@ class BBCodeTestCase(unittest.TestCase):
 
         at = bb.filter('quote __at__')
         self.assertEqual(len(at), 0)
+
+    def test_filter_index(self):
+        source = (u'[b]@a [b]@b[/b][/b] [ref][b]@c[/b][/ref] '
+                  u'[ul][b]x[/b][ul][b]y[/b][/ul][/ul]')
+        selectors = ['b', 'b __at__', 'ul b', 'ul ul', '__at__, ul', 'url']
+        for bb in (bbcode.BBCode(source),
+                   bbcode.BBCode.from_ast(source, bbcode.BBCode(source).to_ast())):
+            for selector in selectors:
+                expected = []
+                for tree in core.parse_selector(selector):
+                    expected.extend(bb.nodes._filter(tree))
+                self.assertEqual(map(id, bb.filter(selector)), map(id, expected))
+        # 只有最外层的 [b]; 无效的 [ref] 整体作为纯文本重新切分, 其中的 @c
+        # 只出现一次
+        bb = bbcode.BBCode(source)
+        self.assertEqual(len(bb.filter('b')), 3)
+        self.assertEqual([at.nickname for at in bb.filter('__at__')],
+                         [u'a', u'b', u'c'])
+        self.assertEqual(core.parse_selector('li url'), core.parse_selector('li url'))
+        self.assertRaises(ValueError, bb.filter, 'b > i')
+
+    def test_render_cache(self):
+        cache = RenderCache(maxsize=2)
+        bb = bbcode.BBCode('[b]xxx[/b]')
+        self.assertEqual(cache.html(bb), '<strong>xxx</strong>')
+        self.assertEqual(len(cache.lru), 1)
+        # 命中缓存时不再解析
+        bb = bbcode.BBCode('[b]xxx[/b]')
+        self.assertEqual(cache.html(bb), '<strong>xxx</strong>')
+        self.assertFalse(hasattr(bb, '_top_node'))
+        # 渲染参数不同
+        self.assertNotEqual(cache.key(bb), cache.key(bb, resp_width=320))
+        cache.html(bb, resp_width=320)
+        cache.html(bbcode.BBCode('yyy'))
+        self.assertEqual(len(cache.lru), 2)
+
+        # 注册表改变后缓存失效
+        key = cache.key(bb)
+        hook = core.register_hook('after_parse')(lambda bbcode: None)
+        try:
+            self.assertNotEqual(cache.key(bb), key)
+        finally:
+            core._HOOKS['after_parse'].remove(hook)
+            core._REGISTRY_VERSION = None
+        self.assertEqual(cache.key(bb), key)
+
+    def test_render_cache_bytes(self):
+        size = CHAR_SIZE
+        cache = RenderCache(maxbytes=100 * size, max_entry_bytes=60 * size)
+        cache.set('a', 'x' * 40)
+        cache.set('b', 'x' * 40)
+        self.assertEqual(cache.lru_bytes, 80 * size)
+        # 超出总字节数时淘汰最早的
+        cache.set('c', 'x' * 40)
+        self.assertEqual(cache.lru.keys(), ['b', 'c'])
+        self.assertEqual(cache.lru_bytes, 80 * size)
+        # 超过单条上限的不放在 LRU 中, 同一个键的旧值也被去掉
+        cache.set('b', 'x' * 61)
+        self.assertEqual(cache.lru.keys(), ['c'])
+        self.assertEqual(cache.lru_bytes, 40 * size)
+        with Flask(__name__).test_request_context('/') as ctx:
+            ctx.app.config['BBCODE_RENDER_CACHE_LRU_ENTRY_BYTES'] = 100 * size
+            cache.set('b', 'x' * 61)
+            self.assertEqual(cache.lru.keys(), ['b'])
+        cache.clear()
+        self.assertEqual(cache.lru_bytes, 0)
+
+    def test_render_cache_uncacheable(self):
+        cache = RenderCache()
+        tags.BoldNode.cacheable = False
+        try:
+            cache.html(bbcode.BBCode('[i]xxx[/i]'))
+            self.assertEqual(len(cache.lru), 1)
+            cache.html(bbcode.BBCode('[i]x[b]xx[/b][/i]'))
+            self.assertEqual(len(cache.lru), 1)
+        finally:
+            del tags.BoldNode.cacheable
+
+    def test_ast(self):
+        source = ('[ul]a\n[b]b @果壳网 http://guokr.com/[/b]\n[/ul]'
+                  '[url]http://guo.kr[/url][color=red]x[/color]')
+        bb = bbcode.BBCode(source)
+        ast = bb.to_ast()
+        loaded = bbcode.BBCode.from_ast(source, ast)
+        self.assertEqual(loaded.nodes.html(), bb.nodes.html())
+        self.assertEqual(unicode(loaded), unicode(bb))
+        self.assertEqual(loaded.to_ast(), ast)
+        # 载入时建立的索引和解析时的一样可用
+        for selector in ('url', 'ul b'):
+            self.assertEqual([n.html() for n in loaded.filter(selector)],
+                             [n.html() for n in bb.filter(selector)])
+
+        # source 改变或版本不符时不能使用
+        self.assertRaises(ValueError, bbcode.BBCode.from_ast, source + 'x', ast)
+        self.assertRaises(ValueError, bbcode.BBCode.from_ast, source,
+                          ast.replace('[%d' % core.AST_VERSION, '[0', 1))
+        self.assertRaises(ValueError, bbcode.BBCode.from_ast, source, 'xxx')
+        self.assertRaises(ValueError, bbcode.BBCode.from_ast, source,
+                          ast[:ast.rindex(',')] + ']]')
+
+    def test_sibling(self):
+        bb = bbcode.BBCode('a\n[b]b[/b]c\n')
+        first, bold, last = bb.nodes.children
+        self.assertIs(first.prev_sibling(), None)
+        self.assertIs(first.next_sibling(), bold)
+        self.assertIs(bold.next_sibling(), last)
+        self.assertIs(last.prev_sibling(), bold)
+        self.assertIs(last.next_sibling(), None)
+        self.assertIs(bold.children[0].next_sibling(), None)
+        self.assertIs(bb.nodes.prev_sibling(), None)
+        self.assertFalse(hasattr(bold, '__dict__'))
+
+    def test_render_many(self):
+        sources = ['[b]a[/b]', 'b\n[i]c[/i]', '[b]a[/b]']
+        calls = []
+        hook = core.register_hook('before_render', batch=True)(
+            lambda bbcodes: calls.append([bb.source for bb in bbcodes]))
+        try:
+            htmls = bbcode.BBCode.render_many(sources, resp_width=123)
+            self.assertEqual(htmls, [bbcode.BBCode(source).nodes.html()
+                                     for source in sources])
+            # 整批文档只触发一次
+            self.assertEqual(calls, [sources])
+            # 已经缓存的不再渲染
+            bbcode.BBCode.render_many(sources + ['d'], resp_width=123)
+            self.assertEqual(calls[1:], [['d']])
+            # 单个文档也能触发
+            bbcode.BBCode('e').html()
+            self.assertEqual(calls[2:], [['e']])
+        finally:
+            core._HOOKS['before_render'].remove(hook)
+            core._BATCH_HOOKS.discard(hook)
+            core._REGISTRY_VERSION = None
+
+    def test_math_hook(self):
+        from guokr.platform.apis import APIServerError
+        from guokr.platform.apis.confidential import formula
+        redis = video._share_redis
+        sources = ['[math]a^2[/math][math]b^2[/math]', '[math]a^2[/math]',
+                   '[math]c^2[/math][math]d^2[/math]']
+        texs = ['a^2', 'b^2', 'c^2', 'd^2']
+        hashed = [hashlib.sha1(tex).hexdigest() for tex in texs]
+        redis.hset('image-formula', hashed[2], 'exists')
+        created = []
+        create = formula.create
+
+        def counting_create(tex, confirm):
+            created.append(tex)
+            if tex == 'd^2':
+                raise APIServerError()
+
+        formula.create = counting_create
+        try:
+            bbs = [bbcode.BBCode(source) for source in sources]
+            bbcode.BBCode.prepare_many(bbs)
+            # 相同的公式只创建一次, 已经生成的不再创建
+            self.assertEqual(sorted(created), ['a^2', 'b^2', 'd^2'])
+            # 只读取公式服务的 image-formula, 创建过的另外记录
+            self.assertEqual(redis.hmget('image-formula', hashed),
+                             [None, None, 'exists', None])
+            pending = ['image-formula-pending:' + h for h in hashed]
+            self.assertEqual([redis.ttl(key) for key in pending],
+                             [tags.FORMULA_PENDING_EXPIRE] * 2 + [None] * 2)
+            # 创建失败的下次重试, 刚创建过的不再创建
+            bbcode.BBCode.prepare_many([bbcode.BBCode(source)
+                                        for source in sources])
+            self.assertEqual(sorted(created), ['a^2', 'b^2', 'd^2', 'd^2'])
+            # 记录过期之后仍未生成的再次创建
+            redis.delete(*pending)
+            bbcode.BBCode.prepare_many([bbcode.BBCode(sources[1])])
+            self.assertEqual(created[-1], 'a^2')
+        finally:
+            formula.create = create
+            redis.hdel('image-formula', *hashed)
+            redis.delete(*['image-formula-pending:' + h for h in hashed])
+
+    def test_budget(self):
+        source = '[b]x[/b]<' * 10
+        bb = bbcode.BBCode(source, max_nodes=5)
+        self.assertEqual(bb.nodes.html(), source.replace('<', '&lt;'))
+        self.assertTrue(bb.degraded)
+        self.assertFalse(RenderCache().cacheable(bb))
+        bb = bbcode.BBCode(source, max_nodes=100)
+        self.assertEqual(bb.nodes.html(), '<strong>x</strong>&lt;' * 10)
+        self.assertFalse(bb.degraded)
+
+        # 超出层数的标签按纯文本处理
+        bb = bbcode.BBCode('[b][i]x[/i][/b]', max_depth=1)
+        self.assertEqual(bb.nodes.html(), '<strong>[i]x[/i]</strong>')
+        self.assertFalse(bb.degraded)
+
+        # 大量未闭合的标签
+        bb = bbcode.BBCode('[ul][ol]' * 5000)
+        node, depth = bb.nodes, 0
+        while node.children and not isinstance(node, core.PlainNode):
+            node, depth = node.children[0], depth + 1
+        # 最内层是其余的标签组成的纯文本
+        self.assertEqual(depth, core.MAXIMUM_DEPTH + 1)
+
+        # 嵌套到最大层数时 unicode() 和 text() 不会超出递归深度
+        bb = bbcode.BBCode('[url]' + '[ul]' * core.MAXIMUM_DEPTH + 'x')
+        source = unicode(bb)
+        self.assertTrue(source.endswith('[ul]x' + '[/ul]' * 255 + '[/url]'))
+        self.assertEqual(unicode(bbcode.BBCode(source)), source)
+        self.assertEqual(bb.text(), '[ul]x')
+
+    def test_plain_text(self):
+        source = ('a\n[b]b[/b][url=http://guokr.com][/url]@果壳网 '
+                  '[img]http://x.com/a.jpg[/img][ math ]x^2[/math]'
+                  '[i]c[/b][ul]d\n[x]')
+        bb = bbcode.BBCode(source)
+        self.assertEqual(bb.plain_text(), bb.text())
+        self.assertEqual(bb.plain_text(), ''.join(bb.iter_text()))
+        self.assertEqual(bb.plain_text(max_chars=4), bb.text()[:4])
+        self.assertEqual(bb.plain_text(max_chars=0), '')
+        # 不会解析节点
+        bb = bbcode.BBCode(source)
+        bb.plain_text()
+        self.assertFalse(hasattr(bb, '_top_node'))
+        # 超出限制时余下的部分原样给出
+        bb = bbcode.BBCode('[b]x[/b]<' * 10, max_nodes=5)
+        self.assertEqual(bb.plain_text(), 'x<x<x[/b]<' + '[b]x[/b]<' * 7)
+        self.assertEqual(bb.plain_text(max_chars=6), 'x<x<x[')
+
+    def test_excerpt(self):
+        bb = bbcode.BBCode('[quote][b]hello world[/b][/quote] more')
+        self.assertEqual(bb.excerpt(5), (
+            '<blockquote><strong>hello</strong></blockquote>', True))
+        self.assertEqual(bb.excerpt(100), (bb.html(), False))
+        self.assertEqual(bb.excerpt(0), ('', True))
+        # 不截断链接
+        bb = bbcode.BBCode('see http://guokr.com/ abc')
+        self.assertEqual(bb.excerpt(8), ('see ', True))
+        # 图片不算可见字符
+        bb = bbcode.BBCode('[img]http://x.com/a.jpg[/img]ab')
+        html, truncated = bb.excerpt(1)
+        self.assertTrue(truncated)
+        self.assertTrue(html.startswith('<img src="http://x.com/a.jpg"'))
+        self.assertTrue(html.endswith('/>a'))
+        # 超出限制时是转义后的纯文本
+        bb = bbcode.BBCode('[b]x[/b]<' * 10, max_nodes=5)
+        self.assertEqual(bb.excerpt(10), ('[b]x[/b]&lt;' * 3, True))
+        bb = bbcode.BBCode('[b]x[/b]<' * 10, max_nodes=100)
+        self.assertEqual(bb.excerpt(3), ('<strong>x</strong>&lt;<strong>x</strong>',
+                                         True))
+
+    def test_edit(self):
+        source = u'[h1]title[/h1]\nfirst [b]line[/b]\nsecond\n[quote]x\ny[/quote]\nlast'
+        bb = bbcode.BBCode(source)
+        fragments = bb.block_html()
+        self.assertEqual(u''.join(fragments), bb.nodes.html())
+        # block 节点之后和每个换行之后分块
+        self.assertEqual(len(fragments), 7)
+
+        def check(offset, length, text):
+            start, stop, html = bb.edit(offset, length, text)
+            fragments[start:stop] = html
+            expected = bbcode.BBCode(bb.source)
+            self.assertEqual(fragments, expected.block_html())
+            self.assertEqual(bb.to_ast(), expected.to_ast())
+            return start, stop
+
+        # 只重新解析和渲染所在的一行, 以及紧接着的一块
+        self.assertEqual(check(source.index(u'line'), 4, u'word'), (2, 4))
+        self.assertEqual(check(bb.source.index(u'second'), 0, u'[i]new[/i] '), (3, 5))
+        # 去掉换行, 两块合并
+        self.assertEqual(check(bb.source.index(u'\n[quote]'), 1, u''), (3, 6))
+        # 没有闭合的标签一直延伸到结尾
+        self.assertEqual(check(0, 0, u'[color=red]'), (0, 6))
+        self.assertEqual(len(fragments), 1)
+        self.assertEqual(check(len(bb.source), 0, u'[/color]\nend'), (0, 1))
+        # 补上之前找不到的引号, [url=" 之后的 [b] 不再是标签
+        bb = bbcode.BBCode(u'a\n[url="\n[b]x[/b]\nc')
+        fragments = bb.block_html()
+        self.assertEqual(check(len(bb.source), 0, u'"]'), (1, 4))
+        self.assertEqual(len(bb.filter('b')), 0)
+
+    def test_rerender(self):
+        import shutil
+        import tempfile
+        from sqlalchemy import create_engine
+        from frame.platform.contribs.bbcode import rerender
+
+        tmpdir = tempfile.mkdtemp()
+        api_url = video.SohuAdapter._api_url
+        # 只使用缓存, 不应访问网络
+        video.SohuAdapter._api_url = 'http://127.0.0.1:1/'
+        try:
+            engine = create_engine('sqlite:///%s/posts.db' % tmpdir)
+            engine.execute('CREATE TABLE post (id INTEGER PRIMARY KEY, '
+                           'content TEXT, html TEXT)')
+            sources = {}
+            for i in range(1, 31):
+                sources[i] = '[b]%d[/b]' % i
+            sources[7] = '[video]http://tv.sohu.com/20130101/n3.shtml[/video]'
+            for i, source in sources.items():
+                engine.execute('INSERT INTO post (id, content) VALUES (?, ?)',
+                               i, source)
+            checkpoint = os.path.join(tmpdir, 'checkpoint')
+            messages = []
+
+            # 处理前 12 行后中断
+            counts = rerender.Rerenderer(
+                engine, 'post', chunk_size=5, processes=0,
+                checkpoint=checkpoint, report=messages.append).run(limit=12)
+            self.assertEqual(counts, {'rendered': 11, 'pending': 1, 'failed': 0})
+            self.assertFalse(video.CACHE_ONLY)
+            rows = dict(engine.execute('SELECT id, html FROM post').fetchall())
+            self.assertEqual(rows[3], '<strong>3</strong>')
+            self.assertEqual(rows[7], None)
+            self.assertEqual(rows[13], None)
+
+            # 从检查点继续, 使用进程池
+            rerenderer = rerender.Rerenderer(
+                engine, 'post', chunk_size=5, processes=2,
+                checkpoint=checkpoint, report=messages.append)
+            counts = rerenderer.run()
+            self.assertEqual(counts, {'rendered': 29, 'pending': 1, 'failed': 0})
+            # 之前中断的运行中等待视频的文档也在其中
+            self.assertEqual(rerenderer.pending, [7])
+            rows = dict(engine.execute('SELECT id, html FROM post').fetchall())
+            for i in sources:
+                if i != 7:
+                    self.assertEqual(rows[i], '<strong>%d</strong>' % i)
+            self.assertIn('done', messages[-1])
+        finally:
+            video.SohuAdapter._api_url = api_url
+            shutil.rmtree(tmpdir)
@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 import os
 import time
 
-from frame.platform.flask import Flask
+from frame.platform.flask import Flask, request
 from frame.platform.flask.testing import TestCase
 from frame.platform.engines import db
 
@@ -26,7 +26,8 @@ class DBTestCase(TestCase):
         app.config.update(
             TESTING=True,
             SQLALCHEMY_DATABASE_URI='sqlite:///%s' % dbpath,
-            SQLALCHEMY_DATABASE_SLAVE_URIS=['sqlite:///%s' % dbpath]
+            SQLALCHEMY_DATABASE_SLAVE_URIS=['sqlite:///%s' % dbpath],
+            SQLALCHEMY_REPLICA_CHECK_INTERVAL=0
         )
 
         db.init_app(app)
@@ -84,3 +85,307 @@ class DBTestCase(TestCase):
 
         self.assertEqual(A.deleted.query.count(), 0)
         self.assertEqual(A.query.order_by(A.id).all(), [a1, a2])
+
+    def test_batch_get(self):
+
+        class B(db.Model):
+            __tablename__ = 'b'
+
+            id = db.Column(db.Integer(), primary_key=True)
+            data = db.Column(db.String(256))
+
+        class C(db.Model):
+            __tablename__ = 'c'
+
+            x = db.Column(db.Integer(), primary_key=True)
+            y = db.Column(db.Integer(), primary_key=True)
+
+        db.create_all()
+        # 在另一个请求中写入, 否则本请求的读取会使用主库
+        with self.app.test_request_context():
+            db.session.add_all([B(id=i, data='b%d' % i)
+                                for i in range(1, 11)])
+            db.session.add_all([C(x=i, y=i * 2) for i in range(1, 4)])
+            db.session.commit()
+            db.session.remove()
+
+        statements = []
+
+        @db.event.listens_for(db.get_engine(self.app, '__slave__'),
+                              'before_cursor_execute')
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        idents = [3, 12, 1, 3, 10, 2, 7]
+        b7 = B.query.get(7)
+        del statements[:]
+        result = B.query.batch_get(*idents, chunk_size=3)
+        self.assertEqual([b and b.id for b in result],
+                         [3, None, 1, 3, 10, 2, 7])
+        self.assertIs(result[-1], b7)
+        # 每 3 个一条语句, 已经在 identity map 中的不再查询,
+        # 因此最后的 7 不需要第三条语句
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all(' IN (' in s for s in statements))
+
+        self.assertEqual([b and b.id for b in
+                          B.query.iter_batch_get(iter(idents))],
+                         [3, None, 1, 3, 10, 2, 7])
+
+        result = C.query.batch_get((2, 4), (1, 1), (3, 6))
+        self.assertEqual([c and c.x for c in result], [2, None, 3])
+
+    def test_model_cache(self):
+
+        @db.model_cache(key_prefix='db-cache-test:%s:' % time.time())
+        @db.preserve_deleted()
+        class D(db.Model):
+            __tablename__ = 'd'
+
+            id = db.Column(db.Integer(), primary_key=True)
+            data = db.Column(db.String(256))
+
+        cache = D.__model_cache__
+        self.assertIsNot(D.deleted.__model_cache__, cache)
+        db.create_all()
+        db.session.add_all([D(id=1, data='d1'), D(id=2, data='d2')])
+        db.session.commit()
+        self.assertEqual(cache.stats()['invalidations'], 2)
+        db.session.remove()
+        # 相当于插入时写入的墓碑已经过期
+        cache.redis.delete(cache.key([1]), cache.key([2]))
+
+        statements = []
+        for bind in None, '__slave__':
+            db.event.listen(db.get_engine(self.app, bind),
+                            'before_cursor_execute',
+                            lambda conn, cursor, statement, *args:
+                            statements.append(statement))
+
+        self.assertEqual(D.query.get(1).data, 'd1')
+        self.assertEqual(len(statements), 1)
+        db.session.remove()
+        d1 = D.query.get(1)
+        self.assertEqual(d1.data, 'd1')
+        self.assertIs(D.query.get(1), d1)
+        self.assertEqual([d and d.data for d in D.query.batch_get(1, 2, 3)],
+                         ['d1', 'd2', None])
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(cache.stats(), {'hits': 1, 'lru_hits': 1,
+                                         'misses': 3, 'invalidations': 2})
+
+        # 修改和删除 (包括写入归档表) 在提交后失效
+        d1.data = 'changed'
+        db.session.delete(D.query.get(2))
+        db.session.commit()
+        self.assertEqual(cache.stats()['invalidations'], 4)
+        self.assertEqual(D.deleted.__model_cache__.stats()['invalidations'], 1)
+        db.session.remove()
+        self.assertEqual(D.query.get(1).data, 'changed')
+        self.assertIsNone(D.query.get(2))
+        self.assertEqual(D.deleted.query.get(2).data, 'd2')
+
+    def test_model_cache_race(self):
+
+        @db.model_cache(key_prefix='db-cache-test:%s:' % time.time())
+        class H(db.Model):
+            __tablename__ = 'h'
+
+            id = db.Column(db.Integer(), primary_key=True)
+            data = db.Column(db.String(256))
+
+        cache = H.__model_cache__
+        db.create_all()
+        db.session.add(H(id=1, data='old'))
+        db.session.commit()
+        db.session.remove()
+
+        # 另一个 session 在提交之前 (或者从有延迟的从库) 读到了旧数据
+        other = db.create_scoped_session()
+        stale = other.query(H).get(1)
+        self.assertEqual(stale.data, 'old')
+
+        H.query.get(1).data = 'new'
+        db.session.commit()
+        cache.set_many([stale])
+        self.assertEqual(cache.get_many([(1,)]), {})
+        # 没有写入时也不延长墓碑的过期时间
+        self.assertLessEqual(cache.redis.ttl(cache.key([1])),
+                             cache.tombstone_expire)
+        db.session.remove()
+        self.assertEqual(H.query.get(1).data, 'new')
+        self.assertEqual(cache.get_many([(1,)]), {})
+        # 墓碑过期之后才能再次写入
+        cache.redis.delete(cache.key([1]))
+        db.session.remove()
+        self.assertEqual(H.query.get(1).data, 'new')
+        self.assertEqual(cache.get_many([(1,)])[(1,)][1], 'new')
+        self.assertGreater(cache.redis.ttl(cache.key([1])),
+                           cache.tombstone_expire)
+        other.remove()
+
+    def test_model_cache_bulk_write(self):
+
+        @db.model_cache(key_prefix='db-cache-test:%s:' % time.time())
+        class I(db.Model):
+            __tablename__ = 'i'
+
+            id = db.Column(db.Integer(), primary_key=True)
+            data = db.Column(db.String(256))
+
+        cache = I.__model_cache__
+        db.create_all()
+        db.session.add_all([I(id=1, data='i1'), I(id=2, data='i2')])
+        db.session.commit()
+        db.session.remove()
+        cache.redis.delete(cache.key([1]), cache.key([2]))
+        self.assertEqual(len(I.query.batch_get(1, 2)), 2)
+        self.assertEqual(len(cache.get_many([(1,), (2,)])), 2)
+        db.session.remove()
+
+        # Query.update 和 Query.delete 在提交后使整张表失效
+        I.query.filter_by(id=1).update({'data': 'bulk'})
+        self.assertEqual(len(cache.get_many([(1,), (2,)])), 2)
+        db.session.commit()
+        self.assertEqual(cache.get_many([(1,), (2,)]), {})
+        db.session.remove()
+        self.assertEqual(I.query.get(1).data, 'bulk')
+        # 版本改变之后 tombstone_expire 秒内不写入
+        self.assertEqual(cache.get_many([(1,)]), {})
+        db.session.remove()
+
+        cache.tombstone_expire = 0
+        self.assertEqual(I.query.get(1).data, 'bulk')
+        self.assertEqual(cache.get_many([(1,)])[(1,)][1], 'bulk')
+        I.query.filter_by(id=2).delete()
+        db.session.rollback()
+        self.assertEqual(len(cache.get_many([(1,)])), 1)
+        I.query.filter_by(id=2).delete()
+        db.session.commit()
+        self.assertEqual(cache.get_many([(1,)]), {})
+
+    def test_replica_pool(self):
+        good = self.app.config['SQLALCHEMY_DATABASE_SLAVE_URIS'][0]
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_SLAVE_URIS=[
+                (good, 2), 'sqlite:////nonexistent/dbtest.db'])
+        db.create_all()
+
+        stats = db.replica_stats()
+        self.assertEqual([s['weight'] for s in stats], [2, 1])
+        pool = db.get_replica_pool()
+        good, bad = pool.replicas
+        pool.check()
+        self.assertEqual([s['healthy'] for s in db.replica_stats()],
+                         [True, False])
+        self.assertTrue(db.replica_stats()[1]['last_error'])
+        for _ in range(10):
+            self.assertIs(db.get_engine(self.app, '__slave__'), good.engine)
+        db.session.execute('SELECT 1', bind=good.engine)
+        # 检查的语句不计入统计, 也不清零连续的错误
+        self.assertEqual(db.replica_stats()[0]['queries'], 1)
+        good.consecutive_errors = 2
+        pool.check()
+        self.assertEqual(db.replica_stats()[0]['queries'], 1)
+        self.assertEqual(good.consecutive_errors, 2)
+
+        # 没有健康的从库时使用主库, 检查成功后恢复
+        good.healthy = False
+        self.assertIs(db.get_engine(self.app, '__slave__'),
+                      db.get_engine(self.app))
+        pool.check()
+        self.assertIs(db.get_engine(self.app, '__slave__'), good.engine)
+
+    def test_read_your_writes(self):
+
+        class E(db.Model):
+            __tablename__ = 'e'
+
+            id = db.Column(db.Integer(), primary_key=True)
+            data = db.Column(db.String(256))
+
+        class F(db.Model):
+            __tablename__ = 'f'
+
+            id = db.Column(db.Integer(), primary_key=True)
+
+        db.create_all()
+        master = db.get_engine(self.app)
+
+        def reads_master(model):
+            return db.session.get_bind(
+                model.__mapper__, model.query.statement) is master
+
+        with self.app.test_request_context():
+            self.assertFalse(reads_master(E))
+            with db.disable_slaves():
+                self.assertTrue(reads_master(E))
+            self.assertFalse(reads_master(E))
+            db.session.add(E(id=1, data='e1'))
+            db.session.commit()
+            self.assertTrue(reads_master(E))
+            self.assertFalse(reads_master(F))
+            F.query.filter_by(id=1).delete()
+            self.assertTrue(reads_master(F))
+        with self.app.test_request_context():
+            self.assertFalse(reads_master(E))
+            # 没有修改的对象不算写
+            e1 = E.query.get(1)
+            e1.data = 'e1'
+            db.session.commit()
+            self.assertFalse(reads_master(E))
+
+        # 同一用户在窗口内的请求也读取主库
+        self.app.config.update(SQLALCHEMY_READ_YOUR_WRITES_WINDOW=10,
+                               SQLALCHEMY_READ_YOUR_WRITES_STORE='redis')
+        with self.app.test_request_context():
+            request.ukey = 'ukey-%s' % time.time()
+            db.session.add(E(id=2, data='e2'))
+            db.session.commit()
+            ukey = request.ukey
+        with self.app.test_request_context():
+            request.ukey = ukey
+            self.assertTrue(reads_master(E))
+            self.assertFalse(reads_master(F))
+        with self.app.test_request_context():
+            request.ukey = 'other'
+            self.assertFalse(reads_master(E))
+
+    def test_max_staleness(self):
+
+        class G(db.Model):
+            __tablename__ = 'g'
+
+            id = db.Column(db.Integer(), primary_key=True)
+
+        db.create_all()
+        master = db.get_engine(self.app)
+        replica = db.get_replica_pool().replicas[0]
+        statement = G.query.statement
+
+        def bind(**kwargs):
+            return db.session.get_bind(G.__mapper__, statement, **kwargs)
+
+        # sqlite 无法取得延迟, 指定了最大延迟时只能使用主库
+        pool = db.get_replica_pool()
+        pool.check()
+        self.assertIsNone(replica.lag)
+        self.assertIs(bind(), replica.engine)
+        self.assertIs(bind(max_staleness=2), master)
+
+        replica.lag, replica.lag_sampled_at = 1.5, time.time()
+        self.assertIs(bind(max_staleness=2), replica.engine)
+        self.assertIs(bind(max_staleness=1), master)
+        with db.max_staleness(1):
+            self.assertIs(bind(), master)
+            self.assertIs(bind(max_staleness=2), replica.engine)
+        self.assertIs(bind(), replica.engine)
+
+        statements = []
+        db.event.listen(replica.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *args:
+                        statements.append(statement))
+        G.query.max_staleness(1).all()
+        self.assertEqual(statements, [])
+        G.query.max_staleness(2).all()
+        self.assertEqual(len(statements), 1)
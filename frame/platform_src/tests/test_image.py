@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import struct
+from unittest import TestCase
+
+from flask import Flask
+from flexmock import flexmock
+from frame.platform.contribs import image
+
+
+def make_hashkey(width, height, format_=b'JP', digest=b'x' * 32):
+    return base64.urlsafe_b64encode(struct.pack(
+        b'<32sII2s', digest, width, height, format_)).decode('ascii')
+
+
+class ImageTestCase(TestCase):
+
+    def test_decode_hashkeys(self):
+        hashkeys = [make_hashkey(i, i * 2, digest=b'%032d' % i)
+                    for i in range(1, image.CHUNK_SIZE * 2 + 10)]
+        params = image.decode_hashkeys(hashkeys + hashkeys[:5])
+        self.assertEqual(len(params), len(hashkeys))
+        for i, hashkey in enumerate(hashkeys, 1):
+            self.assertEqual(params[hashkey], (i, i * 2, 'JPEG'))
+        self.assertEqual(image.decode_hashkey(make_hashkey(3, 4, b'GI')),
+                         (3, 4, 'GIF'))
+        # 长度, 字符或者格式不对
+        invalid = [None, '', make_hashkey(1, 1)[:-1],
+                   make_hashkey(1, 1) + 'A', make_hashkey(1, 1, b'XX'),
+                   '果' * 56]
+        self.assertEqual(image.decode_hashkeys(invalid), {})
+        self.assertEqual(image.decode_hashkey(invalid[-1]), None)
+
+    def test_url_hashkeys(self):
+        from guokr.platform.flask import helpers
+        hashkey = make_hashkey(480, 320)
+        url = 'http://img1.guokr.com/image/%s.jpg' % hashkey
+        (flexmock(helpers).should_receive('url2hashkey')
+         .with_args(url, take_thumbnail=True).and_return(hashkey).once())
+        (flexmock(helpers).should_receive('url2hashkey')
+         .with_args('http://example.com/a.jpg', take_thumbnail=True)
+         .and_return(None).once())
+        with Flask(__name__).test_request_context('/'):
+            for _ in range(2):
+                self.assertEqual(
+                    image.image_metas([url, 'http://example.com/a.jpg']),
+                    {url: (hashkey, (480, 320, 'JPEG')),
+                     'http://example.com/a.jpg': (None, None)})
+
+    def test_request_memoize(self):
+        calls = []
+
+        @image.request_memoize
+        def thumbnail_for(hashkey, width=None):
+            calls.append(hashkey)
+            return '%s_%s' % (hashkey, width)
+
+        app = Flask(__name__)
+        with app.test_request_context('/'):
+            self.assertEqual(thumbnail_for('a', width=48), 'a_48')
+            self.assertEqual(thumbnail_for('a', width=48), 'a_48')
+            self.assertEqual(thumbnail_for('a'), 'a_None')
+            self.assertEqual(thumbnail_for(['unhashable']),
+                             '%s_None' % ['unhashable'])
+        self.assertEqual(calls, ['a', 'a', ['unhashable']])
+        # 每个请求分别缓存, 请求之外不缓存
+        with app.test_request_context('/'):
+            thumbnail_for('a', width=48)
+        thumbnail_for('a', width=48)
+        self.assertEqual(len(calls), 5)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import struct
+from unittest import TestCase
+
+from wtforms import Form
+from wtforms import fields
+from werkzeug.datastructures import MultiDict
+from frame.platform.wtf.validators import ImageHashkey
+
+
+def make_hashkey(width, height, format_=b'JP', digest=b'x' * 32):
+    return base64.urlsafe_b64encode(struct.pack(
+        b'<32sII2s', digest, width, height, format_)).decode('ascii')
+
+
+class ValidatorsTestCase(TestCase):
+
+    def test_image_hashkey(self):
+
+        class TestForm(Form):
+            h = fields.StringField(validators=[
+                ImageHashkey(max_width=100, format_choices=('JPEG', 'PNG'))])
+
+        def validate(hashkey):
+            return TestForm(MultiDict([('h', hashkey)])).validate()
+
+        hashkey = make_hashkey(100, 50)
+        self.assertTrue(validate(hashkey))
+        # 和原来一样接受 base64 解码时忽略的多余字符
+        for suffix in ('=', '==', '\n', ' ', '.', '果'):
+            self.assertTrue(validate(hashkey + suffix))
+        # 长度, 字符, 长宽或者格式不对
+        for invalid in ('', hashkey[:-1], hashkey + 'A', hashkey + 'AAAA',
+                        '果' + hashkey[1:], make_hashkey(101, 50),
+                        make_hashkey(1, 1, b'GI'), make_hashkey(1, 1, b'XX')):
+            self.assertFalse(validate(invalid))
@@ -12,6 +12,8 @@ from wtforms.validators import Regexp, Length, ValidationError
 from guokr.platform.apis import image as imageapi
 from guokr.platform.apis import APIClientError
 from guokr.platform.contribs.encoding import smart_str, smart_unicode
+from guokr.platform.contribs.image import decode_hashkey, \
+    FORMATS, HASHKEY_LAYOUT
 from guokr.platform.engines import _share_redis
 from iptools import IpRange
 
@@ -147,17 +149,21 @@ class ImageHashkey(Regexp):
         if _set_message:
             self.message += ' (%(reason)s)'
 
-        try:
-            data = base64.urlsafe_b64decode(smart_str(field.data))
-            _, width, height, format_ = struct.unpack(b'<32sII2s', data)
-            format_ = {
-                'GI': 'GIF',
-                'PN': 'PNG',
-                'JP': 'JPEG'}[format_]
-        except (TypeError, struct.error, KeyError):
-            raise ValueError(self.message % {
-                'reason': 'hashkey格式错误',
-            })
+        params = decode_hashkey(field.data)
+        if params is None:
+            # decode_hashkey 只接受恰好 56 个字符的 hashkey, 这里还接受
+            # base64 解码时忽略的多余字符 (比如末尾的 = 和换行)
+            try:
+                data = base64.urlsafe_b64decode(smart_str(field.data))
+                _, width, height, format_ = struct.unpack(
+                    b'<' + HASHKEY_LAYOUT, data)
+                format_ = FORMATS[format_]
+            except (TypeError, struct.error, KeyError):
+                raise ValueError(self.message % {
+                    'reason': 'hashkey格式错误',
+                })
+        else:
+            width, height, format_ = params
 
         if width < self.min_width or height < self.min_height or \
            (self.max_width != -1 and width > self.max_width) or \